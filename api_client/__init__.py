@@ -7,3 +7,8 @@ YEARS = [y for y in range(starting_year, current_year + 1)]
 
 class APILimitReached(Exception):
     pass
+
+
+class IncompleteFetch(APILimitReached):
+    # some requests failed: the complete units are stored and checkpointed, the others are left for the next run
+    pass
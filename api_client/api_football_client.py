@@ -1,53 +1,79 @@
 import time
-import requests
+import threading
 import typing as t
 from pathlib import Path
 
 import logger
 import api_client
-from api_client import utils
+from api_client import utils, sessions
+from logger import metrics
 
 LOGGER = logger.get_logger('api_client')
 
 
 class APIFootballClient:
     def __init__(self, enable_cache=True, api_version='v3', cache_folder='.rapid_api_cache',
-                 requests_block=None):
+                 requests_block=None, rate_limiter=None, base_url: str = None, cache_backend='sqlite'):
         self._api_key = utils.get_api_key()
         if not self._api_key:
             raise Exception('API Football key not found in the environment vars set')
         self._rapid_api_host = utils.get_api_football_host()
-        self._enable_cache = enable_cache
+        # enable_cache is either a bool or an utils.CachePolicy (ttls, size budget, memory tier)
+        self._enable_cache = bool(enable_cache)
+        self._cache_policy = enable_cache if isinstance(enable_cache, utils.CachePolicy) else utils.CachePolicy()
         if self._enable_cache:
             cache_folder = Path(cache_folder)
             cache_folder.mkdir(exist_ok=True)
             utils.CACHE_FOLDER = cache_folder
-        self._url = f'https://{self._rapid_api_host}/{api_version}'
+            utils.CACHE_BACKEND = utils.get_cache_backend(cache_backend, cache_folder)
+            utils.get_memory_cache(self._cache_policy.memory_items)
+        self._url = base_url or utils.get_api_football_url() or f'https://{self._rapid_api_host}/{api_version}'
         self._headers = {
             'X-RapidAPI-Key': self._api_key,
             'X-RapidAPI-Host': self._rapid_api_host
         }
+        self._session = sessions.get_session('api_football')
         self._requests_so_far = 0
+        self._lock = threading.Lock()
 
         self._requests_block = requests_block
+        # optional api_client.fetch_engine.TokenBucket shared by every thread using this client
+        self._rate_limiter = rate_limiter
+
+    def _wait(self, seconds: float):
+        if self._rate_limiter is not None:
+            self._rate_limiter.pause(seconds)
+        else:
+            time.sleep(seconds)
+            metrics.observe('ratelimit.wait', seconds)
 
     def send_request(self, partial_url: str, params: dict = None) -> t.Optional[t.Dict]:
         url = f'{self._url}/{partial_url}'
 
         if self._enable_cache:
-            cached_response = utils.read_from_cache(url, params=params)
+            cached_response = utils.read_from_cache(url, params=params,
+                                                    max_age=self._cache_policy.ttl_for(url, params))
             if cached_response:
-                LOGGER.info(f'cache hit - {url}; params: {str(params)}')
+                metrics.incr('api.cache.hit')
+                LOGGER.debug('cache hit - %s; params: %s', url, params)
                 return cached_response
-
-        if self._requests_block is not None and self._requests_so_far >= self._requests_block:
-            msg = f'API limit reached (requests_n: {self._requests_so_far}, block: {self._requests_block})'
-            raise api_client.APILimitReached(msg)
-        self._requests_so_far += 1
-        LOGGER.info(f'starting request - {url}; params: {str(params)}')
+            metrics.incr('api.cache.miss')
+
+        with self._lock:
+            if self._requests_block is not None and self._requests_so_far >= self._requests_block:
+                msg = f'API limit reached (requests_n: {self._requests_so_far}, block: {self._requests_block})'
+                raise api_client.APILimitReached(msg)
+            self._requests_so_far += 1
+        LOGGER.debug('starting request - %s; params: %s', url, params)
         retried = False
         while True:
-            response = requests.get(url, params=params, headers=self._headers)
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            with metrics.timer('api.request'):
+                response = self._session.get(url, params=params, headers=self._headers)
+            metrics.incr(f'api.status.{response.status_code}')
+            if self._rate_limiter is not None:
+                self._rate_limiter.update(response.headers)
             remaining_requests = response.headers.get('x-ratelimit-requests-remaining', 0)
             if int(remaining_requests) < 10:
                 msg = f'API limit reached ({remaining_requests} remaining)'
@@ -55,7 +81,7 @@ class APIFootballClient:
                     raise api_client.APILimitReached(msg)
                 LOGGER.warning(msg)
                 retried = True
-                time.sleep(60)
+                self._wait(60)
                 continue
             if response.status_code == 429:
                 msg = f'Rate limit: {response.status_code} : {response.text}'
@@ -63,7 +89,7 @@ class APIFootballClient:
                     raise api_client.APILimitReached(msg)
                 LOGGER.warning(msg)
                 retried = True
-                time.sleep(15)
+                self._wait(15)
                 continue
             break
 
@@ -75,7 +101,8 @@ class APIFootballClient:
                 f'Received one or more errors in the response: {"; ".join(response.json().get("errors", []))}')
             return None
         if self._enable_cache:
-            utils.cache_result(utils.prepare_for_caching(url, params=params), response)
+            utils.cache_result(utils.prepare_for_caching(url, params=params), response, url=url, params=params,
+                               max_size=self._cache_policy.max_size)
 
         return response.json()
 
@@ -94,11 +121,11 @@ class APIFootballClient:
             params['page'] = current_page
             current_response = self.send_request(partial_url, params=params)
             if current_response is None:
-                LOGGER.warning(f'Returning partial result for pagination - url: {partial_url}, params: {str(params)}')
-                return res
+                LOGGER.warning(f'Page failed, no result for pagination - url: {partial_url}, params: {str(params)}')
+                return None
             total_pages = current_response.get('paging', {}).get('total', 1)
             current_page = current_response.get('paging', {}).get('current', 1)
-            LOGGER.info(f'\tpagination {current_page}/{total_pages}')
+            LOGGER.debug('\tpagination %s/%s', current_page, total_pages)
 
             res.extend(current_response.get('response', []))
 
@@ -117,25 +144,25 @@ class APIFootballClient:
         return response
 
     def get_league_players(self, league_id, year) -> t.Optional[t.List[t.Dict]]:
-        LOGGER.info(f'requesting league players - {league_id}, year {year}')
+        LOGGER.info('requesting league players - %s, year %s', league_id, year)
         response = self.get_clean_response('players', params={'league': league_id, 'season': year}, pagination=True)
 
         return response
 
     def get_player_stats(self, player_id, year):
-        LOGGER.info(f'requesting player stats - {player_id}')
+        LOGGER.info('requesting player stats - %s', player_id)
         response = self.get_clean_response('players', params={'id': player_id, 'season': year})
 
         return response
 
     def get_team_transfers(self, team_id):
-        LOGGER.info(f'requesting team transfers - {team_id}')
+        LOGGER.info('requesting team transfers - %s', team_id)
         response = self.get_clean_response('transfers', params={'team': team_id})
 
         return response
 
     def get_team_leagues(self, team_id):
-        LOGGER.info(f'requesting team leagues - {team_id}')
+        LOGGER.info('requesting team leagues - %s', team_id)
         response = self.get_clean_response('leagues', params={'team': team_id})
 
         return response
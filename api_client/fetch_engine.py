@@ -0,0 +1,145 @@
+import os
+import time
+import threading
+import typing as t
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
+
+import logger
+import api_client
+from logger import metrics
+from api_client import api_football_client
+
+LOGGER = logger.get_logger('api_client')
+
+DEFAULT_RATE_PER_MINUTE = int(os.getenv('API_FOOTBALL_RATE_PER_MINUTE', 300))
+DEFAULT_WORKERS = int(os.getenv('API_FOOTBALL_WORKERS', 8))
+QUOTA_RESERVE = 10
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float = DEFAULT_RATE_PER_MINUTE, capacity: float = None,
+                 quota_reserve: int = QUOTA_RESERVE):
+        self._rate = rate_per_minute / 60
+        self._capacity = capacity or max(1., self._rate)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.
+        self._quota_reserve = quota_reserve
+        self._quota_remaining = None
+        self._lock = threading.Lock()
+
+    @property
+    def rate_per_minute(self) -> float:
+        return self._rate * 60
+
+    @property
+    def quota_remaining(self) -> t.Optional[int]:
+        return self._quota_remaining
+
+    def _refill(self, now: float):
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self._quota_remaining is not None and self._quota_remaining < self._quota_reserve:
+                    raise api_client.APILimitReached(f'API limit reached ({self._quota_remaining} remaining)')
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    if self._quota_remaining is not None:
+                        self._quota_remaining -= 1
+                    return
+                to_wait = max(self._paused_until - now, (1 - self._tokens) / self._rate)
+            time.sleep(to_wait)
+            metrics.observe('ratelimit.wait', to_wait)
+
+    def pause(self, seconds: float):
+        # a 429 or a near-empty window stops every worker, not only the one that got it
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def update(self, headers: t.Mapping[str, str]):
+        with self._lock:
+            limit = headers.get('x-ratelimit-limit')
+            if limit and int(limit) > 0 and int(limit) / 60 != self._rate:
+                self._refill(time.monotonic())
+                self._rate = int(limit) / 60
+                self._capacity = max(1., self._rate)
+            remaining = headers.get('x-ratelimit-remaining')
+            if remaining is not None:
+                self._tokens = min(self._tokens, int(remaining))
+            quota_remaining = headers.get('x-ratelimit-requests-remaining')
+            if quota_remaining is not None:
+                self._quota_remaining = int(quota_remaining)
+
+
+class FetchEngine:
+    def __init__(self, client: api_football_client.APIFootballClient = None, max_workers: int = DEFAULT_WORKERS,
+                 rate_limiter: TokenBucket = None):
+        self._rate_limiter = rate_limiter or TokenBucket()
+        self._client = client or api_football_client.APIFootballClient(rate_limiter=self._rate_limiter)
+        self._max_workers = max_workers
+
+    def _fetch_page(self, partial_url: str, params: t.Dict, page: int) -> t.Optional[t.Dict]:
+        return self._client.send_request(partial_url, params={**params, 'page': page})
+
+    def iter_paginated(self, requests: t.Iterable[t.Tuple[t.Hashable, str, t.Dict]]
+                       ) -> t.Iterator[t.Tuple[t.Hashable, t.Optional[t.List[t.Dict]]]]:
+        # every request's first page is queued at once; the remaining pages are queued as soon as paging.total
+        # is known, and a request is yielded when all its pages are back, with None if any of them failed
+        pending: t.Dict[Future, t.Tuple[t.Hashable, int]] = {}
+        state = {}
+        executor = ThreadPoolExecutor(self._max_workers)
+        try:
+            for key, partial_url, params in requests:
+                state[key] = {'url': partial_url, 'params': params, 'pages': {}, 'missing': 1, 'failed': False}
+                pending[executor.submit(self._fetch_page, partial_url, params, 1)] = (key, 1)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, page = pending.pop(future)
+                    s = state[key]
+                    response = future.result()
+                    s['missing'] -= 1
+                    if response is None:
+                        LOGGER.warning(f'Page failed, no result for pagination - url: {s["url"]}, '
+                                       f'params: {str(s["params"])}, page: {page}')
+                        s['failed'] = True
+                    else:
+                        s['pages'][page] = response.get('response', [])
+                        total_pages = response.get('paging', {}).get('total', 1)
+                        if page == 1 and total_pages > 1:
+                            LOGGER.debug('\tpagination %s %s: %d pages', s['url'], s['params'], total_pages)
+                            for p in range(2, total_pages + 1):
+                                pending[executor.submit(self._fetch_page, s['url'], s['params'], p)] = (key, p)
+                            s['missing'] += total_pages - 1
+                    if s['missing'] == 0:
+                        del state[key]
+                        yield key, None if s['failed'] else [r for p in sorted(s['pages']) for r in s['pages'][p]]
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def iter_unpaginated(self, requests: t.Iterable[t.Tuple[t.Hashable, str, t.Dict]]
+                         ) -> t.Iterator[t.Tuple[t.Hashable, t.Optional[t.List[t.Dict]]]]:
+        # one call per request, sent as is (no page param) for the endpoints that do not paginate; yielded as they
+        # complete, None for a failed one
+        executor = ThreadPoolExecutor(self._max_workers)
+        try:
+            pending = {executor.submit(self._client.get_clean_response, partial_url, params): key
+                       for key, partial_url, params in requests}
+            for future in as_completed(pending):
+                yield pending[future], future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def iter_league_players(self, jobs: t.List[t.Tuple[int, t.Dict]]
+                            ) -> t.Iterator[t.Tuple[t.Tuple[int, t.Dict], t.Optional[t.List[t.Dict]]]]:
+        requests = ((i, 'players', {'league': l_id, 'season': season['year']})
+                    for i, (l_id, season) in enumerate(jobs))
+        for i, players in self.iter_paginated(requests):
+            yield jobs[i], players
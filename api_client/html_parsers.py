@@ -0,0 +1,147 @@
+import os
+import typing as t
+
+from bs4 import BeautifulSoup
+
+# the scraper only needs a handful of operations: the rows of the results table, the cells of a row and the
+# first descendant with a given tag (and class); every backend implements them over its own tree
+
+
+class HTMLParser:
+    name = None
+
+    def rows(self, text: str) -> t.List[t.Any]:
+        # the rows of the first table.items inside div#yw1
+        raise NotImplementedError
+
+    def cells(self, row) -> t.List[t.Any]:
+        raise NotImplementedError
+
+    def first(self, node, tag: str, cls: str = None):
+        raise NotImplementedError
+
+    def attr(self, node, name: str) -> t.Optional[str]:
+        raise NotImplementedError
+
+    def text(self, node) -> str:
+        raise NotImplementedError
+
+    def dump(self, node) -> str:
+        raise NotImplementedError
+
+
+class BeautifulSoupParser(HTMLParser):
+    name = 'bs4'
+
+    def rows(self, text: str):
+        soup = BeautifulSoup(text, 'html.parser')
+        return soup.find('div', attrs={'id': 'yw1'}).find('table', attrs={'class': 'items'}).find('tbody') \
+            .findChildren('tr', recursive=False)
+
+    def cells(self, row):
+        return row.findChildren('td', recursive=False)
+
+    def first(self, node, tag: str, cls: str = None):
+        return node.find(tag, attrs={'class': cls}) if cls else node.find(tag)
+
+    def attr(self, node, name: str):
+        return node.get(name)
+
+    def text(self, node) -> str:
+        return node.text
+
+    def dump(self, node) -> str:
+        return str(node)
+
+
+class LxmlParser(HTMLParser):
+    name = 'lxml'
+
+    def __init__(self):
+        import lxml.html
+        self._html = lxml.html
+
+    def rows(self, text: str):
+        tree = self._html.fromstring(text)
+        table = tree.xpath('//div[@id="yw1"]//table[contains(concat(" ", normalize-space(@class), " "), " items ")]')
+        return table[0].xpath('./tbody/tr')
+
+    def cells(self, row):
+        return row.xpath('./td')
+
+    def first(self, node, tag: str, cls: str = None):
+        if cls:
+            found = node.xpath(f'.//{tag}[contains(concat(" ", normalize-space(@class), " "), " {cls} ")]')
+            return found[0] if found else None
+        return node.find(f'.//{tag}')
+
+    def attr(self, node, name: str):
+        return node.get(name)
+
+    def text(self, node) -> str:
+        return node.text_content()
+
+    def dump(self, node) -> str:
+        return self._html.tostring(node, encoding='unicode')
+
+
+class SelectolaxParser(HTMLParser):
+    name = 'selectolax'
+
+    def __init__(self):
+        try:
+            from selectolax.lexbor import LexborHTMLParser as Tree
+        except ImportError:
+            from selectolax.parser import HTMLParser as Tree
+        self._tree = Tree
+
+    @staticmethod
+    def _children(node, tag: str):
+        return [child for child in node.iter() if child.tag == tag]
+
+    def rows(self, text: str):
+        table = self._tree(text).css_first('div#yw1 table.items')
+        if table is None:
+            raise ValueError('results table not found')
+        return [row for tbody in self._children(table, 'tbody') for row in self._children(tbody, 'tr')]
+
+    def cells(self, row):
+        return self._children(row, 'td')
+
+    def first(self, node, tag: str, cls: str = None):
+        return node.css_first(f'{tag}.{cls}' if cls else tag)
+
+    def attr(self, node, name: str):
+        return node.attributes.get(name)
+
+    def text(self, node) -> str:
+        return node.text()
+
+    def dump(self, node) -> str:
+        return node.html
+
+
+BACKENDS = {backend.name: backend for backend in (SelectolaxParser, LxmlParser, BeautifulSoupParser)}
+_parsers: t.Dict[str, HTMLParser] = {}
+
+
+def available_backends() -> t.List[str]:
+    names = []
+    for name, backend in BACKENDS.items():
+        try:
+            backend()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def get_parser(name: str = None) -> HTMLParser:
+    # the fastest installed backend unless one is asked for (HTML_PARSER env var); bs4 is always there
+    name = name or os.getenv('HTML_PARSER')
+    if name not in _parsers:
+        if name:
+            _parsers[name] = BACKENDS[name]()
+        else:
+            _parsers[name] = get_parser(available_backends()[0])
+    return _parsers[name]
@@ -0,0 +1,55 @@
+import os
+import threading
+import typing as t
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 30))
+DEFAULT_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 16))
+DEFAULT_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+DEFAULT_BACKOFF = float(os.getenv('HTTP_BACKOFF', .5))
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_sessions: t.Dict[t.Tuple[int, str], requests.Session] = {}
+_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, timeout: float = DEFAULT_TIMEOUT, **kwargs):
+        self._timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+        return super().send(request, **kwargs)
+
+
+def create_session(pool_size: int = DEFAULT_POOL_SIZE, retries: int = DEFAULT_RETRIES,
+                   backoff: float = DEFAULT_BACKOFF, timeout: float = DEFAULT_TIMEOUT,
+                   headers: t.Dict[str, str] = None) -> requests.Session:
+    # 429s are left to the callers, they all have their own way of dealing with the rate limit
+    retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUSES, allowed_methods=frozenset(('GET', 'HEAD')),
+                  raise_on_status=False)
+    adapter = TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry,
+                                 timeout=timeout)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def get_session(name: str = 'default', **kwargs) -> requests.Session:
+    # one session per process and name: sockets must not be shared with forked pool workers
+    key = (os.getpid(), name)
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = create_session(**kwargs)
+            _sessions[key] = session
+    return session
@@ -1,33 +1,80 @@
+import os
 import re
+import gzip
 import time
 import json
+import hashlib
+import itertools
 import datetime
+import tempfile
+import threading
 import traceback
 import typing as t
 from pathlib import Path
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
-from bs4 import BeautifulSoup
 
 import logger
+from logger import metrics
+from api_client import sessions, html_parsers
+from api_client.fetch_engine import TokenBucket
 
 LOGGER = logger.get_logger('transfermarkt')
 
 MAX_RETRIES = 3
+BACKOFF = 5
+WORKERS = int(os.getenv('TRANSFERMARKT_WORKERS', 4))
+RATE_PER_MINUTE = float(os.getenv('TRANSFERMARKT_RATE_PER_MINUTE', 120))
+CACHE_FOLDER = Path('.transfermarkt_cache')
+CACHE_TTL = float(os.getenv('TRANSFERMARKT_CACHE_TTL', 24 * 60 * 60))
+TEAMS_URL = 'https://www.transfermarkt.co.uk/spieler-statistik/wertvollstemannschaften/marktwertetop?ajax=yw1&page={page}'
+PLAYERS_URL = 'https://www.transfermarkt.co.uk/spieler-statistik/wertvollstespieler/marktwertetop?ajax=yw1&page={page}'
 HEADERS = {
     'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.0.0 Safari/537.36'
 }
 RESULTS_FOLDER = Path('.transfermarkt_results')
-RESULTS_FOLDER.mkdir(exist_ok=True)
+MANIFEST = 'manifest.json'
 
 MILLION_FINDER = re.compile(r'[^0-9]([0-9]+\.[0-9]+)m')
 BILLION_FINDER = re.compile(r'[^0-9]([0-9]+\.[0-9]+)bn')
 
 
+_limiters: t.Dict[str, TokenBucket] = {}
+_limiters_lock = threading.Lock()
+
+
 class MaxRetriesReached(Exception):
     pass
 
 
+class PageCache:
+    # one gzipped file per fetched page; pages older than ttl are fetched again
+    def __init__(self, folder: Path = CACHE_FOLDER, ttl: t.Optional[float] = CACHE_TTL):
+        self._folder = Path(folder)
+        self._ttl = ttl
+
+    def _path(self, url: str) -> Path:
+        return Path(self._folder, f'{hashlib.md5(url.encode()).hexdigest()}.html.gz')
+
+    def get(self, url: str) -> t.Optional[str]:
+        path = self._path(url)
+        try:
+            if self._ttl is not None and time.time() - path.stat().st_mtime > self._ttl:
+                return None
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                return f.read()
+        except (FileNotFoundError, EOFError, OSError):
+            return None
+
+    def set(self, url: str, text: str):
+        self._folder.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self._folder, delete=False) as f:
+            f.write(gzip.compress(text.encode('utf-8')))
+        os.replace(f.name, self._path(url))
+
+
 def _extract_value(v: str):
     value = MILLION_FINDER.findall(v)
     if value:
@@ -39,19 +86,173 @@ def _extract_value(v: str):
     return None
 
 
-def _extract_teams(r_text: str) -> t.List[t.Dict]:
+def get_limiter(url: str) -> TokenBucket:
+    # one politeness budget per host, shared by every worker
+    host = urlsplit(url).netloc
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = TokenBucket(RATE_PER_MINUTE, capacity=1)
+        return _limiters[host]
+
+
+def fetch_page(url: str, cache: t.Optional[PageCache] = None, retries: int = MAX_RETRIES) -> str:
+    text = cache.get(url) if cache else None
+    if text is not None:
+        metrics.incr('transfermarkt.cache.hit')
+        return text
+    if cache:
+        metrics.incr('transfermarkt.cache.miss')
+
+    limiter = get_limiter(url)
+    session = sessions.get_session('transfermarkt', headers=HEADERS)
+    for attempt in range(retries):
+        limiter.acquire()
+        try:
+            with metrics.timer('transfermarkt.request'):
+                r = session.get(url)
+        except requests.RequestException as e:
+            metrics.incr('transfermarkt.errors')
+            LOGGER.warning(f'{url}: {e}')
+        else:
+            metrics.incr(f'transfermarkt.status.{r.status_code}')
+            if r.status_code == 200:
+                if cache:
+                    cache.set(url, r.text)
+                return r.text
+            # error bodies are never parsed
+            LOGGER.warning(f'{r.status_code} for {url}')
+            if r.status_code == 404 or r.status_code in sessions.RETRY_STATUSES:
+                # server errors have already been retried with backoff by the session
+                break
+            if r.status_code == 429:
+                # the limiter stops every worker on the host, acquire() waits for it
+                retry_after = r.headers.get('Retry-After', '')
+                limiter.pause(float(retry_after) if retry_after.isdigit() else BACKOFF * 2 ** attempt)
+                continue
+        time.sleep(BACKOFF * 2 ** attempt)
+    raise MaxRetriesReached(f'Giving up on {url}')
+
+
+def iter_pages(url_template: str, up_to_page: int, extract: t.Callable[[str], t.List[t.Dict]],
+               workers: int = WORKERS, cache: t.Optional[PageCache] = None
+               ) -> t.Iterator[t.Tuple[int, t.Optional[t.List[t.Dict]]]]:
+    # pages are fetched and parsed concurrently and yielded as soon as they are done, None for failed pages
+    def fetch_and_extract(page: int) -> t.List[t.Dict]:
+        return extract(fetch_page(url_template.format(page=page), cache))
+
+    executor = ThreadPoolExecutor(workers)
+    try:
+        futures = {executor.submit(fetch_and_extract, page): page for page in range(1, up_to_page + 1)}
+        for future in as_completed(futures):
+            page = futures.pop(future)
+            try:
+                yield page, future.result()
+            except MaxRetriesReached as e:
+                LOGGER.warning(str(e))
+                yield page, None
+            except Exception as e:
+                LOGGER.error(f'Page {page} not parsed: {e}\n{traceback.format_exc()}')
+                yield page, None
+    finally:
+        # a consumer stopping early (closed generator, RunWriter raising) leaves the pages not started yet unfetched
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+class RunWriter:
+    # one folder per run: every page is written to its own jsonl file as soon as it is parsed, and the manifest
+    # says which pages are in, so a crashed or still running scrape can already be read
+    def __init__(self, kind: str, up_to_page: int, folder: Path = RESULTS_FOLDER):
+        now = datetime.datetime.now()
+        # sortable names; runs started at the same time (same process or not) get a suffix
+        name = f'{kind}_{now.strftime("%Y%m%d_%H%M%S_%f")}'
+        for attempt in itertools.count():
+            self.path = Path(folder, f'{name}_{attempt}' if attempt else name)
+            try:
+                self.path.mkdir(parents=True)
+                break
+            except FileExistsError:
+                continue
+        self.manifest = {'kind': kind, 'started_at': now.isoformat(), 'finished_at': None, 'complete': False,
+                         'up_to_page': up_to_page, 'rows': 0, 'pages': [], 'failed': []}
+        self._write_manifest()
+
+    def _write(self, name: str, lines: t.Iterable[str]):
+        with tempfile.NamedTemporaryFile('w', dir=self.path, delete=False, encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(f.name, Path(self.path, name))
+
+    def _write_manifest(self):
+        self._write(MANIFEST, [json.dumps(self.manifest, indent=4)])
+
+    def add_page(self, page: int, rows: t.Optional[t.List[t.Dict]]):
+        if rows is None:
+            self.manifest['failed'].append(page)
+        else:
+            self._write(f'page-{page:05d}.jsonl', (json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+            self.manifest['pages'].append(page)
+            self.manifest['rows'] += len(rows)
+        self._write_manifest()
+        done = len(self.manifest['pages']) + len(self.manifest['failed'])
+        if done % 50 == 0:
+            LOGGER.info(f'{done}/{self.manifest["up_to_page"]} pages')
+
+    def close(self):
+        self.manifest['finished_at'] = datetime.datetime.now().isoformat()
+        self.manifest['complete'] = not self.manifest['failed']
+        self._write_manifest()
+        if self.manifest['failed']:
+            LOGGER.warning(f'{len(self.manifest["failed"])} pages failed: {sorted(self.manifest["failed"])}')
+        LOGGER.info(f'{self.manifest["rows"]} rows written to {self.path}')
+
+
+def _read_jsonl(path: Path) -> t.Iterator[t.Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_results(path: t.Union[str, Path]) -> t.Iterator[t.Dict]:
+    # rows of a run folder in page order, of a single jsonl file or of a results file in the old json format
+    path = Path(path)
+    if path.is_dir():
+        with open(Path(path, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        if not manifest['complete']:
+            LOGGER.warning(f'{path} is a partial run: {len(manifest["pages"])} of {manifest["up_to_page"]} pages')
+        for page_path in sorted(path.glob('page-*.jsonl')):
+            yield from _read_jsonl(page_path)
+    elif path.suffix == '.jsonl':
+        yield from _read_jsonl(path)
+    else:
+        with open(path, 'r') as f:
+            yield from json.load(f)
+
+
+def _collect(kind: str, url_template: str, up_to_page: int, extract: t.Callable[[str], t.List[t.Dict]],
+             workers: int, refresh: bool) -> Path:
+    writer = RunWriter(kind, up_to_page)
+    try:
+        for page, rows in iter_pages(url_template, up_to_page, extract, workers,
+                                     PageCache(ttl=0 if refresh else CACHE_TTL)):
+            writer.add_page(page, rows)
+    finally:
+        writer.close()
+    return writer.path
+
+
+def _extract_teams(r_text: str, parser: html_parsers.HTMLParser = None) -> t.List[t.Dict]:
+    parser = parser or html_parsers.get_parser()
     ret = []
-    soup = BeautifulSoup(r_text, 'html.parser')
-    t_body = soup.find('div', attrs={'id': 'yw1'}).find('table', attrs={'class': 'items'}).find('tbody')
-    for tr in t_body.findChildren('tr', recursive=False):
+    for tr in parser.rows(r_text):
         try:
-            tds = [td for td in tr.findChildren('td', recursive=False)]
-            team_name = tds[2].find('a')['title']
-            league_name = tds[3].find('a')['title']
-            value = tds[4].find('b').text
+            tds = parser.cells(tr)
+            team_name = parser.attr(parser.first(tds[2], 'a'), 'title')
+            league_name = parser.attr(parser.first(tds[3], 'a'), 'title')
+            value = parser.text(parser.first(tds[4], 'b'))
             value = _extract_value(value)
             if not all((league_name, team_name, value)):
-                LOGGER.warning(f'Skipping row {tr}: {(league_name, team_name, value)}')
+                LOGGER.warning(f'Skipping row {parser.dump(tr)}: {(league_name, team_name, value)}')
                 continue
             ret.append({
                 'team': team_name,
@@ -59,54 +260,27 @@ def _extract_teams(r_text: str) -> t.List[t.Dict]:
                 'value': value
             })
         except Exception as e:
-            LOGGER.error(f'Skipping row {tr}')
+            LOGGER.error(f'Skipping row {parser.dump(tr)}')
             LOGGER.error(f'{e}\n{traceback.format_exc()}')
     return ret
 
 
-def collect_valuable_teams(up_to_page: int):
-    page = 1
-    res = []
-    current_retries = 0
-    try:
-        for i in range(page, up_to_page + 1):
-            LOGGER.info(f'Page {i}')
-            r = requests.get(
-                f'https://www.transfermarkt.co.uk/spieler-statistik/wertvollstemannschaften/marktwertetop?ajax=yw1&page={i}',
-                headers=HEADERS)
-            if r.status_code != 200:
-                LOGGER.warning(f'{r.status_code}: {r.text}')
-                current_retries += 1
-                if current_retries == MAX_RETRIES:
-                    raise MaxRetriesReached('Max retries reached')
-                time.sleep(5)
-            current_retries = 0
-            res.extend(_extract_teams(r.text))
-            time.sleep(.2)
-    except MaxRetriesReached:
-        LOGGER.warning('Max retries reached')
-    except Exception as e:
-        stack = traceback.format_exc()
-        LOGGER.error(f'Unhandled exception: {e}\n{stack}')
-
-    now = datetime.datetime.now().strftime("%m_%d_%Y__%H_%M_%S")
-    with open(Path(RESULTS_FOLDER, f'teams_{now}.json'), 'w') as f:
-        json.dump(res, f, indent=4, ensure_ascii=False)
-
-
-def _extract_players(r_text: str) -> t.List[t.Dict]:
+def collect_valuable_teams(up_to_page: int, workers: int = WORKERS, refresh=False) -> Path:
+    return _collect('teams', TEAMS_URL, up_to_page, _extract_teams, workers, refresh)
+
+
+def _extract_players(r_text: str, parser: html_parsers.HTMLParser = None) -> t.List[t.Dict]:
+    parser = parser or html_parsers.get_parser()
     ret = []
-    soup = BeautifulSoup(r_text, 'html.parser')
-    t_body = soup.find('div', attrs={'id': 'yw1'}).find('table', attrs={'class': 'items'}).find('tbody')
-    for tr in t_body.findChildren('tr', recursive=False):
+    for tr in parser.rows(r_text):
         try:
-            tds = [td for td in tr.findChildren('td', recursive=False)]
-            player_name = tds[1].find('td', attrs={'class': 'hauptlink'}).find('a')['title']
-            team_name = tds[4].find('a')['title']
-            value = tds[5].find('a').text
+            tds = parser.cells(tr)
+            player_name = parser.attr(parser.first(parser.first(tds[1], 'td', 'hauptlink'), 'a'), 'title')
+            team_name = parser.attr(parser.first(tds[4], 'a'), 'title')
+            value = parser.text(parser.first(tds[5], 'a'))
             value = _extract_value(value)
             if not all((player_name, team_name, value)):
-                LOGGER.warning(f'Skipping row {tr}: {(player_name, team_name, value)}')
+                LOGGER.warning(f'Skipping row {parser.dump(tr)}: {(player_name, team_name, value)}')
                 continue
             ret.append({
                 'player': player_name,
@@ -114,39 +288,13 @@ def _extract_players(r_text: str) -> t.List[t.Dict]:
                 'value': value
             })
         except Exception as e:
-            LOGGER.error(f'Skipping row {tr}')
+            LOGGER.error(f'Skipping row {parser.dump(tr)}')
             LOGGER.error(f'{e}\n{traceback.format_exc()}')
     return ret
 
 
-def collect_valuable_players(up_to_page: int):
-    page = 1
-    res = []
-    current_retries = 0
-    try:
-        for i in range(page, up_to_page + 1):
-            LOGGER.info(f'Page {i}')
-            r = requests.get(
-                f'https://www.transfermarkt.co.uk/spieler-statistik/wertvollstespieler/marktwertetop?ajax=yw1&page={i}',
-                headers=HEADERS)
-            if r.status_code != 200:
-                LOGGER.warning(f'{r.status_code}: {r.text}')
-                current_retries += 1
-                if current_retries == MAX_RETRIES:
-                    raise MaxRetriesReached('Max retries reached')
-                time.sleep(5)
-            current_retries = 0
-            res.extend(_extract_players(r.text))
-            time.sleep(.2)
-    except MaxRetriesReached:
-        LOGGER.warning('Max retries reached')
-    except Exception as e:
-        stack = traceback.format_exc()
-        LOGGER.error(f'Unhandled exception: {e}\n{stack}')
-
-    now = datetime.datetime.now().strftime("%m_%d_%Y__%H_%M_%S")
-    with open(Path(RESULTS_FOLDER, f'players_{now}.json'), 'w') as f:
-        json.dump(res, f, indent=4, ensure_ascii=False)
+def collect_valuable_players(up_to_page: int, workers: int = WORKERS, refresh=False) -> Path:
+    return _collect('players', PLAYERS_URL, up_to_page, _extract_players, workers, refresh)
 
 
 if __name__ == '__main__':
@@ -1,15 +1,28 @@
 import os
+import re
 import json
+import time
+import zlib
+import sqlite3
 import hashlib
+import threading
+import collections
 import requests
 import typing as t
 
 from pathlib import Path
 
 import logger
+import api_client
 
 LOGGER = logger.get_logger('api_client')
 CACHE_FOLDER: Path = None
+CACHE_BACKEND: 'CacheBackend' = None
+LEGACY_CACHE_KEY = re.compile(r'[0-9a-f]{32}')
+MEMORY_CACHE: 'MemoryCache' = None
+EVICTION_EVERY = 100
+_writes_since_eviction = 0
+_backends: t.Dict[t.Tuple[str, Path], 'CacheBackend'] = {}
 
 
 def get_api_key() -> t.Optional[str]:
@@ -21,6 +34,11 @@ def get_api_football_host() -> str:
     return os.getenv('API_FOOTBALL_HOST', 'api-football-v1.p.rapidapi.com')
 
 
+def get_api_football_url() -> t.Optional[str]:
+    # points every client to another server, e.g. the fake one of benchmarks/fake_api.py
+    return os.getenv('API_FOOTBALL_URL') or None
+
+
 def prepare_for_caching(request_url: str, params: dict = None) -> str:
     h = request_url
     if params:
@@ -29,30 +47,305 @@ def prepare_for_caching(request_url: str, params: dict = None) -> str:
     return hashlib.md5(h.encode("utf-8")).hexdigest()
 
 
-def cache_result(hashed_url: str, response: requests.Response):
+DAY = 24 * 60 * 60
+
+
+class CachePolicy:
+    # ttl in seconds, None means the entry never expires; max_size is a budget in bytes for the disk tier
+    DEFAULT_TTLS = {
+        'leagues': 30 * DAY,
+        'transfers': 7 * DAY,
+        'players': None,
+    }
+
+    def __init__(self, ttls: t.Dict[str, t.Optional[float]] = None, default_ttl: t.Optional[float] = None,
+                 current_season_ttl: t.Optional[float] = DAY, max_size: t.Optional[int] = None,
+                 memory_items: int = 256):
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.default_ttl = default_ttl
+        self.current_season_ttl = current_season_ttl
+        self.max_size = max_size
+        self.memory_items = memory_items
+
+    def ttl_for(self, url: str, params: dict = None) -> t.Optional[float]:
+        # data about the season being played changes every week, older seasons are settled
+        if params and str(params.get('season')) == str(api_client.YEARS[-1]):
+            return self.current_season_ttl
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+        return self.ttls.get(endpoint, self.default_ttl)
+
+
+def _is_fresh(fetched_at: float, max_age: t.Optional[float]) -> bool:
+    return max_age is None or (fetched_at or 0) + max_age >= time.time()
+
+
+class MemoryCache:
+    # small per-process LRU in front of the disk tier; cached objects are shared, callers must not mutate them
+    def __init__(self, max_items: int = 256):
+        self.max_items = max_items
+        self._items: t.OrderedDict[str, t.Tuple[float, t.Any]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_entry(self, key: str) -> t.Optional[t.Tuple[float, t.Any]]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+            return entry
+
+    def set(self, key: str, fetched_at: float, obj: t.Any):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = (fetched_at, obj)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+class CacheBackend:
+    def get_entry(self, key: str) -> t.Optional[t.Tuple[float, t.Any]]:
+        raise NotImplementedError
+
+    def get(self, key: str, max_age: t.Optional[float] = None) -> t.Optional[t.Any]:
+        entry = self.get_entry(key)
+        if entry is None or not _is_fresh(entry[0], max_age):
+            return None
+        return entry[1]
+
+    def set(self, key: str, obj: t.Any, url: str = None, params: dict = None):
+        raise NotImplementedError
+
+    def evict(self, max_size: int) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, key: str) -> bool:
+        raise NotImplementedError
+
+
+class FolderCacheBackend(CacheBackend):
+    # legacy layout: one indented json file per request, mtime is used both as fetch and as access time
+    def __init__(self, folder: Path):
+        self.folder = Path(folder)
+        self.folder.mkdir(exist_ok=True)
+
+    def __contains__(self, key: str) -> bool:
+        return Path(self.folder, key).exists()
+
+    def get_entry(self, key: str) -> t.Optional[t.Tuple[float, t.Any]]:
+        path_to_obj = Path(self.folder, key)
+        if not path_to_obj.exists():
+            return None
+
+        with open(path_to_obj, 'r') as f:
+            try:
+                return path_to_obj.stat().st_mtime, json.load(f)
+            except Exception as e:
+                LOGGER.error(f'CACHE - Exception occurred while parsing json file for cache: {e}')
+                return None
+
+    def set(self, key: str, obj: t.Any, url: str = None, params: dict = None):
+        with open(Path(self.folder, key), 'w') as f:
+            json.dump(obj, f, indent=4, ensure_ascii=False)
+
+    def evict(self, max_size: int) -> int:
+        files = [(p.stat(), p) for p in self.folder.iterdir() if LEGACY_CACHE_KEY.fullmatch(p.name)]
+        total = sum(st.st_size for st, _ in files)
+        evicted = 0
+        for st, p in sorted(files, key=lambda f: f[0].st_mtime):
+            if total <= max_size:
+                break
+            p.unlink(missing_ok=True)
+            total -= st.st_size
+            evicted += 1
+        return evicted
+
+
+class SQLiteCacheBackend(CacheBackend):
+    # single file store: zlib compressed compact json, keyed by prepare_for_caching
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS response (
+        key TEXT PRIMARY KEY,
+        url TEXT,
+        params TEXT,
+        fetched_at REAL,
+        size INTEGER,
+        payload BLOB,
+        accessed_at REAL
+    )
+    '''
+    # access times are only written back when they are older than this, reads stay reads most of the time
+    ACCESS_RESOLUTION = 60 * 60
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        con = self._connection()
+        con.execute(self.SCHEMA)
+        if 'accessed_at' not in {r[1] for r in con.execute('PRAGMA table_info(response)')}:
+            con.execute('ALTER TABLE response ADD COLUMN accessed_at REAL')
+            con.execute('UPDATE response SET accessed_at = fetched_at')
+        con.execute('CREATE INDEX IF NOT EXISTS response_accessed_at ON response (accessed_at)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # one connection per thread, and a new one after a fork
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    @staticmethod
+    def encode(obj: t.Any) -> bytes:
+        return zlib.compress(json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+
+    @staticmethod
+    def decode(payload: bytes) -> t.Any:
+        return json.loads(zlib.decompress(payload))
+
+    def __contains__(self, key: str) -> bool:
+        return self._connection().execute('SELECT 1 FROM response WHERE key = ?', (key,)).fetchone() is not None
+
+    def get_entry(self, key: str) -> t.Optional[t.Tuple[float, t.Any]]:
+        con = self._connection()
+        row = con.execute('SELECT fetched_at, accessed_at, payload FROM response WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        fetched_at, accessed_at, payload = row
+        now = time.time()
+        if (accessed_at or 0) + self.ACCESS_RESOLUTION < now:
+            con.execute('UPDATE response SET accessed_at = ? WHERE key = ?', (now, key))
+        try:
+            return fetched_at, self.decode(payload)
+        except Exception as e:
+            LOGGER.error(f'CACHE - Exception occurred while decoding cached payload: {e}')
+            return None
+
+    def set(self, key: str, obj: t.Any, url: str = None, params: dict = None, fetched_at: float = None):
+        self.set_many([(key, obj, url, params, fetched_at)])
+
+    def set_many(self, entries: t.Iterable[t.Tuple[str, t.Any, t.Optional[str], t.Optional[dict], t.Optional[float]]],
+                 replace: bool = True):
+        rows = []
+        for key, obj, url, params, fetched_at in entries:
+            payload = self.encode(obj)
+            fetched_at = fetched_at or time.time()
+            rows.append((key, url, json.dumps(params, sort_keys=True) if params else None, fetched_at,
+                         len(payload), payload, fetched_at))
+        con = self._connection()
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            con.executemany(f'INSERT OR {"REPLACE" if replace else "IGNORE"} INTO response '
+                            f'(key, url, params, fetched_at, size, payload, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            rows)
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+
+    def evict(self, max_size: int) -> int:
+        # least recently used entries go first, until what is left fits in the budget
+        con = self._connection()
+        cursor = con.execute('DELETE FROM response WHERE key IN ('
+                             'SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC, key) AS running '
+                             'FROM response) WHERE running > ?)', (max_size,))
+        return cursor.rowcount
+
+
+def get_cache_backend(kind: str, cache_folder: Path) -> CacheBackend:
+    key = (kind, Path(cache_folder).absolute())
+    backend = _backends.get(key)
+    if backend is not None:
+        return backend
+    if kind == 'sqlite':
+        db_path = Path(cache_folder, 'cache.sqlite3')
+        if not db_path.exists() and has_legacy_entries(cache_folder):
+            LOGGER.warning(f'CACHE - {cache_folder} holds legacy json entries, run migrate_folder_cache to keep them')
+        backend = SQLiteCacheBackend(db_path)
+    elif kind == 'folder':
+        backend = FolderCacheBackend(cache_folder)
+    else:
+        raise ValueError(f'Unknown cache backend: {kind}')
+    _backends[key] = backend
+    return backend
+
+
+def migrate_folder_cache(cache_folder='.rapid_api_cache', batch_size: int = 1000) -> int:
+    # one-shot copy of the legacy one-file-per-request cache into the sqlite store
+    cache_folder = Path(cache_folder)
+    backend = SQLiteCacheBackend(Path(cache_folder, 'cache.sqlite3'))
+    migrated = 0
+    batch = []
+    for path_to_obj in cache_folder.iterdir():
+        if not LEGACY_CACHE_KEY.fullmatch(path_to_obj.name):
+            continue
+        try:
+            with open(path_to_obj, 'r') as f:
+                obj = json.load(f)
+        except Exception as e:
+            LOGGER.error(f'CACHE - Skipping {path_to_obj.name}: {e}')
+            continue
+        batch.append((path_to_obj.name, obj, None, None, path_to_obj.stat().st_mtime))
+        if len(batch) == batch_size:
+            backend.set_many(batch, replace=False)
+            migrated += len(batch)
+            batch = []
+            LOGGER.info(f'CACHE - {migrated} entries migrated')
+    if batch:
+        backend.set_many(batch, replace=False)
+        migrated += len(batch)
+    LOGGER.info(f'CACHE - migration done: {migrated} entries')
+    return migrated
+
+
+def has_legacy_entries(cache_folder: Path) -> bool:
+    return any(LEGACY_CACHE_KEY.fullmatch(p.name) for p in Path(cache_folder).iterdir())
+
+
+def get_memory_cache(max_items: int) -> MemoryCache:
+    global MEMORY_CACHE
+    if MEMORY_CACHE is None or MEMORY_CACHE.max_items != max_items:
+        MEMORY_CACHE = MemoryCache(max_items)
+    return MEMORY_CACHE
+
+
+def cache_result(hashed_url: str, response: requests.Response, url: str = None, params: dict = None,
+                 max_size: int = None):
     if response.status_code != 200:
         return
-    path_to_obj = Path(CACHE_FOLDER, hashed_url)
-    if path_to_obj.exists():
-        return
     try:
         obj = response.json()
     except Exception as e:
         LOGGER.error(f'CACHE - Exception occurred while parsing response for cache: {e}')
         return
 
-    with open(path_to_obj, 'w') as f:
-        json.dump(obj, f, indent=4, ensure_ascii=False)
+    CACHE_BACKEND.set(hashed_url, obj, url=url, params=params)
+    if MEMORY_CACHE is not None:
+        MEMORY_CACHE.set(hashed_url, time.time(), obj)
+    if max_size is not None:
+        global _writes_since_eviction
+        _writes_since_eviction += 1
+        if _writes_since_eviction >= EVICTION_EVERY:
+            _writes_since_eviction = 0
+            evicted = CACHE_BACKEND.evict(max_size)
+            if evicted:
+                LOGGER.info(f'CACHE - {evicted} entries evicted')
 
 
-def read_from_cache(url, params: dict = None) -> t.Optional[t.Any]:
-    path_to_obj = Path(CACHE_FOLDER, prepare_for_caching(url, params=params))
-    if not path_to_obj.exists():
-        return None
+def read_from_cache(url, params: dict = None, max_age: t.Optional[float] = None) -> t.Optional[t.Any]:
+    key = prepare_for_caching(url, params=params)
+    if MEMORY_CACHE is not None:
+        entry = MEMORY_CACHE.get_entry(key)
+        if entry is not None and _is_fresh(entry[0], max_age):
+            return entry[1]
 
-    with open(path_to_obj, 'r') as f:
-        try:
-            return json.load(f)
-        except Exception as e:
-            LOGGER.error(f'CACHE - Exception occurred while parsing json file for cache: {e}')
-            return None
+    entry = CACHE_BACKEND.get_entry(key)
+    if entry is None or not _is_fresh(entry[0], max_age):
+        return None
+    if MEMORY_CACHE is not None:
+        MEMORY_CACHE.set(key, *entry)
+    return entry[1]
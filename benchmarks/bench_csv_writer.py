@@ -0,0 +1,55 @@
+import time
+import random
+import argparse
+import resource
+import tempfile
+import typing as t
+from pathlib import Path
+
+from data_generator import neo4j_interactor
+
+
+def synthetic_players(n_players: int) -> t.Iterator[t.Tuple[int, float]]:
+    for p_id in range(1, n_players + 1):
+        yield p_id, float(p_id % 50)
+
+
+def synthetic_relationships(n_edges: int, n_players: int, seed: int = 0) -> t.Iterator[t.Tuple[int, int, int]]:
+    rnd = random.Random(seed)
+    for _ in range(n_edges):
+        yield rnd.randint(1, n_players), rnd.randint(1, n_players), rnd.randint(1, 2000)
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(n_edges: int, n_players: int, part_size: int, compress: bool) -> t.Dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp, 'csv_files')
+        start = time.perf_counter()
+        neo4j_interactor.dump_csvs(synthetic_players(n_players), synthetic_relationships(n_edges, n_players),
+                                   csv_files_root=root, part_size=part_size, compress=compress)
+        elapsed = time.perf_counter() - start
+        size = sum(f.stat().st_size for f in root.iterdir())
+
+    return {
+        'edges': n_edges,
+        'compress': compress,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': int((n_edges + n_players) / elapsed),
+        'bytes_written': size,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput and peak RSS of the streaming neo4j csv writer')
+    parser.add_argument('--edges', type=int, nargs='+', default=[100000, 1000000, 5000000])
+    parser.add_argument('--players', type=int, default=100000)
+    parser.add_argument('--part-size', type=int, default=100000)
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+
+    for n in args.edges:
+        print(run(n, args.players, args.part_size, args.compress))
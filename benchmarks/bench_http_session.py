@@ -0,0 +1,60 @@
+import time
+import argparse
+import threading
+import statistics
+import typing as t
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+from api_client import sessions
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = b'{"errors": [], "response": []}'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(get: t.Callable, url: str, n: int) -> t.Dict:
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        get(url, params={'page': i})
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        'requests': n,
+        'mean_ms': round(statistics.mean(latencies), 3),
+        'p50_ms': round(statistics.median(latencies), 3),
+        'p95_ms': round(sorted(latencies)[int(n * .95) - 1], 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per request latency: bare requests.get vs pooled session')
+    parser.add_argument('-n', type=int, default=2000)
+    args = parser.parse_args()
+
+    server = start_server()
+    url = f'http://127.0.0.1:{server.server_port}/v3/players'
+    try:
+        print('requests.get   ', measure(requests.get, url, args.n))
+        print('pooled session ', measure(sessions.create_session().get, url, args.n))
+    finally:
+        server.shutdown()
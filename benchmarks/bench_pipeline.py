@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import tempfile
+import traceback
+import subprocess
+import typing as t
+from pathlib import Path
+
+# the benchmark owns its database (dropped at every scale), only needs the warnings of the pipeline and is only
+# limited by the rate of the fake API; every stage is a full load, no graph changelog is needed. All of it is read
+# when the modules below are imported
+os.environ['DB_NAME'] = os.getenv('BENCH_DB_NAME', 'football_bench')
+os.environ.setdefault('GRAPH_CHANGELOG', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('RAPID_API_KEY', 'benchmark')
+os.environ.setdefault('API_FOOTBALL_RATE_PER_MINUTE', '60000')
+
+import psycopg2     # noqa: E402
+import sqlalchemy   # noqa: E402
+
+from shared import db as db_utils   # noqa: E402
+from benchmarks import synthetic, fake_api  # noqa: E402
+
+# every stage of the pipeline against a synthetic dataset (benchmarks/synthetic.py) served by a local fake
+# API-Football, a local Postgres and Transfermarkt pages rendered from the same dataset. Stages run one after the
+# other, each in a forked process: wall time, cpu time and peak memory include its pool workers.
+# One json line per scale and stage is appended to --output, to be compared across versions.
+
+STAGES = ('collect_data', 'fix_transfers', 'parse_transfermarkt', 'find_ids', 'apply_formula',
+          'generate_relationships')
+RESULT_FILE = '.stage_result.json'
+VALUES_FILE = 'values.json'
+
+
+def ensure_database():
+    db_name = os.environ['DB_NAME']
+    con = psycopg2.connect(db_utils.get_db_url().rsplit('/', 1)[0] + '/postgres')
+    try:
+        # CREATE DATABASE cannot run in a transaction
+        con.autocommit = True
+        cursor = con.cursor()
+        cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', (db_name,))
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE {db_name}')
+    finally:
+        con.close()
+
+
+def reset_database():
+    from db_interactor import model as m
+    m.metadata_obj.drop_all(m.engine)
+    m.engine.dispose()
+
+
+def _count(table: str) -> int:
+    from db_interactor import model as m
+    with m.engine.connect() as conn:
+        return conn.execute(sqlalchemy.text(f'SELECT count(*) FROM {table}')).scalar()
+
+
+def stage_collect_data(dataset: synthetic.Dataset, workdir: Path) -> t.Dict:
+    from data_generator import collect_data
+    collect_data.main()
+    return {'items': _count('militancy'), 'players': _count('player'), 'team_militancies': _count('teammilitancy')}
+
+
+def stage_fix_transfers(dataset: synthetic.Dataset, workdir: Path) -> t.Dict:
+    from data_generator import data_fixers
+    data_fixers.fix_transfers()
+    return {'items': len(dataset.transfers)}
+
+
+def stage_parse_transfermarkt(dataset: synthetic.Dataset, workdir: Path) -> t.Dict:
+    from api_client import transfermarkt_scraper
+    folders = dataset.write_transfermarkt_fixtures(Path(workdir, 'transfermarkt_fixtures'))
+    rows = 0
+    for kind, extract in (('teams', transfermarkt_scraper._extract_teams),
+                          ('players', transfermarkt_scraper._extract_players)):
+        pages = sorted(folders[kind].glob('page-*.html'))
+        writer = transfermarkt_scraper.RunWriter(kind, len(pages), folder=Path(workdir, 'transfermarkt_results'))
+        for page, path in enumerate(pages, 1):
+            page_rows = extract(path.read_text(encoding='utf-8'))
+            writer.add_page(page, page_rows)
+            rows += len(page_rows)
+        writer.close()
+    return {'items': rows}
+
+
+def stage_find_ids(dataset: synthetic.Dataset, workdir: Path) -> t.Dict:
+    from api_client import transfermarkt_scraper
+    from data_generator import entity_values_maker
+    results = Path(workdir, 'transfermarkt_results')
+    runs = [next(results.glob('teams_*')), next(results.glob('players_*'))]
+    # the rows are streamed into find_ids, as entity_values_maker.main does
+    teams_res, players_res = entity_values_maker.find_ids(*(transfermarkt_scraper.iter_results(run) for run in runs))
+    leagues, team_values, player_values = entity_values_maker.sort_data(teams_res, players_res)
+    with open(Path(workdir, VALUES_FILE), 'w') as f:
+        json.dump({'leagues': sorted(leagues), 'teams': team_values, 'players': player_values}, f)
+    items = sum(json.loads(Path(run, transfermarkt_scraper.MANIFEST).read_text())['rows'] for run in runs)
+    return {'items': items, 'resolved': len(teams_res) + len(players_res)}
+
+
+def stage_apply_formula(dataset: synthetic.Dataset, workdir: Path) -> t.Dict:
+    from data_generator import entity_values_maker
+    with open(Path(workdir, VALUES_FILE), 'r') as f:
+        values = json.load(f)
+    entity_values_maker.apply_formula(set(values['leagues']), {int(k): v for k, v in values['teams'].items()},
+                                      {int(k): v for k, v in values['players'].items()})
+    return {'items': _count('player')}
+
+
+def stage_generate_relationships(dataset: synthetic.Dataset, workdir: Path) -> t.Dict:
+    from data_generator import neo4j_interactor
+    root = Path(workdir, 'csv_files')
+    neo4j_interactor.generate_relationships(csv_files_root=root)
+    relationships = 0
+    for path in root.glob('played-with-part*.csv'):
+        with open(path, 'rb') as f:
+            relationships += sum(1 for _ in f)
+    return {'items': relationships}
+
+
+def run_stage(func: t.Callable[[synthetic.Dataset, Path], t.Dict], dataset: synthetic.Dataset, workdir: Path
+              ) -> t.Dict:
+    # os.wait4 gives the cpu time and the peak rss of the stage process and of the pool workers it waited for
+    result_path = Path(workdir, RESULT_FILE)
+    result_path.unlink(missing_ok=True)
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            from db_interactor import model as m
+            m.engine.dispose(close=False)
+            result_path.write_text(json.dumps(func(dataset, workdir)))
+            code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    _, status, usage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        return {'status': 'failed', 'wall_s': round(wall, 3)}
+    result = json.loads(result_path.read_text())
+    rss_unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {
+        'status': 'ok',
+        'wall_s': round(wall, 3),
+        'cpu_s': round(usage.ru_utime + usage.ru_stime, 3),
+        'max_rss_mb': round(usage.ru_maxrss / rss_unit, 1),
+        'items_per_s': round(result['items'] / wall, 1) if wall else None,
+        **result,
+    }
+
+
+def git_version() -> t.Optional[str]:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales: t.Sequence[float], seed: int, latency: float, workdir: Path, output: Path):
+    ensure_database()
+    version = git_version()
+    stage_funcs = {stage: globals()[f'stage_{stage}'] for stage in STAGES}
+    cwd = Path.cwd()
+    for scale in scales:
+        start = time.perf_counter()
+        dataset = synthetic.generate(scale, seed)
+        print(f'scale {scale}: {dataset.counts()} generated in {time.perf_counter() - start:.1f}s')
+        scale_dir = Path(workdir, f'scale_{scale}')
+        scale_dir.mkdir(parents=True, exist_ok=True)
+        reset_database()
+
+        server = fake_api.FakeAPIFootball(dataset, latency).start()
+        os.environ['API_FOOTBALL_URL'] = server.url
+        # api and scraper caches, not found files and csv files all land in the scale folder
+        os.chdir(scale_dir)
+        try:
+            for stage, func in stage_funcs.items():
+                requests_before = sum(server.requests.values())
+                result = run_stage(func, dataset, scale_dir)
+                record = {'version': version, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                          'scale': scale, 'stage': stage, **dataset.counts(), **result,
+                          'api_requests': sum(server.requests.values()) - requests_before}
+                print(f'{stage:<24} {result["status"]:<7} {result["wall_s"]:>9.2f}s '
+                      f'{result.get("cpu_s", 0):>9.2f}s cpu {result.get("max_rss_mb", 0):>8.1f}MB '
+                      f'{result.get("items_per_s") or 0:>12.1f} items/s')
+                with open(output, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                if result['status'] != 'ok':
+                    print(f'{stage} failed, skipping the rest of scale {scale}')
+                    break
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Time every pipeline stage on synthetic data at several scales')
+    arg_parser.add_argument('--scales', type=float, nargs='+', default=[1, 10, 100])
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--latency', type=float, default=0., help='seconds added to every fake API response')
+    arg_parser.add_argument('--workdir', type=Path, default=None, help='kept when given, a temporary folder otherwise')
+    arg_parser.add_argument('--output', type=Path, default=Path('bench_pipeline_results.jsonl'))
+    args = arg_parser.parse_args()
+
+    output_path = args.output.absolute()
+    if args.workdir:
+        run(args.scales, args.seed, args.latency, args.workdir.absolute(), output_path)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(args.scales, args.seed, args.latency, Path(tmp), output_path)
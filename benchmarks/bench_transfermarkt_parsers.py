@@ -0,0 +1,116 @@
+import gzip
+import html
+import json
+import time
+import random
+import argparse
+import functools
+import statistics
+import typing as t
+from pathlib import Path
+
+from api_client import html_parsers, transfermarkt_scraper
+
+# pages of the most valuable players and clubs lists, in the markup of transfermarkt.co.uk, with the rows every
+# parser backend has to extract from them (expected.json). Synthetic pages reuse their markup and surroundings
+FIXTURES = Path(Path(__file__).parent, 'fixtures', 'transfermarkt')
+EXPECTED = 'expected.json'
+
+PLAYER_ROW = '''<tr class="{parity}">
+<td class="zentriert">{i}</td><td class=""><table class="inline-table"><tr><td rowspan="2"><img src="data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7" data-src="https://img.a.transfermarkt.technology/portrait/medium/{i}-1684761437.jpg?lm=1" title="{name}" alt="{name}" class="bilderrahmen-fixed lazy lazy" /></td><td class="hauptlink"><a title="{name}" href="/player/profil/spieler/{i}">{name}</a></td></tr><tr><td>Centre-Forward</td></tr></table></td><td class="zentriert">{age}</td><td class="zentriert"><img src="https://tmssl.akamaized.net/images/flagge/verysmall/75.png?lm=1520611569" title="Italy" alt="Italy" class="flaggenrahmen" /></td><td class="zentriert"><a title="{team}" href="/team/startseite/verein/{team_id}"><img src="https://tmssl.akamaized.net/images/wappen/verysmall/{team_id}.png?lm=1656580823" title="{team}" alt="{team}" class="" /></a></td><td class="rechts hauptlink"><a href="/player/marktwertverlauf/spieler/{i}">&euro;{value:.2f}m</a> </td></tr>'''
+TEAM_ROW = '''<tr class="{parity}">
+<td class="zentriert">{i}</td><td class="zentriert no-border-rechts"><a title="{team}" href="/team/startseite/verein/{i}"><img src="https://tmssl.akamaized.net/images/wappen/tiny/{i}.png?lm=1656580823" title="{team}" alt="{team}" class="tiny_wappen" /></a></td><td class="hauptlink no-border-links"><a title="{team}" href="/team/startseite/verein/{i}">{team}</a></td><td class="hauptlink"><img src="https://tmssl.akamaized.net/images/flagge/tiny/75.png?lm=1520611569" title="{league}" alt="{league}" class="flaggenrahmen" /> <a title="{league}" href="/league/startseite/wettbewerb/{i}">{league}</a></td><td class="rechts"><b>&euro;{value:.2f}m</b></td></tr>'''
+
+
+def _name(rng: random.Random) -> str:
+    syllables = ['ma', 'ri', 'o', 'lu', 'ca', 'sil', 'va', 'ber', 'to', 'ne', 'ro', 'gio', 'an', 'dre']
+    return ' '.join(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize() for _ in range(2))
+
+
+@functools.lru_cache()
+def page_shell(kind: str) -> t.Tuple[str, str]:
+    # what comes before and after the rows of the results table in the first saved page
+    text = Path(FIXTURES, kind, 'page-00001.html').read_text(encoding='utf-8')
+    head, rest = text.split('<tbody>\n', 1)
+    return head + '<tbody>\n', '\n</tbody>' + rest.split('\n</tbody>', 1)[1]
+
+
+def render_page(kind: str, rows: t.Sequence[t.Dict]) -> str:
+    # rows: name, age, team, team_id, value for players; team, league, value for teams
+    template = PLAYER_ROW if kind == 'players' else TEAM_ROW
+    defaults = {'name': '', 'age': 0, 'team': '', 'team_id': 0, 'league': ''}
+    head, tail = page_shell(kind)
+    return head + '\n'.join(
+        template.format(**{**defaults, **{k: html.escape(v, quote=True) if isinstance(v, str) else v
+                                          for k, v in row.items()},
+                           'parity': 'odd' if i % 2 else 'even', 'i': i})
+        for i, row in enumerate(rows, 1)) + tail
+
+
+def make_page(kind: str, rows: int = 25, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    return render_page(kind, [{'name': _name(rng), 'age': rng.randint(17, 38), 'team': f'{_name(rng)} FC',
+                               'team_id': rng.randint(1, 5000), 'league': f'{_name(rng)} League',
+                               'value': rng.uniform(1, 200)} for _ in range(rows)])
+
+
+def load_fixtures(folder: Path) -> t.List[str]:
+    pages = []
+    for path in sorted(Path(folder).iterdir()):
+        if path.suffix == '.gz':
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                pages.append(f.read())
+        elif path.suffix == '.html':
+            pages.append(path.read_text(encoding='utf-8'))
+    return pages
+
+
+def expected_rows(kind: str) -> t.List[t.List[t.Dict]]:
+    # the rows of every saved page of kind, in the order of load_fixtures
+    with open(Path(FIXTURES, EXPECTED), 'r', encoding='utf-8') as f:
+        expected = json.load(f)
+    return [rows for name, rows in sorted(expected.items()) if name.startswith(f'{kind}/')]
+
+
+def measure(extract: t.Callable, parser: html_parsers.HTMLParser, pages: t.List[str], repeat: int) -> t.Dict:
+    timings = []
+    rows = 0
+    for _ in range(repeat):
+        for page in pages:
+            start = time.perf_counter()
+            rows += len(extract(page, parser))
+            timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'pages': len(timings),
+        'rows_per_page': round(rows / len(timings), 1),
+        'mean_ms': round(statistics.mean(timings), 3),
+        'p95_ms': round(sorted(timings)[int(len(timings) * .95) - 1], 3),
+    }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Parse time per Transfermarkt page for every installed backend')
+    arg_parser.add_argument('--kind', choices=('players', 'teams'), default='players')
+    arg_parser.add_argument('--fixtures', type=Path, default=None,
+                            help='folder of saved pages (.html or the .html.gz files of the page cache), '
+                                 'benchmarks/fixtures/transfermarkt/<kind> by default')
+    arg_parser.add_argument('--synthetic', action='store_true', help='generated pages instead of saved ones')
+    arg_parser.add_argument('--pages', type=int, default=20)
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    if args.synthetic:
+        fixtures = [make_page(args.kind, seed=i) for i in range(args.pages)]
+    else:
+        fixtures = load_fixtures(args.fixtures or Path(FIXTURES, args.kind))
+    # the rows of the committed pages are known, other pages are compared across backends
+    reference = expected_rows(args.kind) if not args.synthetic and not args.fixtures else None
+    extractor = transfermarkt_scraper._extract_players if args.kind == 'players' else \
+        transfermarkt_scraper._extract_teams
+    for backend in html_parsers.available_backends():
+        backend_parser = html_parsers.get_parser(backend)
+        extracted = [extractor(page, backend_parser) for page in fixtures]
+        same = reference is None or extracted == reference
+        reference = reference or extracted
+        print(backend, measure(extractor, backend_parser, fixtures, args.repeat),
+              'same rows' if same else 'DIFFERENT ROWS')
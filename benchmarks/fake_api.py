@@ -0,0 +1,107 @@
+import json
+import math
+import time
+import argparse
+import threading
+import collections
+import typing as t
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks import synthetic
+
+# the leagues, players and transfers endpoints of API-Football over a synthetic dataset, with the paging and the
+# rate limit headers APIFootballClient and FetchEngine read. Clients reach it through API_FOOTBALL_URL.
+
+PAGE_SIZE = 20
+RATE_PER_MINUTE = 60000     # as API_FOOTBALL_RATE_PER_MINUTE in bench_pipeline
+DAILY_QUOTA = 10 ** 7
+
+
+class FakeAPIFootball(ThreadingHTTPServer):
+    def __init__(self, dataset: synthetic.Dataset, latency: float = 0., port: int = 0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.dataset = dataset
+        self.latency = latency
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+        self._quota = DAILY_QUOTA
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}/v3'
+
+    def start(self) -> 'FakeAPIFootball':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def respond(self, endpoint: str, params: t.Dict[str, str]) -> t.Tuple[int, t.Dict]:
+        with self._lock:
+            self.requests[endpoint] += 1
+            self._quota -= 1
+        if endpoint in ('leagues', 'transfers') and 'page' in params:
+            # as the real API does for the endpoints without paging
+            return 200, {'errors': ['page: the Page field does not exist'], 'response': []}
+        if endpoint == 'leagues':
+            if 'team' in params:
+                return 200, _paged(self.dataset.api_team_leagues(int(params['team'])), None)
+            return 200, _paged(self.dataset.api_leagues(), None)
+        if endpoint == 'players' and 'league' in params:
+            return 200, _paged(self.dataset.api_players(int(params['league']), int(params['season'])),
+                               int(params.get('page', 1)))
+        if endpoint == 'transfers':
+            return 200, _paged(self.dataset.api_transfers(int(params['team'])), None)
+        return 404, {'errors': [f'{endpoint} not available'], 'response': []}
+
+    def headers(self) -> t.Dict[str, str]:
+        return {'x-ratelimit-limit': str(RATE_PER_MINUTE), 'x-ratelimit-remaining': str(RATE_PER_MINUTE),
+                'x-ratelimit-requests-limit': str(DAILY_QUOTA), 'x-ratelimit-requests-remaining': str(self._quota)}
+
+
+def _paged(rows: t.List[t.Dict], page: t.Optional[int]) -> t.Dict:
+    # page None: endpoints the real API does not paginate
+    if page is None:
+        return {'errors': [], 'results': len(rows), 'paging': {'current': 1, 'total': 1}, 'response': rows}
+    total = max(1, math.ceil(len(rows) / PAGE_SIZE))
+    rows = rows[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+    return {'errors': [], 'results': len(rows), 'paging': {'current': page, 'total': total}, 'response': rows}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server: FakeAPIFootball
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, body = self.server.respond(url.path.rstrip('/').rsplit('/', 1)[-1], params)
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in self.server.headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Serve a synthetic dataset as API-Football')
+    arg_parser.add_argument('--scale', type=float, default=1)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--latency', type=float, default=0., help='seconds added to every response')
+    args = arg_parser.parse_args()
+
+    server = FakeAPIFootball(synthetic.generate(args.scale, args.seed), args.latency, args.port)
+    print(f'API_FOOTBALL_URL={server.url}', server.dataset.counts())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
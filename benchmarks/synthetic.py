@@ -0,0 +1,182 @@
+import random
+import datetime
+import collections
+import typing as t
+from pathlib import Path
+
+import api_client
+from benchmarks import bench_transfermarkt_parsers
+
+# a deterministic football world: leagues of teams whose players play some seasons and move team mid-season.
+# Scale 1 is 4 leagues of 18 teams of 25 players over the last 3 seasons; everything grows linearly with it.
+# It is served as API-Football responses (benchmarks/fake_api.py) and as Transfermarkt pages.
+
+LEAGUES_PER_SCALE = 4
+TEAMS_PER_LEAGUE = 18
+PLAYERS_PER_TEAM = 25
+SEASONS = 3
+TRANSFER_RATE = .15     # share of players moving team in a season
+TRANSFERMARKT_SHARE = .3    # share of players and teams listed by Transfermarkt
+SYLLABLES = ['ma', 'ri', 'o', 'lu', 'ca', 'sil', 'va', 'ber', 'to', 'ne', 'ro', 'gio', 'an', 'dre', 'ke', 'zu', 'pa',
+             'mi', 'ster', 'fa', 'bo', 'le', 'ti', 'gu', 'sa', 'den', 'ko', 'vic', 'el', 'har']
+COUNTRIES = ['IT', 'ES', 'GB', 'DE', 'FR', 'PT', 'NL', 'BE']
+
+
+class Transfer(t.NamedTuple):
+    player_id: int
+    date: datetime.date
+    team_out: int
+    team_in: int
+
+
+class Dataset:
+    def __init__(self, scale: float = 1, seed: int = 0):
+        self.scale = scale
+        self.years = api_client.YEARS[-SEASONS:]
+        self._rng = random.Random(seed)
+        self._names = set()
+
+        self.leagues: t.Dict[int, t.Tuple[str, str]] = {}       # id: (name, country code)
+        self.teams: t.Dict[int, t.Tuple[str, int]] = {}         # id: (name, league id)
+        self.players: t.Dict[int, t.Tuple[str, str]] = {}       # id: (first name, last name)
+        # (player id, year): [(team id, appearences)], two teams in the season of a transfer
+        self.careers: t.Dict[t.Tuple[int, int], t.List[t.Tuple[int, int]]] = {}
+        self.transfers: t.List[Transfer] = []
+
+        for l_i in range(max(1, round(LEAGUES_PER_SCALE * scale))):
+            l_id = 1000 + l_i
+            self.leagues[l_id] = f'{self._unique_name()} League', COUNTRIES[l_i % len(COUNTRIES)]
+            for _ in range(TEAMS_PER_LEAGUE):
+                self.teams[10000 + len(self.teams)] = f'{self._unique_name()} FC', l_id
+
+        team_ids = list(self.teams)
+        rosters = {}
+        for team_id in team_ids:
+            for _ in range(PLAYERS_PER_TEAM):
+                p_id = 100000 + len(self.players)
+                self.players[p_id] = tuple(self._unique_name().split())
+                rosters[p_id] = team_id
+
+        for year in self.years:
+            for p_id, team_id in rosters.items():
+                appearences = self._rng.randint(0, 38)
+                if self._rng.random() < TRANSFER_RATE:
+                    new_team = self._rng.choice(team_ids)
+                    if new_team != team_id:
+                        date = datetime.date(year + 1, 1, self._rng.randint(2, 28))
+                        self.transfers.append(Transfer(p_id, date, team_id, new_team))
+                        first_half = self._rng.randint(0, appearences)
+                        self.careers[p_id, year] = [(team_id, first_half), (new_team, appearences - first_half)]
+                        rosters[p_id] = new_team
+                        continue
+                self.careers[p_id, year] = [(team_id, appearences)]
+
+        self._league_seasons = collections.defaultdict(list)
+        self._team_leagues = collections.defaultdict(set)
+        for (p_id, year), career in self.careers.items():
+            for league_id in dict.fromkeys(self.teams[team_id][1] for team_id, _ in career):
+                self._league_seasons[league_id, year].append(p_id)
+            for team_id, _ in career:
+                self._team_leagues[team_id].add((self.teams[team_id][1], year))
+        self._team_transfers = collections.defaultdict(list)
+        for transfer in self.transfers:
+            self._team_transfers[transfer.team_out].append(transfer)
+            self._team_transfers[transfer.team_in].append(transfer)
+
+    def _unique_name(self) -> str:
+        while True:
+            name = ' '.join(''.join(self._rng.choice(SYLLABLES) for _ in range(self._rng.randint(2, 3))).capitalize()
+                            for _ in range(2))
+            if name not in self._names:
+                self._names.add(name)
+                return name
+
+    @staticmethod
+    def _season(year: int) -> t.Dict:
+        return {'year': year, 'start': f'{year}-08-01', 'end': f'{year + 1}-05-31', 'current': False}
+
+    def _league(self, l_id: int) -> t.Dict:
+        return {'id': l_id, 'name': self.leagues[l_id][0], 'type': 'League',
+                'logo': f'https://media.example.com/football/leagues/{l_id}.png'}
+
+    def _team(self, team_id: int) -> t.Dict:
+        return {'id': team_id, 'name': self.teams[team_id][0],
+                'logo': f'https://media.example.com/football/teams/{team_id}.png'}
+
+    # API-Football responses, without paging
+
+    def api_leagues(self) -> t.List[t.Dict]:
+        return [{'league': self._league(l_id), 'country': {'name': country, 'code': country},
+                 'seasons': [self._season(year) for year in self.years]}
+                for l_id, (_, country) in self.leagues.items()]
+
+    def api_team_leagues(self, team_id: int) -> t.List[t.Dict]:
+        seasons = collections.defaultdict(list)
+        for l_id, year in sorted(self._team_leagues.get(team_id, ())):
+            seasons[l_id].append(self._season(year))
+        return [{'league': self._league(l_id), 'country': {'name': self.leagues[l_id][1]}, 'seasons': s}
+                for l_id, s in seasons.items()]
+
+    def api_players(self, league_id: int, year: int) -> t.List[t.Dict]:
+        ret = []
+        for p_id in self._league_seasons.get((league_id, year), ()):
+            first_name, last_name = self.players[p_id]
+            ret.append({
+                'player': {'id': p_id, 'name': f'{first_name[0]}. {last_name}', 'firstname': first_name,
+                           'lastname': last_name, 'photo': f'https://media.example.com/football/players/{p_id}.png'},
+                'statistics': [{'team': self._team(team_id), 'league': {'id': self.teams[team_id][1], 'season': year},
+                                'games': {'appearences': appearences}}
+                               for team_id, appearences in self.careers[p_id, year]],
+            })
+        return ret
+
+    def api_transfers(self, team_id: int) -> t.List[t.Dict]:
+        by_player = collections.defaultdict(list)
+        for transfer in self._team_transfers.get(team_id, ()):
+            by_player[transfer.player_id].append(transfer)
+        return [{'player': {'id': p_id, 'name': ' '.join(self.players[p_id])},
+                 'transfers': [{'date': tr.date.isoformat(), 'type': 'N/A',
+                                'teams': {'in': self._team(tr.team_in), 'out': self._team(tr.team_out)}}
+                               for tr in transfers]}
+                for p_id, transfers in by_player.items()]
+
+    # Transfermarkt rows, most valuable first as on the site
+
+    def transfermarkt_teams(self) -> t.List[t.Dict]:
+        rng = random.Random(len(self.teams))
+        team_ids = rng.sample(list(self.teams), max(1, int(len(self.teams) * TRANSFERMARKT_SHARE)))
+        rows = [{'team': self.teams[team_id][0], 'league': self.leagues[self.teams[team_id][1]][0],
+                 'value': rng.uniform(5, 900)} for team_id in team_ids]
+        return sorted(rows, key=lambda r: -r['value'])
+
+    def transfermarkt_players(self) -> t.List[t.Dict]:
+        rng = random.Random(len(self.players))
+        last_year = self.years[-1]
+        player_ids = rng.sample(list(self.players), max(1, int(len(self.players) * TRANSFERMARKT_SHARE)))
+        rows = []
+        for p_id in player_ids:
+            team_id = self.careers[p_id, last_year][-1][0]
+            rows.append({'name': ' '.join(self.players[p_id]), 'age': rng.randint(17, 38),
+                         'team': self.teams[team_id][0], 'team_id': team_id, 'value': rng.uniform(1, 180)})
+        return sorted(rows, key=lambda r: -r['value'])
+
+    def write_transfermarkt_fixtures(self, folder: Path, rows_per_page: int = 25) -> t.Dict[str, Path]:
+        # the pages as the scraper downloads them, one folder per kind: the rows of the dataset in the markup of the
+        # saved pages of benchmarks/fixtures
+        folders = {}
+        for kind, rows in (('teams', self.transfermarkt_teams()), ('players', self.transfermarkt_players())):
+            folders[kind] = Path(folder, kind)
+            folders[kind].mkdir(parents=True, exist_ok=True)
+            for page, start in enumerate(range(0, len(rows), rows_per_page), 1):
+                html = bench_transfermarkt_parsers.render_page(kind, rows[start:start + rows_per_page])
+                Path(folders[kind], f'page-{page:05d}.html').write_text(html, encoding='utf-8')
+        return folders
+
+    def counts(self) -> t.Dict[str, int]:
+        return {'leagues': len(self.leagues), 'teams': len(self.teams), 'players': len(self.players),
+                'militancies': sum(len(career) for career in self.careers.values()),
+                'transfers': len(self.transfers)}
+
+
+def generate(scale: float = 1, seed: int = 0) -> Dataset:
+    return Dataset(scale, seed)
@@ -1,66 +1,51 @@
 import typing as t
-from multiprocessing import Pool
 
 from unidecode import unidecode
-from sqlalchemy.dialects.postgresql import insert
 
 import logger
 import api_client
-from api_client import api_football_client
-from data_generator import utils
+from logger import metrics
+from api_client import api_football_client, fetch_engine
+from data_generator import utils, executor
 import db_interactor
-from db_interactor import model as m
+from db_interactor import bulk, checkpoints, model as m
 
 
 LOGGER = logger.get_logger('data_generator')
-
-
-def initializer():
-    m.engine.dispose(close=False)
-
-
-def get_insert_do_nothing_stmt(table, values, no_constraint=False):
-    index_elements = None if no_constraint else ['id']
-    insert_stmt = insert(table).values(**values)
-    do_nothing_stmt = insert_stmt.on_conflict_do_nothing(
-        index_elements=index_elements
-    )
-    return do_nothing_stmt
+LEAGUE_SEASONS_STAGE = 'collect_data.league_seasons'
+TEAM_MILITANCIES_STAGE = 'collect_data.team_militancies'
 
 
 def store_leagues(leagues: t.List[t.Dict]) -> t.List[t.Dict]:
     ret = []
-    with m.engine.connect() as conn:
-        for l in leagues:
-            seasons = []
-            for s in l.get('seasons') or []:
-                year = s.get('year')
-                if year not in api_client.YEARS:
-                    continue
-                start_date = utils.convert_to_date(s.get('start'))
-                end_date = utils.convert_to_date(s.get('end'))
-                s_values = {'league_id': l['league']['id'], 'year': s.get('year'), 'start_date': start_date,
-                            'end_date': end_date}
-                if not all(s_values.values()):
-                    seasons = []
-                    break
-                seasons.append(s_values)
-            if not seasons:
+    leagues_values = []
+    seasons_values = []
+    for l in leagues:
+        seasons = []
+        for s in l.get('seasons') or []:
+            year = s.get('year')
+            if year not in api_client.YEARS:
                 continue
+            start_date = utils.convert_to_date(s.get('start'))
+            end_date = utils.convert_to_date(s.get('end'))
+            s_values = {'league_id': l['league']['id'], 'year': s.get('year'), 'start_date': start_date,
+                        'end_date': end_date}
+            if not all(s_values.values()):
+                seasons = []
+                break
+            seasons.append(s_values)
+        if not seasons:
+            continue
 
-            fixed_name = unidecode(l['league']['name'] or '')
-            values = {'id': l['league']['id'], 'img_url': l['league']['logo'], 'display_name': fixed_name,
-                      'country_code': l['country']['code']}
-            do_nothing_stmt = get_insert_do_nothing_stmt(m.League, values)
-            conn.execute(do_nothing_stmt)
-
-            for s_values in seasons:
-                s_do_nothing_stmt = get_insert_do_nothing_stmt(m.LeagueSeasons, s_values, no_constraint=True)
-                conn.execute(s_do_nothing_stmt)
+        fixed_name = unidecode(l['league']['name'] or '')
+        leagues_values.append({'id': l['league']['id'], 'img_url': l['league']['logo'], 'display_name': fixed_name,
+                               'country_code': l['country']['code']})
+        seasons_values.extend(seasons)
 
-            ret.append({'id': l['league']['id'], 'seasons': seasons})
+        ret.append({'id': l['league']['id'], 'seasons': seasons})
 
-        conn.commit()
+    bulk.copy_merge(m.League, leagues_values, update_columns=('display_name', 'img_url', 'country_code'))
+    bulk.copy_merge(m.LeagueSeasons, seasons_values, update_columns=('start_date', 'end_date'))
 
     return ret
 
@@ -69,8 +54,9 @@ def process_players_batch(players_batch: t.List[t.Dict], season: t.Dict):
     teams = []
     players = []
     militancies = []
+    team_militancies = []
     if not players_batch:
-        return teams, players, militancies
+        return teams, players, militancies, team_militancies
 
     for p in players_batch:
         if not p.get('player', {}).get('id') or not p.get('statistics'):
@@ -95,51 +81,75 @@ def process_players_batch(players_batch: t.List[t.Dict], season: t.Dict):
                                 'end_date': season['end_date'], 'appearences': s['games']['appearences'] or 0}
             militancies.append(militancy_values)
 
+            # a team with players in this league season played the league that season
+            if (s.get('league') or {}).get('id') == season['league_id']:
+                team_militancies.append({'team_id': team_values['id'], 'league_id': season['league_id'],
+                                         'year': season['year']})
+
     teams = list({team['id']: team for team in teams}.values())
     militancies = list({(mi['player_id'], mi['team_id'], mi['year']): mi for mi in militancies}.values())
+    team_militancies = list({tuple(tm.values()): tm for tm in team_militancies}.values())
 
-    return teams, players, militancies
+    return teams, players, militancies, team_militancies
 
 
-def process_league_year_players(*args):
-    l_id, season = args[0]
+@metrics.collected
+def process_league_year_players(league_season):
+    l_id, season = league_season
     client = api_football_client.APIFootballClient()
     players = client.get_league_players(l_id, season['year'])
-    teams, players, militancies = process_players_batch(players, season)
-    return teams, players, militancies
+    if players is None:
+        return (l_id, season['year']), None
+    return (l_id, season['year']), process_players_batch(players, season)
 
 
 def process_teams(teams):
+    if not teams:
+        return
     teams = {team['id']: team for team in teams}
     LOGGER.info(f'TEAMS - storing {len(teams)} teams')
-    with db_interactor.get_session() as session:
-        teams_objs = [m.Team(**team) for team in teams.values()]
-        session.bulk_save_objects(teams_objs)
-        session.commit()
+    bulk.copy_merge(m.Team, teams.values(), columns=('id', 'name', 'img_url'), update_columns=('name', 'img_url'))
 
 
 def process_players(players):
+    if not players:
+        return
     players = {player['id']: player for player in players}
     LOGGER.info(f'PLAYERS - storing {len(players)} players')
-    with db_interactor.get_session() as session:
-        players_objs = [m.Player(**player) for player in players.values()]
-        session.bulk_save_objects(players_objs)
-        session.commit()
+    # value is only set on insert, it belongs to entity_values_maker afterwards
+    bulk.copy_merge(m.Player, ({**player, 'value': 0} for player in players.values()),
+                    columns=('id', 'name', 'surname', 'img_url', 'value'),
+                    update_columns=('name', 'surname', 'img_url'))
 
 
 def process_militancies(militancies):
+    if not militancies:
+        return
     militancies = {(mi['player_id'], mi['team_id'], mi['year']): mi for mi in militancies}
     LOGGER.info(f'MILITANCIES - storing {len(militancies)} militancies')
-    with db_interactor.get_session() as session:
-        m_objs = [m.Militancy(**m_obj) for m_obj in militancies.values()]
-        session.bulk_save_objects(m_objs)
-        session.commit()
+    # start_date and end_date are left alone on conflict, data_fixers.fix_transfers refines them
+    bulk.copy_merge(m.Militancy, militancies.values(),
+                    columns=('player_id', 'team_id', 'year', 'start_date', 'end_date', 'appearences'),
+                    update_columns=('appearences',))
 
 
+def process_team_militancies(team_militancies):
+    if not team_militancies:
+        return
+    LOGGER.info(f'TEAM MILITANCIES - storing {len(team_militancies)} team militancies')
+    bulk.copy_merge(m.TeamMilitancy, team_militancies, columns=('team_id', 'league_id', 'year'))
+
+
+@metrics.collected
 def store_team_militancy(t_id):
-    t_id = t_id[0]
     client = api_football_client.APIFootballClient(requests_block=1)
     leagues = client.get_team_leagues(t_id)
+    if leagues is None:
+        return None
+    return team_militancies_from_leagues(t_id, leagues)
+
+
+def team_militancies_from_leagues(t_id: int, leagues: t.Optional[t.List[t.Dict]]) -> t.List[t.Dict]:
     if leagues:
         leagues = [r for r in leagues if r.get('league', {}).get('type') == 'League']
     else:
@@ -158,49 +168,124 @@ def store_team_militancy(t_id):
     return ret
 
 
-def store_team_militancies():
-    with db_interactor.get_session() as session:
-        team_ids = {r[0] for r in session.query(m.Team.id).all()}
-        league_ids = {r[0] for r in session.query(m.League.id).all()}
-
-    args = [(r,) for r in team_ids]
-    LOGGER.info(f'LEAGUES - Processing ({len(args)}) team militancies')
+def fetch_team_leagues(team_ids: t.List[int], use_fetch_engine=True) -> t.Iterator[t.Tuple[int, t.Optional[t.List]]]:
+    # (team id, team militancies), None when the API limit or a failed request stopped the team from being fetched
+    if use_fetch_engine:
+        engine = fetch_engine.FetchEngine()
+        fetched = set()
+        try:
+            # the leagues endpoint has no paging: plain requests, still on the engine's workers and rate limiter
+            for t_id, leagues in engine.iter_unpaginated((t_id, 'leagues', {'team': t_id}) for t_id in team_ids):
+                fetched.add(t_id)
+                yield t_id, None if leagues is None else team_militancies_from_leagues(t_id, leagues)
+        except api_client.APILimitReached as e:
+            LOGGER.warning(f'{len(team_ids) - len(fetched)} team militancies not fetched: {e}')
+        for t_id in team_ids:
+            if t_id not in fetched:
+                yield t_id, None
+    else:
+        pool = executor.Executor('team_militancies', executor.THREAD)
+        yield from zip(team_ids, pool.map_until_limit(store_team_militancy, team_ids))
 
-    with Pool(14, initializer=initializer) as p:
-        data = p.map(store_team_militancy, args)
 
-    team_militancies = list({tuple(tm_obj.values()): m.TeamMilitancy(**tm_obj) for d in data for tm_obj in d
-                             if tm_obj['league_id'] in league_ids and tm_obj['team_id'] in team_ids}.values())
+def store_team_militancies(resume=False, use_fetch_engine=True):
+    # team militancies are inferred from the league seasons while they are collected (store_batches); only teams
+    # left without any are asked to the API, one call each
     with db_interactor.get_session() as session:
-        session.bulk_save_objects(team_militancies)
-        session.commit()
-
-
-def main():
+        team_ids = {r[0] for r in session.query(m.Team.id).all()}
+        league_ids = {r[0] for r in session.query(m.League.id).all()}
+        inferred = {r[0] for r in session.query(m.TeamMilitancy.team_id).distinct()}
+
+    done = checkpoints.completed_units(TEAM_MILITANCIES_STAGE) if resume else set()
+    missing = sorted(r for r in team_ids if r not in inferred and str(r) not in done)
+    LOGGER.info(f'TEAM MILITANCIES - {len(inferred & team_ids)} of {len(team_ids)} teams inferred from the league '
+                f'seasons, {len(missing)} need the per-team API ({len(team_ids - inferred) - len(missing)} '
+                f'already done)')
+
+    data = list(fetch_team_leagues(missing, use_fetch_engine=use_fetch_engine))
+    team_militancies = {tuple(tm_obj.values()): tm_obj for _, d in data if d for tm_obj in d
+                        if tm_obj['league_id'] in league_ids and tm_obj['team_id'] in team_ids}
+    process_team_militancies(list(team_militancies.values()))
+    checkpoints.mark_done(TEAM_MILITANCIES_STAGE, [t_id for t_id, d in data if d is not None])
+
+    not_fetched = sum(1 for _, d in data if d is None)
+    LOGGER.info(f'TEAM MILITANCIES - per-team API fallback: {len(data) - not_fetched} teams fetched, '
+                f'{len(team_militancies)} team militancies found')
+    if not_fetched:
+        raise api_client.APILimitReached(f'{not_fetched} team militancies left for the next run')
+
+
+def iter_league_year_batches(args: t.List[t.Tuple[int, t.Dict]], use_fetch_engine=True
+                             ) -> t.Iterator[t.Tuple[t.Tuple[int, int], t.Tuple[t.List, t.List, t.List, t.List]]]:
+    # batches are yielded as soon as a league season is complete, fetching goes on while they are stored; a league
+    # season with a failed page comes with a None batch
+    if use_fetch_engine:
+        LOGGER.info(f'LEAGUES - Fetching ({len(args)}) league seasons')
+        # every league/season/page request goes through one shared rate limiter
+        engine = fetch_engine.FetchEngine()
+        for (l_id, season), players in engine.iter_league_players(args):
+            yield (l_id, season['year']), None if players is None else process_players_batch(players, season)
+    else:
+        pool = executor.Executor('league_seasons', executor.THREAD)
+        for _, batch in pool.imap(process_league_year_players, args):
+            yield batch
+
+
+def store_batches(batches: t.Iterable[t.Tuple[t.Tuple[int, int], t.Optional[t.Tuple[t.List, t.List, t.List, t.List]]]]
+                  ) -> t.Dict[str, int]:
+    # only the keys already stored are kept in memory; every batch is committed on its own and only complete league
+    # seasons are checkpointed
+    seen_teams = set()
+    seen_players = set()
+    seen_militancies = set()
+    batches_n = 0
+    incomplete = 0
+    for (l_id, year), batch in batches:
+        if batch is None:
+            LOGGER.warning(f'LEAGUES - league {l_id} season {year} incomplete, left for the next run')
+            incomplete += 1
+            continue
+        teams, players, militancies, team_militancies = batch
+        teams = [team for team in teams if team['id'] not in seen_teams]
+        players = [p for p in players if p['id'] not in seen_players]
+        militancies = [mi for mi in militancies
+                       if (mi['player_id'], mi['team_id'], mi['year']) not in seen_militancies]
+
+        process_teams(teams)
+        process_players(players)
+        process_militancies(militancies)
+        # every league season is a batch of its own, its team militancies cannot have been stored before
+        process_team_militancies(team_militancies)
+
+        seen_teams.update(team['id'] for team in teams)
+        seen_players.update(p['id'] for p in players)
+        seen_militancies.update((mi['player_id'], mi['team_id'], mi['year']) for mi in militancies)
+        checkpoints.mark_done(LEAGUE_SEASONS_STAGE, [f'{l_id}:{year}'])
+        batches_n += 1
+        LOGGER.info(f'BATCH {batches_n} stored ({len(seen_teams)} teams, {len(seen_players)} players, '
+                    f'{len(seen_militancies)} militancies so far)')
+
+    return {'batches': batches_n, 'teams': len(seen_teams), 'players': len(seen_players),
+            'militancies': len(seen_militancies), 'incomplete': incomplete}
+
+
+def main(use_fetch_engine=True, resume=False):
     db_interactor.init_db()
     client = api_football_client.APIFootballClient(requests_block=5)
     all_leagues = client.get_leagues()
     all_leagues = store_leagues(all_leagues)
 
-    args = [(league['id'], s) for league in all_leagues for s in league['seasons']]
-    LOGGER.info(f'LEAGUES - Starting multiprocessing ({len(args)}) processes')
-    with Pool(14, initializer=initializer) as p:
-        data = p.map(process_league_year_players, args)
-
-    teams = [team for d in data for team in d[0]]
-    players = [p for d in data for p in d[1]]
-    militancies = [mi for d in data for mi in d[2]]
-    del data
-
-    LOGGER.info('Storing teams')
-    process_teams(teams)
-    LOGGER.info('Storing team militancies')
-    LOGGER.info('Storing players')
-    process_players(players)
-    LOGGER.info('Storing militancies')
-    process_militancies(militancies)
-
-    store_team_militancies()
+    done = checkpoints.completed_units(LEAGUE_SEASONS_STAGE) if resume else set()
+    args = [(league['id'], s) for league in all_leagues for s in league['seasons']
+            if f'{league["id"]}:{s["year"]}' not in done]
+    if done:
+        LOGGER.info(f'LEAGUES - {len(done)} league seasons already collected')
+    stored = store_batches(iter_league_year_batches(args, use_fetch_engine=use_fetch_engine))
+    LOGGER.info(f'Stored {stored}')
+
+    store_team_militancies(resume=resume, use_fetch_engine=use_fetch_engine)
+    if stored['incomplete']:
+        raise api_client.IncompleteFetch(f'{stored["incomplete"]} league seasons incomplete, left for the next run')
 
 
 if __name__ == '__main__':
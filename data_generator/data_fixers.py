@@ -1,57 +1,26 @@
-import time
-import requests
+import bisect
+import datetime
+import collections
 import typing as t
 import sqlalchemy
 from sqlalchemy.orm import Session
 import traceback
-from multiprocessing import Pool
 
 import logger
+import api_client
+from logger import metrics
 from api_client import api_football_client
-from data_generator import utils
+from data_generator import utils, image_fetcher, executor
 import db_interactor
-from db_interactor import model as m
+from db_interactor import bulk, checkpoints, model as m
 
 
 LOGGER = logger.get_logger('data_generator')
+TRANSFERS_STAGE = 'data_fixers.transfers'
 
 
-def initializer():
-    m.engine.dispose(close=False)
-
-
-def download_img(*args):
-    kind, obj_id = args[0]
-    if kind == 'league':
-        table = m.League
-    elif kind == 'team':
-        table = m.Team
-    else:
-        table = m.Player
-
-    with db_interactor.get_session() as session:
-        entity = session.query(table).get(obj_id)
-        img_url = entity.img_url
-        r = requests.get(img_url)
-        if r.status_code != 200:
-            LOGGER.warning(f'Skipping {kind} {obj_id}: {r.status_code} - {r.text}')
-        entity.img = r.content
-
-        session.add(entity)
-        session.commit()
-
-
-def download_images():
-    args = []
-    with db_interactor.get_session() as session:
-        for kind, table in zip(('league', 'team', 'player'), (m.League, m.Team, m.Player)):
-            args.extend([(kind, r[0]) for r in session.query(table.id).filter(
-                table.img == sqlalchemy.null(), table.img_url != sqlalchemy.null()).all()]
-                        )
-
-    LOGGER.info(f'Processing {len(args)} entities')
-    with Pool(14, initializer=initializer) as p:
-        p.map(download_img, args)
+def download_images(storage='table', refresh=False):
+    image_fetcher.fetch_images(storage=storage, refresh=refresh)
 
 
 def get_all_teams(session: Session):
@@ -92,7 +61,7 @@ def fix_player_transfer(player_transfer: t.Dict, session: sqlalchemy.orm.Session
     for transfer in player_transfer['transfers']:
         transfer_date = utils.convert_to_date(transfer['date'])
         if not transfer_date:
-            LOGGER.info(f'Skipping transfer, player_id: {player_id} (Reason: date={transfer["date"]})')
+            LOGGER.debug('Skipping transfer, player_id: %s (Reason: date=%s)', player_id, transfer['date'])
             continue
 
         for team, is_out in zip((transfer['teams']['out'], transfer['teams']['in']), (True, False)):
@@ -107,8 +76,8 @@ def fix_player_transfer(player_transfer: t.Dict, session: sqlalchemy.orm.Session
                               if pm.team_id == team['id'] and pm.start_date < transfer_date < pm.end_date]
 
             if not this_militancy:
-                LOGGER.info(
-                    f'Skipping transfer, player_id: {player_id}, team_id: {team["id"]} (Reason: militancy not found)')
+                LOGGER.debug('Skipping transfer, player_id: %s, team_id: %s (Reason: militancy not found)',
+                             player_id, team['id'])
                 continue
 
             if is_out:
@@ -118,39 +87,155 @@ def fix_player_transfer(player_transfer: t.Dict, session: sqlalchemy.orm.Session
             session.add(this_militancy[0])
 
 
+class TransfersIndex:
+    # everything fix_player_transfer/create_militancy_if_possible query row by row, loaded once and indexed
+    MILITANCY_COLUMNS = ('player_id', 'team_id', 'year', 'start_date', 'end_date', 'appearences')
+
+    def __init__(self, session: Session):
+        self.militancies: t.Dict[int, t.List[t.Dict]] = collections.defaultdict(list)
+        for row in session.query(*[getattr(m.Militancy, c) for c in self.MILITANCY_COLUMNS]).yield_per(100000):
+            self.militancies[row[0]].append(dict(zip(self.MILITANCY_COLUMNS, row)))
+        self.player_ids = {row[0] for row in session.query(m.Player.id)}
+
+        self.team_leagues: t.Dict[int, t.Set[int]] = collections.defaultdict(set)
+        for team_id, league_id in session.query(m.TeamMilitancy.team_id, m.TeamMilitancy.league_id):
+            self.team_leagues[team_id].add(league_id)
+
+        self.league_seasons: t.Dict[int, t.List[t.Tuple]] = collections.defaultdict(list)
+        for league_id, year, start_date, end_date in session.query(
+                m.LeagueSeasons.league_id, m.LeagueSeasons.year, m.LeagueSeasons.start_date,
+                m.LeagueSeasons.end_date):
+            self.league_seasons[league_id].append((end_date, start_date, year))
+
+        self._team_seasons: t.Dict[int, t.Tuple[t.List, t.List]] = {}
+        self.changed: t.Dict[t.Tuple[int, int, int], t.Dict] = {}
+
+    def team_seasons(self, team_id: int) -> t.Tuple[t.List[t.Tuple], t.List[datetime.date]]:
+        # seasons of all the team's leagues sorted by end date, plus the end dates alone for bisect
+        if team_id not in self._team_seasons:
+            seasons = sorted({s for l_id in self.team_leagues[team_id] for s in self.league_seasons[l_id]
+                              if s[0] and s[1]})
+            self._team_seasons[team_id] = seasons, [s[0] for s in seasons]
+        return self._team_seasons[team_id]
+
+    def create_militancy_if_possible(self, player_id, team_id, transfer_date) -> t.Optional[t.Dict]:
+        if team_id not in self.team_leagues or player_id not in self.player_ids:
+            return None
+
+        seasons, end_dates = self.team_seasons(team_id)
+        season = None
+        for end_date, start_date, year in seasons[bisect.bisect_right(end_dates, transfer_date):]:
+            if start_date < transfer_date:
+                season = (end_date, start_date, year)
+                break
+        if season is None:
+            i = bisect.bisect_left(end_dates, transfer_date)
+            season = seasons[i - 1] if i else None
+
+        if not season:
+            return None
+
+        end_date, start_date, year = season
+        militancy = {'player_id': player_id, 'team_id': team_id, 'year': year, 'start_date': start_date,
+                     'end_date': end_date, 'appearences': 0}
+        self.changed[(player_id, team_id, year)] = militancy
+        return militancy
+
+    def apply_player_transfer(self, player_transfer: t.Dict):
+        if not player_transfer.get('transfers') or not player_transfer.get('player', {}).get('id'):
+            return
+        player_id = player_transfer['player']['id']
+        player_militancy = self.militancies[player_id]
+        for transfer in player_transfer['transfers']:
+            transfer_date = utils.convert_to_date(transfer['date'])
+            if not transfer_date:
+                LOGGER.debug('Skipping transfer, player_id: %s (Reason: date=%s)', player_id, transfer['date'])
+                continue
+
+            for team, is_out in zip((transfer['teams']['out'], transfer['teams']['in']), (True, False)):
+                if team['id'] not in (pm['team_id'] for pm in player_militancy):
+                    new_militancy = self.create_militancy_if_possible(player_id, team['id'], transfer_date)
+                    if not new_militancy:
+                        continue
+                    player_militancy.append(new_militancy)
+
+                this_militancy = [pm for pm in player_militancy
+                                  if pm['team_id'] == team['id'] and pm['start_date'] and pm['end_date']
+                                  and pm['start_date'] < transfer_date < pm['end_date']]
+
+                if not this_militancy:
+                    LOGGER.debug('Skipping transfer, player_id: %s, team_id: %s (Reason: militancy not found)',
+                                 player_id, team['id'])
+                    continue
+
+                if is_out:
+                    this_militancy[0]['end_date'] = transfer_date
+                else:
+                    this_militancy[0]['start_date'] = transfer_date
+                pm = this_militancy[0]
+                self.changed[(pm['player_id'], pm['team_id'], pm['year'])] = pm
+
+
+def apply_transfers(transfers: t.List[t.Dict]) -> int:
+    with db_interactor.get_session() as session:
+        index = TransfersIndex(session)
+    LOGGER.info(f'Processing {len(transfers)} player transfers in memory')
+    progress = logger.Progress(LOGGER, 'TRANSFER', total=len(transfers))
+    for player_transfers in transfers:
+        index.apply_player_transfer(player_transfers)
+        progress.step()
+
+    LOGGER.info(f'Writing {len(index.changed)} new or changed militancies')
+    bulk.copy_merge(m.Militancy, index.changed.values(), columns=TransfersIndex.MILITANCY_COLUMNS,
+                    update_columns=('start_date', 'end_date'))
+    return len(index.changed)
+
+
+@metrics.collected
 def get_team_transfer(t_id):
-    t_id = t_id[0]
-    LOGGER.info(f'Processing team {t_id}')
+    LOGGER.debug('Processing team %s', t_id)
     client = api_football_client.APIFootballClient(requests_block=500)
-    transfers = client.get_team_transfers(t_id)
-    return transfers or []
+    # None when the request failed: the team is not checkpointed
+    return client.get_team_transfers(t_id)
 
 
-def fix_transfers():
+def fix_transfers(resume=False, batch=True):
     with db_interactor.get_session() as session:
         team_ids = get_all_teams(session)
 
-    args = [(t_id,) for t_id in team_ids]
+    done = checkpoints.completed_units(TRANSFERS_STAGE) if resume else set()
+    args = [t_id for t_id in team_ids if str(t_id) not in done]
+    LOGGER.info(f'Fetching transfers of {len(args)} teams ({len(team_ids) - len(args)} already done)')
+    data = executor.Executor('transfers', executor.THREAD).map_until_limit(get_team_transfer, args)
+    fetched = [t_id for t_id, d in zip(args, data) if d is not None]
+
     try:
-        with Pool(14, initializer=initializer) as p:
-            data = p.map(get_team_transfer, args)
-
-        transfers = [tr for d in data for tr in d]
-        LOGGER.info(f'Processing {len(transfers)} player transfers')
-        with db_interactor.get_session() as session:
-            for i, player_transfers in enumerate(transfers):
-                if i % 5000 == 0:
-                    print(f'TRANSFER {i+1}/{len(transfers)}')
-                fix_player_transfer(player_transfers, session)
-            session.commit()
+        transfers = [tr for d in data if d for tr in d]
+        if batch:
+            apply_transfers(transfers)
+        else:
+            LOGGER.info(f'Processing {len(transfers)} player transfers')
+            progress = logger.Progress(LOGGER, 'TRANSFER', total=len(transfers))
+            with db_interactor.get_session() as session:
+                for player_transfers in transfers:
+                    fix_player_transfer(player_transfers, session)
+                    progress.step()
+                session.commit()
     except Exception as e:
         LOGGER.error(f'Exception occurred: {e}')
         traceback.print_stack()
-        session.rollback()
+        raise
+    checkpoints.mark_done(TRANSFERS_STAGE, fetched)
+
+    missing = len(args) - len(fetched)
+    if missing:
+        raise api_client.APILimitReached(f'transfers of {missing} teams left for the next run')
 
 
 if __name__ == '__main__':
-    start = time.time()
-    fix_transfers()
-    download_images()
-    print(f'Time taken: {time.time() - start}')
+    metrics.start_run('data_fixers')
+    with metrics.stage('fix_transfers'):
+        fix_transfers()
+    with metrics.stage('download_images'):
+        download_images()
+    metrics.write_report()
@@ -0,0 +1,242 @@
+import re
+import time
+import collections
+import typing as t
+
+import numpy as np
+import sqlalchemy
+from fuzzywuzzy import fuzz as fuzzywuzzy
+from rapidfuzz import fuzz, process
+
+import logger
+from logger import metrics
+from db_interactor import model as m
+from data_generator import executor
+
+
+LOGGER = logger.get_logger('market_values')
+
+SIMILARITY_THRESHOLD = 70
+# pg_trgm words: runs of letters and digits, accented ones included
+WORDS = re.compile(r'[^\W_]+')
+MIN_CHUNK = 1000
+
+_worker_state = None
+
+
+def normalize(s: str) -> str:
+    return ' '.join(WORDS.findall((s or '').lower()))
+
+
+def trigrams(s: str) -> t.FrozenSet[str]:
+    # same trigrams as pg_trgm: every word padded with two spaces in front and one behind
+    return frozenset(w[i:i + 3] for word in s.split() for w in (f'  {word} ',) for i in range(len(w) - 2))
+
+
+class NameIndex:
+    # every name sharing a trigram with the query is a candidate, as with the pg_trgm % operator, and candidates are
+    # ranked on the pg_trgm similarity, computed in float4 like the extension does
+    def __init__(self, ids: t.Sequence[int], names: t.Sequence[str]):
+        self.ids = np.asarray(ids)
+        grams = [trigrams(normalize(n)) for n in names]
+        self._sizes = np.array([len(g) for g in grams], dtype=np.float32)
+        by_trigram = collections.defaultdict(list)
+        for i, name_grams in enumerate(grams):
+            for gram in name_grams:
+                by_trigram[gram].append(i)
+        self._by_trigram = {gram: np.array(postings, dtype=np.int64) for gram, postings in by_trigram.items()}
+
+    def nearest(self, name: str, limit: int, floor: float) -> t.List[int]:
+        # ids of the names closest to name: WHERE name % query ORDER BY name <-> query LIMIT limit, with
+        # pg_trgm.similarity_threshold = floor; equally close names come by id
+        grams = trigrams(normalize(name))
+        postings = [self._by_trigram[gram] for gram in grams if gram in self._by_trigram]
+        if not postings:
+            return []
+        candidates, shared = np.unique(np.concatenate(postings), return_counts=True)
+        shared = shared.astype(np.float32)
+        scores = shared / (np.float32(len(grams)) + self._sizes[candidates] - shared)
+        keep = scores.astype(np.float64) >= floor
+        candidates, scores = candidates[keep], scores[keep]
+        best = np.lexsort((self.ids[candidates], -scores))[:limit]
+        return self.ids[candidates[best]].tolist()
+
+
+def partial_ratio(choice: str, query: str) -> int:
+    # the score of entity_values_maker.fuzz_similar, argument order included
+    return fuzzywuzzy.partial_ratio(choice, query)
+
+
+def rapidfuzz_bounds(queries: t.Sequence[str], choices: t.Sequence[str], workers: int) -> np.ndarray:
+    # rapidfuzz's partial_ratio searches every alignment fuzzywuzzy tries, and more: it never scores a pair lower,
+    # so pairs whose bound cannot round up to the threshold do not need the exact (and slower) fuzzywuzzy score
+    return process.cdist(queries, choices, scorer=fuzz.partial_ratio, dtype=np.float32, workers=workers)
+
+
+def exact_scores(query: str, choices: t.Sequence[str], bounds: np.ndarray) -> t.List[int]:
+    # fuzzywuzzy scores of the choices that can reach the threshold, the others only need to stay below it
+    return [partial_ratio(choice, query) if bound >= SIMILARITY_THRESHOLD - 1 else 0
+            for choice, bound in zip(choices, bounds)]
+
+
+class ScoreMatrix:
+    # partial_ratio of every query against every choice: rapidfuzz bounds computed at once, exact fuzzywuzzy scores
+    # computed (and kept) for the pairs that can reach the threshold. Scores below it are reported as 0
+    def __init__(self, queries: t.Iterable[str], choices: t.Iterable[str], workers: int = -1):
+        self._queries = {q: i for i, q in enumerate(dict.fromkeys(queries))}
+        self._choices = {c: i for i, c in enumerate(dict.fromkeys(choices))}
+        self._bounds = rapidfuzz_bounds(list(self._queries), list(self._choices), workers) \
+            if self._queries and self._choices else None
+        self._exact = {}
+
+    def score(self, query: str, choice: str) -> int:
+        key = self._queries[query], self._choices[choice]
+        if self._bounds[key] < SIMILARITY_THRESHOLD - 1:
+            return 0
+        score = self._exact.get(key)
+        if score is None:
+            score = self._exact[key] = partial_ratio(choice, query)
+        return score
+
+
+class EntityResolver:
+    def __init__(self, similarity_floor: float, player_candidates: int, team_candidates: int):
+        self._floor = similarity_floor
+        self._player_candidates = player_candidates
+        self._team_candidates = team_candidates
+        # threads of rapidfuzz's cdist: all cores, but one in the worker processes of resolve_players
+        self._cdist_workers = -1
+
+    def load(self):
+        start = time.time()
+        with m.engine.connect() as conn:
+            self.teams = {r[0]: r[1] or '' for r in conn.execute(sqlalchemy.select(m.Team.id, m.Team.name))}
+            self.leagues = {r[0]: r[1] or '' for r in conn.execute(sqlalchemy.select(m.League.id,
+                                                                                     m.League.display_name))}
+            self.players = {r[0]: r[1] or '' for r in conn.execute(sqlalchemy.select(m.Player.id,
+                                                                                     m.Player.full_name))}
+
+            self.team_leagues = collections.defaultdict(set)
+            self.league_teams = collections.defaultdict(set)
+            for team_id, league_id in conn.execute(sqlalchemy.select(m.TeamMilitancy.team_id,
+                                                                     m.TeamMilitancy.league_id).distinct()):
+                self.team_leagues[team_id].add(league_id)
+                self.league_teams[league_id].add(team_id)
+
+            # (other entity id, appearences) per player and per team, as walked through the militancy relationships
+            self.player_militancies = collections.defaultdict(set)
+            self.team_militancies = collections.defaultdict(set)
+            query = sqlalchemy.select(m.Militancy.player_id, m.Militancy.team_id, m.Militancy.appearences)
+            for player_id, team_id, appearences in conn.execution_options(yield_per=100000).execute(query):
+                self.player_militancies[player_id].add((team_id, appearences))
+                self.team_militancies[team_id].add((player_id, appearences))
+
+        self.teams_by_name = collections.defaultdict(list)
+        for team_id, name in self.teams.items():
+            self.teams_by_name[name].append(team_id)
+        self.leagues_by_name = collections.defaultdict(list)
+        for league_id, name in self.leagues.items():
+            self.leagues_by_name[name].append(league_id)
+        self.player_index = NameIndex(list(self.players), list(self.players.values()))
+        self.team_index = NameIndex(list(self.teams), list(self.teams.values()))
+        LOGGER.info(f'Resolver loaded {len(self.players)} players, {len(self.teams)} teams, '
+                    f'{len(self.leagues)} leagues in {time.time() - start:.1f}s')
+        return self
+
+    def resolve_teams(self, teams: t.List[t.Tuple[str, str, t.Any]]) -> t.List[t.Optional[t.Dict]]:
+        # teams: (team name, league name, value), names already fixed as in entity_values_maker.process_team
+        league_scores = ScoreMatrix((league_name for _, league_name, _ in teams), self.leagues.values())
+        team_scores = ScoreMatrix((team_name for team_name, _, _ in teams), self.teams.values())
+        return [self._resolve_team(team_name, league_name, value, league_scores, team_scores)
+                for team_name, league_name, value in teams]
+
+    def _resolve_team(self, team_name: str, league_name: str, value, league_scores: ScoreMatrix,
+                      team_scores: ScoreMatrix) -> t.Optional[t.Dict]:
+        records = {(team_id, self.leagues[l_id], l_id) for team_id in self.teams_by_name.get(team_name, ())
+                   for l_id in self.team_leagues[team_id]}
+        records = [(*r, league_scores.score(league_name, r[1])) for r in records]
+        records = [r for r in records if r[-1] >= SIMILARITY_THRESHOLD]
+        if records:
+            team_id, l_name, l_id, _ = max(records, key=lambda r: r[-1])
+            return {'team': {'name': team_name, 'id': team_id}, 'league': {'name': l_name, 'id': l_id}, 'value': value}
+
+        records = {(l_id, self.teams[team_id], team_id) for l_id in self.leagues_by_name.get(league_name, ())
+                   for team_id in self.league_teams[l_id]}
+        records = [(*r, team_scores.score(team_name, r[1])) for r in records]
+        records = [r for r in records if r[-1] >= SIMILARITY_THRESHOLD]
+        if records:
+            l_id, t_name, team_id, _ = max(records, key=lambda r: r[-1])
+            return {'team': {'name': t_name, 'id': team_id}, 'league': {'name': league_name, 'id': l_id},
+                    'value': value}
+
+        LOGGER.warning('Nothing found for team value - league: %s, team: %s', league_name, team_name)
+        return None
+
+    def resolve_players(self, players: t.List[t.Tuple[str, str, t.Any]], workers: int = None
+                        ) -> t.List[t.Optional[t.Dict]]:
+        # players: (player name, team name, value)
+        team_scores = ScoreMatrix((team_name for _, team_name, _ in players), self.teams.values())
+        workers = min(workers or executor.CPU_WORKERS, max(1, len(players) // MIN_CHUNK))
+        if workers == 1:
+            return self._resolve_players(players, team_scores)
+
+        # the candidate search is pure python: chunks go to worker processes that get the loaded state once
+        chunks = [players[i::workers] for i in range(workers)]
+        pool = executor.Executor('resolve_players', executor.PROCESS, workers=workers, chunksize=1,
+                                 initializer=_set_worker_state, initargs=(self, team_scores))
+        results = pool.map(_resolve_players_chunk, chunks)
+        resolved = [None] * len(players)
+        for i, chunk_results in enumerate(results):
+            resolved[i::workers] = chunk_results
+        return resolved
+
+    def _resolve_players(self, players: t.List[t.Tuple[str, str, t.Any]], team_scores: ScoreMatrix
+                         ) -> t.List[t.Optional[t.Dict]]:
+        return [self._resolve_player(player_name, team_name, value, team_scores)
+                for player_name, team_name, value in players]
+
+    @staticmethod
+    def _best(records: t.List[t.Tuple]) -> t.Optional[t.Tuple]:
+        # highest name score first, most appearences among equals
+        records = [r for r in records if r[-1] >= SIMILARITY_THRESHOLD]
+        if not records:
+            return None
+        max_similarity = max(r[-1] for r in records)
+        return max((r for r in records if r[-1] == max_similarity), key=lambda r: r[-2] or 0)
+
+    def _resolve_player(self, player_name: str, team_name: str, value, team_scores: ScoreMatrix
+                        ) -> t.Optional[t.Dict]:
+        candidates = self.player_index.nearest(player_name, self._player_candidates, self._floor)
+        records = {(p_id, self.teams[team_id], team_id, appearences) for p_id in candidates
+                   for team_id, appearences in self.player_militancies[p_id]}
+        best = self._best([(*r, team_scores.score(team_name, r[1])) for r in records])
+        if best:
+            return {'player': {'name': player_name, 'id': best[0]}, 'team': {'name': best[1], 'id': best[2]},
+                    'value': value}
+
+        candidates = self.team_index.nearest(team_name, self._team_candidates, self._floor)
+        records = list({(team_id, self.players[p_id], p_id, appearences) for team_id in candidates
+                        for p_id, appearences in self.team_militancies[team_id]})
+        if records:
+            names = [r[1] for r in records]
+            scores = exact_scores(player_name, names, rapidfuzz_bounds([player_name], names, self._cdist_workers)[0])
+            best = self._best([(*r, s) for r, s in zip(records, scores)])
+            if best:
+                return {'player': {'name': best[1], 'id': best[2]}, 'team': {'name': team_name, 'id': best[0]},
+                        'value': value}
+
+        LOGGER.warning('Nothing found for player value - player: %s, team: %s', player_name, team_name)
+        return None
+
+
+def _set_worker_state(resolver: EntityResolver, team_scores: ScoreMatrix):
+    global _worker_state
+    # every worker process is already one core
+    resolver._cdist_workers = 1
+    _worker_state = resolver, team_scores
+
+
+@metrics.collected
+def _resolve_players_chunk(players: t.List[t.Tuple[str, str, t.Any]]) -> t.List[t.Optional[t.Dict]]:
+    resolver, team_scores = _worker_state
+    return resolver._resolve_players(players, team_scores)
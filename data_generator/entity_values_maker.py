@@ -1,10 +1,13 @@
+import os
 import re
 import math
+import time
 import json
+import itertools
+import functools
 import datetime
 import typing as t
 from pathlib import Path
-from multiprocessing import Pool
 
 from unidecode import unidecode
 import sqlalchemy
@@ -13,12 +16,21 @@ from fuzzywuzzy import fuzz
 
 import logger
 import db_interactor
+from logger import metrics
+from api_client import transfermarkt_scraper
 from db_interactor import model as m
+from data_generator import entity_resolver, valuation, executor
 
 
 LOGGER = logger.get_logger('market_values')
 
 SIMILARITY_THRESHOLD = 70
+# trigram similarity (0-1) a player/team name needs to be a candidate, and how many candidates are kept
+SIMILARITY_FLOOR = float(os.getenv('MATCH_SIMILARITY_FLOOR', 0.1))
+PLAYER_CANDIDATES = int(os.getenv('MATCH_PLAYER_CANDIDATES', 10))
+TEAM_CANDIDATES = int(os.getenv('MATCH_TEAM_CANDIDATES', 5))
+# rows of the transfermarkt results resolved at a time
+MATCH_CHUNK = int(os.getenv('MATCH_CHUNK', 50000))
 NAMES_FIXER = re.compile(r'[a-z][A-Z]')
 LEAGUE_NAME_FIXER = {
     'Série A': 'Serie A',
@@ -30,10 +42,6 @@ TEAM_NAME_FIXER = {
 }
 
 
-def initializer():
-    m.engine.dispose(close=False)
-
-
 def fuzz_similar(a: str, b: str):
     return fuzz.partial_ratio(a, b)
 
@@ -56,12 +64,12 @@ def fix_team_name(s: str) -> str:
     return TEAM_NAME_FIXER.get(s, s)
 
 
+@metrics.collected
 def process_team(team):
-    team = team[0]
     team_name = unidecode(fix_team_name(team['team']))
     league_name = unidecode(fix_league_name(team['league']))
 
-    with db_interactor.get_session() as session:
+    with db_interactor.worker_session() as session:
         teams_records = session.query(m.Team).filter(m.Team.name == team_name).all()
         if teams_records:
             teams_records = {(team.id, mi.league.display_name, mi.league_id)
@@ -89,17 +97,22 @@ def process_team(team):
                     'value': team['value']
                 }
 
-    LOGGER.warning(f'Nothing found for team value - league: {league_name}, team: {team_name}')
+    LOGGER.warning('Nothing found for team value - league: %s, team: %s', league_name, team_name)
     return None
 
 
-def get_potential_players(name: str, session: Session):
-    player = session.query(m.Player.id.label('player_id'),
-                           sqlalchemy.func.concat(m.Player.name, ' ', m.Player.surname
-                                                  ).label('full_name')).cte('player')
+def set_similarity_floor(session: Session, floor: float = SIMILARITY_FLOOR):
+    # the % operator filters on pg_trgm.similarity_threshold; set for the current transaction only (SET LOCAL), so it
+    # does not stay on the pooled connection once the lookup is over
+    session.execute(sqlalchemy.select(sqlalchemy.func.set_config('pg_trgm.similarity_threshold', str(floor), True)))
 
-    player_sim = session.query(player.columns.player_id.label('player_id')).order_by(
-        sqlalchemy.desc(sqlalchemy.func.similarity(name, player.columns.full_name))).limit(10).cte()
+
+def get_potential_players(name: str, session: Session, limit: int = PLAYER_CANDIDATES):
+    # % and <-> are both answered by the gist index on full_name: the nearest names are read from the index
+    # instead of scoring every player
+    set_similarity_floor(session)
+    player_sim = session.query(m.Player.id.label('player_id')).filter(
+        m.Player.full_name.op('%')(name)).order_by(m.Player.full_name.op('<->')(name)).limit(limit).cte()
 
     query = session.query(player_sim, m.Militancy).outerjoin(m.Militancy)
 
@@ -108,9 +121,10 @@ def get_potential_players(name: str, session: Session):
     return players_records
 
 
-def get_potential_teams(name: str, session: Session):
-    team_sim = session.query(m.Team.id).order_by(
-        sqlalchemy.desc(sqlalchemy.func.similarity(name, m.Team.name))).limit(5).cte()
+def get_potential_teams(name: str, session: Session, limit: int = TEAM_CANDIDATES):
+    set_similarity_floor(session)
+    team_sim = session.query(m.Team.id).filter(m.Team.name.op('%')(name)).order_by(
+        m.Team.name.op('<->')(name)).limit(limit).cte()
 
     query = session.query(team_sim, m.Militancy).outerjoin(m.Militancy)
 
@@ -120,12 +134,12 @@ def get_potential_teams(name: str, session: Session):
     return teams_records
 
 
+@metrics.collected
 def process_player(player):
-    player = player[0]
     player_name = unidecode(player['player'])
     team_name = unidecode(player['team'])
 
-    with db_interactor.get_session() as session:
+    with db_interactor.worker_session() as session:
         players_records = get_potential_players(player_name, session)
         if players_records:
             players_records = {(a[0], a[1], a[2], a[3], fuzz_similar(a[1], team_name)) for a in players_records}
@@ -154,26 +168,63 @@ def process_player(player):
                     'value': player['value']
                 }
 
-    LOGGER.warning(f'Nothing found for player value - player: {player_name}, team: {team_name}')
+    LOGGER.warning('Nothing found for player value - player: %s, team: %s', player_name, team_name)
     return None
 
 
-def find_ids(teams: t.List[t.Dict], players: t.List[t.Dict]) -> t.Tuple[t.List, t.List]:
-    teams = list({(team['team'], team['league']): team for team in teams}.values())
-    args = [(team,) for team in teams]
-    with Pool(12, initializer=initializer) as p:
-        teams_res = p.map(process_team, args)
-
-    teams_not_found = [team for team, res in zip(teams, teams_res) if not res]
+def unique(rows: t.Iterable[t.Dict], key: t.Callable[[t.Dict], t.Hashable]) -> t.Iterator[t.Dict]:
+    # the first row of every key, as the rows stream in
+    seen = set()
+    for row in rows:
+        if key(row) not in seen:
+            seen.add(key(row))
+            yield row
+
+
+def resolve_teams(teams: t.List[t.Dict], resolver: entity_resolver.EntityResolver = None) -> t.List:
+    # the results of process_team, from the resolver when there is one: names are fixed the same way
+    if resolver is None:
+        return executor.Executor('team_values', executor.PROCESS).map(process_team, teams)
+    return resolver.resolve_teams([(unidecode(fix_team_name(team['team'])), unidecode(fix_league_name(team['league'])),
+                                    team['value']) for team in teams])
+
+
+def resolve_players(players: t.List[t.Dict], resolver: entity_resolver.EntityResolver = None) -> t.List:
+    if resolver is None:
+        return executor.Executor('player_values', executor.PROCESS).map(process_player, players)
+    return resolver.resolve_players([(unidecode(player['player']), unidecode(player['team']), player['value'])
+                                     for player in players])
+
+
+def _resolve_stream(rows: t.Iterator[t.Dict], resolve: t.Callable[[t.List[t.Dict]], t.List]
+                    ) -> t.Tuple[t.List, t.List]:
+    # (results, rows not found), resolved MATCH_CHUNK rows at a time: only the chunk is held, not the whole input
+    found, not_found = [], []
+    for chunk in iter(lambda: list(itertools.islice(rows, MATCH_CHUNK)), []):
+        for row, res in zip(chunk, resolve(chunk)):
+            if res:
+                found.append(res)
+            else:
+                not_found.append(row)
+    return found, not_found
+
+
+def find_ids(teams: t.Iterable[t.Dict], players: t.Iterable[t.Dict], batch=True) -> t.Tuple[t.List, t.List]:
+    # batch: everything is resolved in memory by entity_resolver, otherwise every row is matched with its own
+    # queries through a process pool. Rows can come as streams, duplicates are dropped on the way
+    start = time.time()
+    resolver = entity_resolver.EntityResolver(SIMILARITY_FLOOR, PLAYER_CANDIDATES, TEAM_CANDIDATES).load() \
+        if batch else None
+    teams_res, teams_not_found = _resolve_stream(unique(teams, lambda team: (team['team'], team['league'])),
+                                                 functools.partial(resolve_teams, resolver=resolver))
     LOGGER.warning(f'{len(teams_not_found)} teams could not be identified')
 
-    players = list({(player['player'], player['team']): player for player in players}.values())
-    args = [(player,) for player in players]
-    with Pool(12, initializer=initializer) as p:
-        players_res = p.map(process_player, args)
-
-    players_not_found = [p for p, res in zip(players, players_res) if not res]
+    players_res, players_not_found = _resolve_stream(
+        unique(players, lambda player: (player['player'], player['team'])),
+        functools.partial(resolve_players, resolver=resolver))
     LOGGER.warning(f'{len(players_not_found)} players could not be identified')
+    LOGGER.info(f'{len(teams_res) + len(teams_not_found)} teams and {len(players_res) + len(players_not_found)} '
+                f'players resolved in {time.time() - start:.1f}s')
 
     now = datetime.datetime.now().strftime("%m_%d_%Y__%H_%M_%S")
     log_dir = Path('.not_found')
@@ -184,7 +235,7 @@ def find_ids(teams: t.List[t.Dict], players: t.List[t.Dict]) -> t.Tuple[t.List,
     with open(Path(log_dir, f'players_not_found_{now}.json'), 'w') as f:
         json.dump(players_not_found, f, indent=4, ensure_ascii=False)
 
-    return [team for team in teams_res if team], [player for player in players_res if player]
+    return teams_res, players_res
 
 
 def sort_data(teams: t.List[t.Dict], players: t.List[t.Dict]) -> t.Tuple[t.Set, t.Dict, t.Dict]:
@@ -201,7 +252,15 @@ def sort_data(teams: t.List[t.Dict], players: t.List[t.Dict]) -> t.Tuple[t.Set,
     return all_leagues, all_teams, all_players
 
 
-def apply_formula(leagues, teams, players):
+def apply_formula(leagues, teams, players, vectorized=True):
+    # vectorized: computed on columnar arrays by data_generator.valuation and written back with one bulk update
+    if vectorized:
+        valuation.apply(leagues, teams, players)
+    else:
+        apply_formula_orm(leagues, teams, players)
+
+
+def apply_formula_orm(leagues, teams, players):
     # for all leagues get all teams and from teams all players (most recent year) and assign a base value
     with db_interactor.get_session() as session:
         for l_id in leagues:
@@ -263,12 +322,11 @@ def main(teams_path: str, players_path: str, cut_players: int = None):
     players_path = Path(players_path).absolute()
     assert teams_path.exists() and players_path.exists(), 'File(s) not found'
 
-    with open(teams_path, 'r') as f:
-        teams = json.load(f)
-    with open(players_path, 'r') as f:
-        players = json.load(f)
+    # run folders, jsonl or old json files, read as streams: a partial scrape can already be used
+    teams = transfermarkt_scraper.iter_results(teams_path)
+    players = transfermarkt_scraper.iter_results(players_path)
     if cut_players:
-        players = players[:cut_players]
+        players = itertools.islice(players, cut_players)
 
     teams, players = find_ids(teams, players)
 
@@ -0,0 +1,123 @@
+import os
+import math
+import itertools
+import functools
+import typing as t
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import logger
+import api_client
+import db_interactor
+from db_interactor import engines
+
+# how the data_generator stages fan out their tasks. Every stage has a name and a default backend: threads for the
+# stages waiting on the API, processes for the ones working on the database or the cpu. Both can be changed per stage
+# through the environment, e.g. TRANSFERS_WORKERS=32 or RELATIONSHIPS_BACKEND=thread.
+#   DATA_GENERATOR_WORKERS: processes, the cpu count by default
+#   DATA_GENERATOR_IO_WORKERS: threads, 14 by default
+# When a task raises (api_client.APILimitReached above all) no other task starts and the exception reaches the
+# stage: the results yielded until then are kept and the rest is left to the next run.
+# A database stage moved to threads shares the pool of the main engine (DB_POOL_SIZE + DB_MAX_OVERFLOW) instead of
+# one small pool per process: its workers are capped to the pool, more threads would only wait for a connection.
+
+LOGGER = logger.get_logger('data_generator')
+
+PROCESS = 'process'
+THREAD = 'thread'
+CPU_WORKERS = int(os.getenv('DATA_GENERATOR_WORKERS', 0)) or os.cpu_count() or 1
+IO_WORKERS = int(os.getenv('DATA_GENERATOR_IO_WORKERS', 14))
+CHUNKS_PER_WORKER = 4
+
+T = t.TypeVar('T')
+R = t.TypeVar('R')
+
+
+def _call(func: t.Callable[[T], R], indexed: t.Tuple[int, T]) -> t.Tuple[int, R]:
+    i, item = indexed
+    return i, func(item)
+
+
+class Executor:
+    def __init__(self, stage: str, backend: str = PROCESS, workers: int = None, chunksize: int = None,
+                 initializer: t.Callable = db_interactor.worker_initializer, initargs: t.Tuple = ()):
+        # initializer only runs in process workers; threads share the engine of the main process
+        self.stage = stage
+        self.backend = os.getenv(f'{stage.upper()}_BACKEND', backend)
+        if self.backend not in (PROCESS, THREAD):
+            raise ValueError(f'Unknown backend for {stage}: {self.backend}')
+        self.workers = int(os.getenv(f'{stage.upper()}_WORKERS', 0)) or workers or \
+            (CPU_WORKERS if self.backend == PROCESS else IO_WORKERS)
+        self.chunksize = int(os.getenv(f'{stage.upper()}_CHUNKSIZE', 0)) or chunksize
+        # the stages set up with worker_initializer work on the database
+        connections = engines.POOL_SIZE + engines.MAX_OVERFLOW
+        if self.backend == THREAD and backend == PROCESS and initializer is db_interactor.worker_initializer \
+                and not engines.NULL_POOL and self.workers > connections:
+            LOGGER.warning(f'{stage} - {self.workers} threads on a pool of {connections} connections, capped to '
+                           f'{connections}: raise DB_POOL_SIZE or DB_MAX_OVERFLOW for more')
+            self.workers = connections
+        self._initializer = initializer
+        self._initargs = initargs
+
+    def _chunksize(self, n: int) -> int:
+        # a few chunks per worker, as Pool.map does: fewer round trips, still balanced
+        return self.chunksize or max(1, math.ceil(n / (self.workers * CHUNKS_PER_WORKER)))
+
+    def imap(self, func: t.Callable[[T], R], items: t.Sequence[T]) -> t.Iterator[t.Tuple[T, R]]:
+        # (item, result) in completion order; func and the items must be picklable with the process backend
+        for i, result in self._results(func, items):
+            yield items[i], result
+
+    def _results(self, func, items) -> t.Iterator[t.Tuple[int, t.Any]]:
+        # (position of the item, result): items do not need to be hashable
+        workers = max(1, min(self.workers, len(items)))
+        LOGGER.info(f'{self.stage} - {len(items)} tasks on {workers} {self.backend} workers')
+        progress = logger.Progress(LOGGER, f'{self.stage} - task', total=len(items))
+        if not items:
+            return
+        for i, result in self._dispatch(func, items, workers):
+            progress.step()
+            yield i, result
+
+    def _dispatch(self, func, items, workers) -> t.Iterator[t.Tuple[int, t.Any]]:
+        if self.backend == PROCESS:
+            with Pool(workers, initializer=self._initializer, initargs=self._initargs) as p:
+                # leaving the block terminates the workers, also when a task raised
+                yield from p.imap_unordered(functools.partial(_call, func), enumerate(items),
+                                            chunksize=self._chunksize(len(items)))
+            return
+
+        executor = ThreadPoolExecutor(workers, thread_name_prefix=self.stage)
+        try:
+            # one task in flight per worker, the next one is submitted as one completes
+            queued = enumerate(items)
+            pending = {executor.submit(func, item): i for i, item in itertools.islice(queued, workers)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    result = future.result()
+                    for j, item in itertools.islice(queued, 1):
+                        pending[executor.submit(func, item)] = j
+                    yield i, result
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def map(self, func: t.Callable[[T], R], items: t.Sequence[T]) -> t.List[R]:
+        # results in the order of items
+        results = [None] * len(items)
+        for i, result in self._results(func, items):
+            results[i] = result
+        return results
+
+    def map_until_limit(self, func: t.Callable[[T], R], items: t.Sequence[T]) -> t.List[t.Optional[R]]:
+        # results in the order of items, None for the items left out when the API limit was reached
+        results = [None] * len(items)
+        done = 0
+        try:
+            for i, result in self._results(func, items):
+                results[i] = result
+                done += 1
+        except api_client.APILimitReached as e:
+            LOGGER.warning(f'{self.stage} - API limit reached, {len(items) - done} tasks left: {e}')
+        return results
@@ -0,0 +1,193 @@
+import os
+import datetime
+import typing as t
+
+import sqlalchemy
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+import logger
+from logger import metrics
+from data_generator import neo4j_interactor
+from db_interactor import model as m
+
+
+LOGGER = logger.get_logger('data_generator')
+
+WATERMARK_NAME = 'neo4j'
+BATCH_SIZE = 5000
+
+CREATE_PLAYER_INDEX = 'CREATE INDEX player_id IF NOT EXISTS FOR (p:Player) ON (p.playerId)'
+REMOVE_EDGES = 'UNWIND $rows AS r ' \
+               'MATCH (:Player {playerId: r.start})-[rel:PLAYED_WITH {team_id: r.team_id}]->(:Player {playerId: r.end}) ' \
+               'DELETE rel'
+ADD_EDGES = 'UNWIND $rows AS r ' \
+            'MERGE (a:Player {playerId: r.start}) ' \
+            'MERGE (b:Player {playerId: r.end}) ' \
+            'MERGE (a)-[:PLAYED_WITH {team_id: r.team_id}]->(b)'
+SET_VALUES = 'UNWIND $rows AS r ' \
+             'MERGE (p:Player {playerId: r.id}) ' \
+             'SET p.value = r.value'
+
+CREATE_SCOPE = 'CREATE TEMP TABLE graph_scope (player_id integer, team_id integer) ON COMMIT DROP'
+NEW_EDGES = '''
+SELECT DISTINCT a.player_id, b.player_id, a.team_id
+FROM militancy a
+JOIN militancy b ON b.team_id = a.team_id AND b.start_date >= a.start_date AND b.end_date <= a.end_date
+    AND b.player_id != a.player_id
+WHERE EXISTS (SELECT 1 FROM graph_scope s WHERE s.team_id = a.team_id AND s.player_id IN (a.player_id, b.player_id))
+'''
+OLD_EDGES = '''
+SELECT p.player_id, p.other_player_id, p.team_id
+FROM playedwith p
+WHERE EXISTS (SELECT 1 FROM graph_scope s
+              WHERE s.team_id = p.team_id AND s.player_id IN (p.player_id, p.other_player_id))
+'''
+
+
+class WatermarkNotFound(Exception):
+    pass
+
+
+class CypherExecutor:
+    def run(self, statement: str, parameters: t.Dict = None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Neo4jExecutor(CypherExecutor):
+    def __init__(self, uri: str = None, user: str = None, password: str = None):
+        try:
+            import neo4j
+        except ImportError:
+            raise ImportError('the neo4j package is required to refresh the graph in place (pip install neo4j)')
+        uri = uri or os.getenv('NEO4J_URI', 'bolt://localhost:7687')
+        auth = (user or os.getenv('NEO4J_USER', 'neo4j'), password or os.getenv('NEO4J_PASSWORD'))
+        self._driver = neo4j.GraphDatabase.driver(uri, auth=auth)
+
+    def run(self, statement: str, parameters: t.Dict = None):
+        with self._driver.session() as session:
+            session.execute_write(lambda tx: tx.run(statement, parameters or {}).consume())
+
+    def close(self):
+        self._driver.close()
+
+
+class RecordingExecutor(CypherExecutor):
+    # keeps every statement in memory: useful for dry runs and as a local fake
+    def __init__(self):
+        self.statements: t.List[t.Tuple[str, t.Dict]] = []
+
+    def run(self, statement: str, parameters: t.Dict = None):
+        self.statements.append((statement, parameters or {}))
+
+
+def _batches(rows: t.List, batch_size: int) -> t.Iterator[t.List]:
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
+
+def _edge_rows(edges: t.Iterable[t.Tuple[int, int, int]]) -> t.List[t.Dict]:
+    # neo4j-admin stores the playerId:ID column as a string property
+    return [{'start': str(p_id), 'end': str(p_id2), 'team_id': team_id} for p_id, p_id2, team_id in edges]
+
+
+def _set_watermark(conn, change_id: int):
+    stmt = insert(m.ExportWatermark).values(name=WATERMARK_NAME, change_id=change_id,
+                                            exported_at=datetime.datetime.now())
+    stmt = stmt.on_conflict_do_update(index_elements=['name'], set_={'change_id': stmt.excluded.change_id,
+                                                                     'exported_at': stmt.excluded.exported_at})
+    conn.execute(stmt)
+
+
+def snapshot_played_with() -> int:
+    # first step of a full rebuild: the PlayedWith mirror and the change id it stands at are read from one snapshot
+    # of the database, the export then reads the mirror (neo4j_interactor.generate_relationships(from_snapshot=True)).
+    # Changes committed meanwhile stay in the changelog; pass the change id to mark_exported once the graph is imported
+    with m.engine.connect().execution_options(isolation_level='REPEATABLE READ') as conn:
+        change_id = conn.execute(sqlalchemy.select(sqlalchemy.func.coalesce(sqlalchemy.func.max(m.GraphChange.id),
+                                                                            0))).scalar()
+        conn.execute(sqlalchemy.delete(m.PlayedWith))
+        conn.execute(insert(m.PlayedWith).from_select(['player_id', 'other_player_id', 'team_id'],
+                                                      neo4j_interactor.get_played_with_query()))
+        conn.commit()
+    LOGGER.info(f'PlayedWith snapshot taken (change id {change_id})')
+    return change_id
+
+
+def mark_exported(change_id: int):
+    # last step of a full rebuild: the graph holds everything up to change_id, refresh_graph goes on from there
+    with m.engine.connect() as conn:
+        _set_watermark(conn, change_id)
+        conn.execute(sqlalchemy.delete(m.GraphChange).where(m.GraphChange.id <= change_id))
+        conn.commit()
+    LOGGER.info(f'Graph exported up to change id {change_id}')
+
+
+def refresh_graph(executor: CypherExecutor, batch_size: int = BATCH_SIZE) -> t.Dict[str, int]:
+    with m.engine.connect() as conn:
+        watermark = conn.execute(sqlalchemy.select(m.ExportWatermark.change_id).where(
+            m.ExportWatermark.name == WATERMARK_NAME)).scalar()
+        if watermark is None:
+            raise WatermarkNotFound('No export watermark found: run a full rebuild (neo4j_interactor.py) first')
+
+        changes = conn.execute(sqlalchemy.select(m.GraphChange.id, m.GraphChange.entity, m.GraphChange.player_id,
+                                                 m.GraphChange.team_id).where(m.GraphChange.id > watermark)).all()
+        if not changes:
+            LOGGER.info('Graph already up to date')
+            return {'changes': 0, 'added': 0, 'removed': 0, 'values': 0}
+        last_change_id = max(c[0] for c in changes)
+        scope = {(c[2], c[3]) for c in changes if c[1] == 'militancy'}
+        changed_players = {c[2] for c in changes if c[1] == 'player'}
+
+        added = removed = set()
+        if scope:
+            conn.execute(text(CREATE_SCOPE))
+            conn.execute(text('INSERT INTO graph_scope (player_id, team_id) VALUES (:player_id, :team_id)'),
+                         [{'player_id': p_id, 'team_id': team_id} for p_id, team_id in scope])
+            new_edges = {tuple(r) for r in conn.execute(text(NEW_EDGES))}
+            old_edges = {tuple(r) for r in conn.execute(text(OLD_EDGES))}
+            added = new_edges - old_edges
+            removed = old_edges - new_edges
+
+        values = []
+        if changed_players:
+            values = conn.execute(sqlalchemy.select(m.Player.id, m.Player.value).where(
+                m.Player.id.in_(changed_players))).all()
+
+        LOGGER.info(f'Refreshing graph: {len(changes)} changes, {len(added)} new relationships, '
+                    f'{len(removed)} removed relationships, {len(values)} player values')
+        executor.run(CREATE_PLAYER_INDEX)
+        for rows in _batches([{'id': str(p_id), 'value': value} for p_id, value in values], batch_size):
+            executor.run(SET_VALUES, {'rows': rows})
+        for rows in _batches(_edge_rows(removed), batch_size):
+            executor.run(REMOVE_EDGES, {'rows': rows})
+        for rows in _batches(_edge_rows(added), batch_size):
+            executor.run(ADD_EDGES, {'rows': rows})
+
+        for edges in _batches(list(removed), batch_size):
+            conn.execute(sqlalchemy.delete(m.PlayedWith).where(
+                sqlalchemy.tuple_(m.PlayedWith.player_id, m.PlayedWith.other_player_id, m.PlayedWith.team_id).in_(
+                    edges)))
+        for edges in _batches(list(added), batch_size):
+            conn.execute(insert(m.PlayedWith).on_conflict_do_nothing(),
+                         [{'player_id': p_id, 'other_player_id': p_id2, 'team_id': team_id}
+                          for p_id, p_id2, team_id in edges])
+        _set_watermark(conn, last_change_id)
+        conn.execute(sqlalchemy.delete(m.GraphChange).where(m.GraphChange.id <= last_change_id))
+        conn.commit()
+
+    return {'changes': len(changes), 'added': len(added), 'removed': len(removed), 'values': len(values)}
+
+
+if __name__ == '__main__':
+    metrics.start_run('graph_refresh')
+    neo4j_executor = Neo4jExecutor()
+    try:
+        with metrics.stage('refresh_graph'):
+            print(refresh_graph(neo4j_executor))
+    finally:
+        neo4j_executor.close()
+    metrics.write_report()
@@ -0,0 +1,189 @@
+import os
+import hashlib
+import itertools
+import datetime
+import tempfile
+import typing as t
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+import logger
+from api_client import sessions
+from db_interactor import model as m
+
+
+LOGGER = logger.get_logger('data_generator')
+
+# inline: the bytes go into each entity's img column
+# table: every distinct image is stored once in imageblob.data
+# disk: every distinct image is stored once under IMAGES_FOLDER, imageblob.path points to it
+STORAGES = ('inline', 'table', 'disk')
+IMAGES_FOLDER = Path(os.getenv('IMAGES_FOLDER', '.images'))
+ENTITY_TABLES = (m.League, m.Team, m.Player)
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchedImage(t.NamedTuple):
+    url: str
+    status_code: int
+    sha256: t.Optional[str] = None
+    content_type: t.Optional[str] = None
+    size: int = 0
+    content: t.Optional[bytes] = None
+    path: t.Optional[str] = None
+    etag: t.Optional[str] = None
+    last_modified: t.Optional[str] = None
+
+
+def blob_path(sha256: str, root: Path = None) -> Path:
+    return Path(root or IMAGES_FOLDER, sha256[:2], sha256)
+
+
+def fetch_image(session: requests.Session, url: str, etag: str = None, last_modified: str = None,
+                storage: str = 'table', root: Path = None) -> FetchedImage:
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    try:
+        with session.get(url, headers=headers, stream=True) as r:
+            validators = {'etag': r.headers.get('ETag') or etag,
+                          'last_modified': r.headers.get('Last-Modified') or last_modified}
+            if r.status_code != 200:
+                return FetchedImage(url, r.status_code, **validators)
+
+            # the body is hashed while it is streamed; on disk it never has to be held in memory at once
+            h = hashlib.sha256()
+            size = 0
+            if storage == 'disk':
+                root = Path(root or IMAGES_FOLDER)
+                root.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(dir=root, delete=False) as f:
+                    try:
+                        for chunk in r.iter_content(CHUNK_SIZE):
+                            h.update(chunk)
+                            size += len(chunk)
+                            f.write(chunk)
+                    except Exception:
+                        os.unlink(f.name)
+                        raise
+                sha256 = h.hexdigest()
+                path = blob_path(sha256, root)
+                path.parent.mkdir(exist_ok=True)
+                os.replace(f.name, path)
+                return FetchedImage(url, 200, sha256, r.headers.get('Content-Type'), size, path=str(path),
+                                    **validators)
+
+            chunks = []
+            for chunk in r.iter_content(CHUNK_SIZE):
+                h.update(chunk)
+                size += len(chunk)
+                chunks.append(chunk)
+            return FetchedImage(url, 200, h.hexdigest(), r.headers.get('Content-Type'), size, b''.join(chunks),
+                                **validators)
+    except requests.RequestException as e:
+        LOGGER.warning('Image not fetched %s: %s', url, e)
+        return FetchedImage(url, 0)
+
+
+def get_urls_to_fetch(conn, storage: str, refresh=False) -> t.Dict[str, t.Tuple[t.Optional[str], t.Optional[str]]]:
+    # distinct urls mapped to the validators of their last fetch
+    urls = set()
+    for table in ENTITY_TABLES:
+        query = sqlalchemy.select(table.img_url).distinct().where(table.img_url != sqlalchemy.null())
+        if storage == 'inline':
+            query = query.where(table.img == sqlalchemy.null())
+        urls.update(r[0] for r in conn.execute(query))
+
+    known = {r[0]: (r[1], r[2], r[3]) for r in conn.execute(sqlalchemy.select(
+        m.ImageSource.url, m.ImageSource.etag, m.ImageSource.last_modified, m.ImageSource.status_code))}
+    if storage == 'inline':
+        # conditional requests are no use when the bytes have to be written again
+        return {url: (None, None) for url in urls}
+    if not refresh:
+        urls = {url for url in urls if url not in known or known[url][2] != 200}
+    return {url: known.get(url, (None, None, None))[:2] for url in urls}
+
+
+def _store_batch(conn, images: t.List[FetchedImage], storage: str, stored_hashes: t.Set[str]):
+    fetched = [img for img in images if img.status_code == 200]
+    if storage == 'inline':
+        for table in ENTITY_TABLES:
+            if not fetched:
+                break
+            stmt = sqlalchemy.update(table).where(table.img_url == sqlalchemy.bindparam('url'),
+                                                  table.img == sqlalchemy.null())
+            conn.execute(stmt.values(img=sqlalchemy.bindparam('content')),
+                         [{'url': img.url, 'content': img.content} for img in fetched])
+    else:
+        blobs = {img.sha256: img for img in fetched if img.sha256 not in stored_hashes}
+        if blobs:
+            conn.execute(insert(m.ImageBlob).on_conflict_do_nothing(),
+                         [{'sha256': img.sha256, 'content_type': img.content_type, 'size': img.size,
+                           'data': img.content if storage == 'table' else None, 'path': img.path}
+                          for img in blobs.values()])
+            stored_hashes.update(blobs)
+
+    # 304s keep their blob, everything else records what happened to the url
+    sources = [img for img in images if img.status_code != 304]
+    if sources:
+        stmt = insert(m.ImageSource)
+        stmt = stmt.on_conflict_do_update(index_elements=['url'], set_={
+            'sha256': stmt.excluded.sha256, 'etag': stmt.excluded.etag,
+            'last_modified': stmt.excluded.last_modified, 'status_code': stmt.excluded.status_code,
+            'fetched_at': stmt.excluded.fetched_at})
+        now = datetime.datetime.now()
+        conn.execute(stmt, [{'url': img.url, 'sha256': img.sha256 if storage != 'inline' else None,
+                             'etag': img.etag, 'last_modified': img.last_modified, 'status_code': img.status_code,
+                             'fetched_at': now}
+                            for img in sources])
+    conn.commit()
+
+
+def fetch_images(storage: str = 'table', refresh=False, max_workers: int = 16, batch_size: int = 500,
+                 root: Path = None) -> t.Dict[int, int]:
+    if storage not in STORAGES:
+        raise ValueError(f'Unknown image storage: {storage}')
+
+    with m.engine.connect() as conn:
+        urls = get_urls_to_fetch(conn, storage, refresh=refresh)
+        stored_hashes = {r[0] for r in conn.execute(sqlalchemy.select(m.ImageBlob.sha256))} \
+            if storage != 'inline' else set()
+        LOGGER.info(f'IMAGES - fetching {len(urls)} distinct urls ({storage} storage)')
+
+        session = sessions.get_session('images', pool_size=max_workers)
+        statuses = {}
+        batch = []
+        done_n = 0
+        pending = set()
+        todo = iter(urls.items())
+        with ThreadPoolExecutor(max_workers) as executor:
+            # a bounded number of downloads in flight, so finished bodies do not pile up in memory
+            while True:
+                for url, (etag, last_modified) in itertools.islice(todo, max_workers * 4 - len(pending)):
+                    pending.add(executor.submit(fetch_image, session, url, etag, last_modified, storage, root))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    img = future.result()
+                    statuses[img.status_code] = statuses.get(img.status_code, 0) + 1
+                    if img.status_code not in (200, 304):
+                        LOGGER.warning('IMAGES - skipping %s: %s', img.url, img.status_code)
+                    batch.append(img)
+                done_n += len(done)
+                if len(batch) >= batch_size:
+                    _store_batch(conn, batch, storage, stored_hashes)
+                    batch = []
+                    LOGGER.info(f'IMAGES - {done_n}/{len(urls)}')
+            if batch:
+                _store_batch(conn, batch, storage, stored_hashes)
+
+    LOGGER.info(f'IMAGES - done, status codes: {statuses}')
+    return statuses
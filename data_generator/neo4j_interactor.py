@@ -1,34 +1,41 @@
 import os
 import csv
-import time
+import gzip
 import shutil
 import logger
 import subprocess
 import typing as t
 from pathlib import Path
-from multiprocessing import Pool
+
+import sqlalchemy
+from sqlalchemy.orm import aliased
 
 import db_interactor
 from db_interactor import model as m
+from logger import metrics
+from data_generator import executor
 
 
 LOGGER = logger.get_logger('data_generator')
 
 
-def initializer():
-    m.engine.dispose(close=False)
-
-
 def get_all_player_ids():
     with db_interactor.get_session() as session:
         query = session.query(m.Player.id)
         return [row[0] for row in query.all()]
 
 
-def generate_player_relationships(*args):
-    p_id, i, tot = args[0]
-    LOGGER.info(f'Player {i+1} of {tot}')
-    with db_interactor.get_session() as session:
+def iter_player_values(yield_per: int = 100000) -> t.Iterator[t.Tuple[int, float]]:
+    with m.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=yield_per).execute(
+            sqlalchemy.select(m.Player.id, m.Player.value))
+        for p_id, value in result:
+            yield p_id, value
+
+
+@metrics.collected
+def generate_player_relationships(p_id):
+    with db_interactor.worker_session() as session:
         player = session.query(m.Player).get(p_id)
         militancies = {player.id: {'value': player.value, 'relationships': set()}}
         for mi in player.militancy:
@@ -41,53 +48,122 @@ def generate_player_relationships(*args):
     return militancies
 
 
-def dump_csvs(data: t.Dict[str, t.Dict]):
+def get_played_with_query():
+    # same condition used by generate_player_relationships, applied to the whole militancy table at once
+    mi = aliased(m.Militancy)
+    mi2 = aliased(m.Militancy)
+    return sqlalchemy.select(mi.player_id, mi2.player_id, mi.team_id).distinct().select_from(mi).join(
+        mi2, sqlalchemy.and_(mi2.team_id == mi.team_id, mi2.start_date >= mi.start_date,
+                             mi2.end_date <= mi.end_date, mi2.player_id != mi.player_id))
+
+
+def iter_played_with(yield_per: int = 100000) -> t.Iterator[t.Tuple[int, int, int]]:
+    with m.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=yield_per).execute(get_played_with_query())
+        for p_id, p_id2, team_id in result:
+            yield p_id, p_id2, team_id
+
+
+def iter_played_with_snapshot(yield_per: int = 100000) -> t.Iterator[t.Tuple[int, int, int]]:
+    # the PlayedWith mirror taken by graph_refresh.snapshot_played_with
+    with m.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=yield_per).execute(
+            sqlalchemy.select(m.PlayedWith.player_id, m.PlayedWith.other_player_id, m.PlayedWith.team_id))
+        for p_id, p_id2, team_id in result:
+            yield p_id, p_id2, team_id
+
+
+def iter_player_relationships() -> t.Iterator[t.Tuple[int, int, int]]:
+    all_player_ids = get_all_player_ids()
+    LOGGER.info(f'Generating relationships for {len(all_player_ids)} players...')
+    pool = executor.Executor('relationships', executor.PROCESS, chunksize=100)
+    for _, d in pool.imap(generate_player_relationships, all_player_ids):
+        for p_id, r in d.items():
+            for p_id2, team_id in r['relationships']:
+                yield p_id, p_id2, team_id
+
+
+def _open_csv(path: Path, compress: bool):
+    if compress:
+        return gzip.open(path.with_name(f'{path.name}.gz'), 'wt', encoding='UTF8', newline='')
+    return open(path, 'w', encoding='UTF8', newline='')
+
+
+def check_part_size(part_size: int):
+    if part_size < 1:
+        raise ValueError('part_size must be positive')
+
+
+def write_csv_parts(rows: t.Iterable[t.Tuple], folder: Path, prefix: str, part_size: int = 100000,
+                    compress: bool = False) -> int:
+    check_part_size(part_size)
+    total = 0
+    part = 0
+    f = None
+    writer = None
+    try:
+        for row in rows:
+            if total % part_size == 0:
+                if f:
+                    f.close()
+                part += 1
+                LOGGER.info(f'{prefix} part {part} ({total} rows so far)...')
+                f = _open_csv(Path(folder, f'{prefix}-part{part}.csv'), compress)
+                writer = csv.writer(f, delimiter=",")
+            writer.writerow(row)
+            total += 1
+    finally:
+        if f:
+            f.close()
+
+    return total
+
+
+def dump_csvs(players: t.Iterable[t.Tuple[int, float]], relationships: t.Iterable[t.Tuple[int, int, int]],
+              csv_files_root: Path = None, part_size: int = 100000, compress: bool = False):
+    # checked before the previous csv files are removed
+    check_part_size(part_size)
+    csv_files_root = Path(csv_files_root or 'csv_files')
+    shutil.rmtree(csv_files_root, ignore_errors=True)
+    csv_files_root.mkdir(parents=True)
+
     # players nodes
-    shutil.rmtree('csv_files', ignore_errors=True)
-    os.mkdir('csv_files')
-    with open('csv_files/players-header.csv', 'w', encoding='UTF8') as f:
+    with open(Path(csv_files_root, 'players-header.csv'), 'w', encoding='UTF8', newline='') as f:
         writer = csv.writer(f, delimiter=",")
         writer.writerow(('playerId:ID', ':LABEL', 'value:float'))
 
     LOGGER.info(f'Players csv...')
-    with open('csv_files/players.csv', 'w', encoding='UTF8') as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerows([(p_id, 'Player', d['value']) for p_id, d in data.items()])
+    players_n = write_csv_parts(((p_id, 'Player', value) for p_id, value in players), csv_files_root, 'players',
+                                part_size=part_size, compress=compress)
 
     # relationships
-    with open('csv_files/played-with-header.csv', 'w', encoding='UTF8') as f:
+    with open(Path(csv_files_root, 'played-with-header.csv'), 'w', encoding='UTF8', newline='') as f:
         writer = csv.writer(f, delimiter=",")
         writer.writerow((':START_ID', ':END_ID', ':TYPE', 'team_id:int'))
-    relationships = []
-    for p_id, d in data.items():
-        for rp in d['relationships']:
-            p_id2, team_id = rp
-            relationships.append((p_id, p_id2, 'PLAYED_WITH', team_id))
-
-    i = 1
-    estimated = int(len(relationships) / 100000) + 1
-    LOGGER.info(f'Relationships csv...')
-    while relationships:
-        LOGGER.info(f'{i}/{estimated} (estimated)...')
-        with open(f'csv_files/played-with-part{i}.csv', 'w', encoding='UTF8') as f:
-            writer = csv.writer(f, delimiter=",")
-            writer.writerows(relationships[:100000])
-        relationships = relationships[100000:]
-        i += 1
 
+    LOGGER.info(f'Relationships csv...')
+    relationships_n = write_csv_parts(
+        ((p_id, p_id2, 'PLAYED_WITH', team_id) for p_id, p_id2, team_id in relationships), csv_files_root,
+        'played-with', part_size=part_size, compress=compress)
+    LOGGER.info(f'{players_n} players and {relationships_n} relationships written')
+
+
+def generate_relationships(set_based=True, csv_files_root: Path = None, part_size: int = 100000,
+                           compress: bool = False, from_snapshot=False):
+    check_part_size(part_size)
+    if from_snapshot:
+        LOGGER.info(f'Generating relationships (PlayedWith snapshot)...')
+        relationships = iter_played_with_snapshot()
+    elif set_based:
+        LOGGER.info(f'Generating relationships (set based)...')
+        relationships = iter_played_with()
+    else:
+        relationships = iter_player_relationships()
 
-def generate_relationships():
-    all_player_ids = get_all_player_ids()
-    all_player_ids = [(p_id, i, len(all_player_ids)) for i, p_id in enumerate(all_player_ids)]
-
-    LOGGER.info(f'Generating relationships for {len(all_player_ids)} players...')
-    with Pool(14, initializer=initializer) as p:
-        data = p.map(generate_player_relationships, all_player_ids)
-
-    LOGGER.info(f'Relationships generated')
     LOGGER.info(f'Dumping csvs...')
-    data = {p: r for d in data for p, r in d.items()}
-    dump_csvs(data)
+    dump_csvs(iter_player_values(), relationships, csv_files_root=csv_files_root, part_size=part_size,
+              compress=compress)
+    LOGGER.info(f'Relationships generated')
 
 
 def import_csv_command_line(csv_files_root=None):
@@ -102,8 +178,9 @@ def import_csv_command_line(csv_files_root=None):
     except:
         raise EnvironmentError('NEO4J_HOME env variable must be properly set')
 
-    relationships_parts = ','.join([str(f.name) for f in csv_files_root.glob('played-with-part*')])
-    cmd = f'{neo4j_home.absolute()}/bin/neo4j-admin database import full --nodes=players-header.csv,players.csv ' \
+    players_parts = ','.join(sorted([str(f.name) for f in csv_files_root.glob('players-part*')]))
+    relationships_parts = ','.join(sorted([str(f.name) for f in csv_files_root.glob('played-with-part*')]))
+    cmd = f'{neo4j_home.absolute()}/bin/neo4j-admin database import full --nodes=players-header.csv,{players_parts} ' \
           f'--relationships=played-with-header.csv,{relationships_parts} ' \
           f'neo4j --overwrite-destination --skip-bad-relationships --verbose'
 
@@ -117,10 +194,18 @@ def import_csv_command_line(csv_files_root=None):
     if stderr:
         print('ERROR')
         print(stderr)
+    return process.returncode == 0
 
 
 if __name__ == '__main__':
-    start = time.time()
-    generate_relationships()
-    import_csv_command_line()
-    print(f'Time taken: {time.time() - start}')
+    from data_generator import graph_refresh
+    metrics.start_run('neo4j_export')
+    with metrics.stage('snapshot_played_with'):
+        exported_change_id = graph_refresh.snapshot_played_with()
+    with metrics.stage('generate_relationships'):
+        generate_relationships(from_snapshot=True)
+    with metrics.stage('import_csv'):
+        imported = import_csv_command_line()
+    if imported:
+        graph_refresh.mark_exported(exported_change_id)
+    metrics.write_report()
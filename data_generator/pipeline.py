@@ -0,0 +1,56 @@
+import sys
+import typing as t
+
+import logger
+import api_client
+from logger import metrics
+from data_generator import collect_data, data_fixers, entity_values_maker
+from db_interactor import checkpoints
+
+
+LOGGER = logger.get_logger('data_generator')
+
+PIPELINE_STAGE = 'pipeline'
+STAGES = ('collect_data', 'download_images', 'fix_transfers', 'market_values')
+
+
+def run(teams_path: str = None, players_path: str = None, stages: t.Sequence[str] = STAGES, fresh=False) -> bool:
+    # every stage skips the units it already completed; when the API quota runs out the run stops cleanly and the
+    # next one starts from the same point
+    if fresh:
+        checkpoints.clear()
+    stage_funcs = {
+        'collect_data': lambda: collect_data.main(resume=True),
+        'download_images': data_fixers.download_images,
+        'fix_transfers': lambda: data_fixers.fix_transfers(resume=True),
+        'market_values': lambda: entity_values_maker.main(teams_path, players_path),
+    }
+
+    done = checkpoints.completed_units(PIPELINE_STAGE)
+    for stage in stages:
+        if stage in done:
+            LOGGER.info(f'PIPELINE - {stage} already completed')
+            continue
+        if stage == 'market_values' and not (teams_path and players_path):
+            LOGGER.warning('PIPELINE - market_values needs the transfermarkt results (teams_path, players_path)')
+            return False
+
+        LOGGER.info(f'PIPELINE - {stage}')
+        try:
+            with metrics.stage(stage):
+                stage_funcs[stage]()
+        except api_client.APILimitReached as e:
+            LOGGER.warning(f'PIPELINE - {stage} stopped before the end ({e}), run again to resume')
+            return False
+        checkpoints.mark_done(PIPELINE_STAGE, [stage])
+
+    return True
+
+
+if __name__ == '__main__':
+    metrics.start_run('pipeline')
+    try:
+        completed = run(*sys.argv[1:3])
+    finally:
+        metrics.write_report()
+    sys.exit(0 if completed else 1)
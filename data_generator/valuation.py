@@ -0,0 +1,124 @@
+import math
+import time
+import typing as t
+
+import numpy as np
+import sqlalchemy
+
+import logger
+from db_interactor import bulk, model as m
+
+
+LOGGER = logger.get_logger('market_values')
+
+MIN_SEASON_APPEARENCES = 10     # a season counts as long enough above this many appearences
+YEAR_FACTOR = 10000
+
+
+class Militancies(t.NamedTuple):
+    player_id: np.ndarray
+    team_id: np.ndarray
+    year: np.ndarray
+    appearences: np.ndarray
+
+
+class TeamMilitancies(t.NamedTuple):
+    team_id: np.ndarray
+    league_id: np.ndarray
+    year: np.ndarray
+
+
+def _arrays(conn, columns, dtypes) -> t.List[np.ndarray]:
+    rows = conn.execution_options(yield_per=100000).execute(sqlalchemy.select(*columns)).all()
+    if not rows:
+        return [np.empty(0, dtype=dtype) for dtype in dtypes]
+    return [np.array(column, dtype=dtype) for column, dtype in zip(zip(*rows), dtypes)]
+
+
+def load() -> t.Tuple[Militancies, TeamMilitancies, np.ndarray, np.ndarray]:
+    start = time.time()
+    with m.engine.connect() as conn:
+        mi = Militancies(*_arrays(conn, (m.Militancy.player_id, m.Militancy.team_id, m.Militancy.year,
+                                         sqlalchemy.func.coalesce(m.Militancy.appearences, 0)),
+                                  (np.int64, np.int64, np.int64, np.int64)))
+        tm = TeamMilitancies(*_arrays(conn, (m.TeamMilitancy.team_id, m.TeamMilitancy.league_id,
+                                             m.TeamMilitancy.year), (np.int64, np.int64, np.int64)))
+        player_ids, values = _arrays(conn, (m.Player.id, sqlalchemy.func.coalesce(m.Player.value, 0)),
+                                     (np.int64, np.float64))
+    LOGGER.info(f'Loaded {len(mi.player_id)} militancies and {len(player_ids)} players in {time.time() - start:.1f}s')
+    return mi, tm, player_ids, values
+
+
+def _group_max(keys: np.ndarray, values: np.ndarray) -> t.Tuple[np.ndarray, np.ndarray]:
+    # distinct keys and the max of values for each of them
+    unique, inverse = np.unique(keys, return_inverse=True)
+    result = np.full(len(unique), np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(result, inverse, values)
+    return unique, result
+
+
+def log_values(appearences: np.ndarray, log_base: np.ndarray) -> np.ndarray:
+    # int(math.log(appearences + 1, log_base)) for every row; results that land next to an integer are recomputed
+    # with math.log, so that truncation rounds them exactly as the scalar version does
+    values = np.log(appearences + 1.) / np.log(log_base)
+    near = np.flatnonzero(np.abs(values - np.rint(values)) < 1e-9)
+    for i in near:
+        values[i] = math.log(appearences[i] + 1, log_base[i])
+    return values.astype(np.int64)
+
+
+def compute_values(mi: Militancies, tm: TeamMilitancies, player_ids: np.ndarray, values: np.ndarray,
+                   leagues: t.Iterable[int], teams: t.Dict[int, float], players: t.Dict[int, float]) -> np.ndarray:
+    # same valuation as entity_values_maker.apply_formula_orm, on columns: returns the new value of every player
+    values = values.copy()
+    player_index = {p_id: i for i, p_id in enumerate(player_ids.tolist())}
+
+    def positions(ids: np.ndarray) -> np.ndarray:
+        return np.fromiter((player_index[p_id] for p_id in ids.tolist()), dtype=np.int64, count=len(ids))
+
+    # base value: the players of the last season of every league
+    in_leagues = np.isin(tm.league_id, np.fromiter(leagues, dtype=np.int64))
+    if in_leagues.any():
+        league_ids, last_year = _group_max(tm.league_id[in_leagues], tm.year[in_leagues])
+        tm_last_year = last_year[np.searchsorted(league_ids, tm.league_id[in_leagues])]
+        is_last = tm.year[in_leagues] == tm_last_year
+        last_seasons = tm.team_id[in_leagues][is_last] * YEAR_FACTOR + tm.year[in_leagues][is_last]
+        base_players = np.unique(mi.player_id[np.isin(mi.team_id * YEAR_FACTOR + mi.year, last_seasons)])
+        values[positions(base_players)] = 1
+
+    # valued teams: the players of the last long enough season get a log-weighted share of the team value
+    average_values = {team_id: int(team_value / 10) for team_id, team_value in teams.items()}
+    valued_teams = np.fromiter((team_id for team_id, value in average_values.items() if value > 0), dtype=np.int64)
+    in_teams = np.isin(mi.team_id, valued_teams)
+    if in_teams.any():
+        seasons, max_appearences = _group_max(mi.team_id[in_teams] * YEAR_FACTOR + mi.year[in_teams],
+                                              mi.appearences[in_teams])
+        long_enough = max_appearences > MIN_SEASON_APPEARENCES
+        _, chosen = _group_max(seasons[long_enough] // YEAR_FACTOR, seasons[long_enough])
+        chosen_max = max_appearences[long_enough][np.searchsorted(seasons[long_enough], chosen)]
+        # one base per team, in the same float arithmetic as the scalar version
+        log_bases = np.array([max_app ** (1 / average_values[season // YEAR_FACTOR])
+                              for season, max_app in zip(chosen.tolist(), chosen_max.tolist())], dtype=np.float64)
+
+        row_seasons = mi.team_id * YEAR_FACTOR + mi.year
+        rows = np.flatnonzero(np.isin(row_seasons, chosen))
+        log_base = log_bases[np.searchsorted(chosen, row_seasons[rows])]
+        np.maximum.at(values, positions(mi.player_id[rows]), log_values(mi.appearences[rows], log_base))
+
+    # scraped values
+    if players:
+        scraped_ids = np.fromiter(players, dtype=np.int64, count=len(players))
+        scraped_values = np.fromiter(players.values(), dtype=np.float64, count=len(players))
+        np.maximum.at(values, positions(scraped_ids), scraped_values)
+
+    return values
+
+
+def apply(leagues: t.Iterable[int], teams: t.Dict[int, float], players: t.Dict[int, float]) -> int:
+    mi, tm, player_ids, values = load()
+    start = time.time()
+    new_values = compute_values(mi, tm, player_ids, values, leagues, teams, players)
+    changed = np.flatnonzero(new_values != values)
+    LOGGER.info(f'{len(changed)} player values computed in {time.time() - start:.1f}s')
+    return bulk.copy_update(m.Player, zip(player_ids[changed].tolist(), new_values[changed].tolist()),
+                            ['id', 'value'])
@@ -1,18 +1,92 @@
+import threading
+
 import psycopg2
 from sqlalchemy.orm import Session
 
 from shared import db as db_utils
 
+GRAPH_CHANGES_TRIGGERS = '''
+CREATE OR REPLACE FUNCTION log_militancy_graph_change() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('graph.changelog', true) = 'off' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO graphchange (entity, player_id, team_id) VALUES ('militancy', OLD.player_id, OLD.team_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO graphchange (entity, player_id, team_id) VALUES ('militancy', NEW.player_id, NEW.team_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION log_player_graph_change() RETURNS trigger AS $$
+BEGIN
+    IF current_setting('graph.changelog', true) = 'off' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' OR NEW.value IS DISTINCT FROM OLD.value THEN
+        INSERT INTO graphchange (entity, player_id) VALUES ('player', NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER militancy_graph_change AFTER INSERT OR UPDATE OR DELETE ON militancy
+    FOR EACH ROW EXECUTE FUNCTION log_militancy_graph_change();
+CREATE OR REPLACE TRIGGER player_graph_change AFTER INSERT OR UPDATE ON player
+    FOR EACH ROW EXECUTE FUNCTION log_player_graph_change();
+'''
+
+
+_worker = threading.local()
+
 
 def get_session():
     from db_interactor import model
     return Session(model.engine)
 
 
+def worker_initializer():
+    # initializer of every process pool: the inherited engine shares its connections with the parent, they are
+    # left to it and the worker gets a small pool of its own
+    from db_interactor import engines, model
+    model.engine.dispose(close=False)
+    model.engine = engines.worker_engine()
+    _worker.session = None
+
+
+def worker_session() -> Session:
+    # one Session per process (per thread with the thread backend of data_generator.executor), reused by every task
+    # it runs: `with worker_session() as session:` closes it at the end of the task, its connection goes back to the
+    # pool and the next task checks it out again
+    from db_interactor import model
+    session = getattr(_worker, 'session', None)
+    if session is None or session.bind is not model.engine:
+        session = _worker.session = Session(model.engine)
+    return session
+
+
 def init_db():
     from db_interactor import model
-    model.metadata_obj.create_all(model.engine)
     with psycopg2.connect(db_utils.get_db_url()) as con:
         cursor = con.cursor()
         cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
         con.commit()
+    model.metadata_obj.create_all(model.engine)
+    # create_all does not add columns to existing tables: full_name is added before the indexes built on it
+    from db_interactor import migrations
+    migrations.add_player_full_name()
+    with psycopg2.connect(db_utils.get_db_url()) as con:
+        cursor = con.cursor()
+        cursor.execute(GRAPH_CHANGES_TRIGGERS)
+        con.commit()
+
+
+def ensure_indexes():
+    # create_all skips tables that already exist, so databases created before an index was declared get it here
+    from db_interactor import model
+    for table in model.metadata_obj.sorted_tables:
+        for index in table.indexes:
+            index.create(model.engine, checkfirst=True)
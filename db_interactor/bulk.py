@@ -0,0 +1,141 @@
+import io
+import csv
+import time
+import itertools
+import typing as t
+
+import logger
+from logger import metrics
+
+LOGGER = logger.get_logger('db_interactor')
+
+NULL = '\\N'
+
+
+def _to_copy_value(value):
+    if value is None:
+        return NULL
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    return value
+
+
+class _CopyReader(io.TextIOBase):
+    # file-like object for copy_expert: rows are turned into csv lines only when postgres asks for them
+    def __init__(self, rows: t.Iterable[t.Sequence]):
+        self._rows = iter(rows)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = ''
+        self.rows_n = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self, size: int):
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        for row in self._rows:
+            self._writer.writerow([_to_copy_value(v) for v in row])
+            self.rows_n += 1
+            if self._buffer.tell() >= size:
+                break
+        self._pending += self._buffer.getvalue()
+
+    def read(self, size: int = -1) -> str:
+        if size is None or size < 0:
+            size = 1 << 16
+        if len(self._pending) < size:
+            self._fill(size)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def _table_name(table) -> str:
+    return getattr(table, '__tablename__', None) or table.name
+
+
+def _primary_key(table) -> t.List[str]:
+    table = getattr(table, '__table__', table)
+    return [c.name for c in table.primary_key.columns]
+
+
+def copy_into(cursor, table_name: str, columns: t.Sequence[str], rows: t.Iterable[t.Sequence]) -> int:
+    reader = _CopyReader(rows)
+    cursor.copy_expert(f'COPY {table_name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv, NULL \'{NULL}\')',
+                       reader)
+    return reader.rows_n
+
+
+def copy_merge(table, rows: t.Iterable[t.Dict], columns: t.Sequence[str] = None,
+               conflict_columns: t.Sequence[str] = None, update_columns: t.Sequence[str] = ()) -> int:
+    # streams the rows into a temp table with COPY, then merges them into the target table with
+    # INSERT ... SELECT ... ON CONFLICT: existing rows are updated (update_columns) or left untouched
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0
+    columns = list(columns or first.keys())
+    rows = itertools.chain([first], rows)
+    table_name = _table_name(table)
+    tmp_name = f'tmp_{table_name}'
+    conflict_columns = list(conflict_columns or _primary_key(table))
+    cols = ', '.join(columns)
+
+    if update_columns:
+        assignments = ', '.join(f'{c} = EXCLUDED.{c}' for c in update_columns)
+        current = ', '.join(f'{table_name}.{c}' for c in update_columns)
+        excluded = ', '.join(f'EXCLUDED.{c}' for c in update_columns)
+        # no-op updates are skipped: they would still write a new row version and fire the triggers
+        action = f'DO UPDATE SET {assignments} WHERE ({current}) IS DISTINCT FROM ({excluded})'
+    else:
+        action = 'DO NOTHING'
+
+    return _copy_and_run(table_name, columns, ([row.get(c) for c in columns] for row in rows),
+                         f'INSERT INTO {table_name} ({cols}) '
+                         f'SELECT DISTINCT ON ({", ".join(conflict_columns)}) {cols} FROM {tmp_name} '
+                         f'ON CONFLICT ({", ".join(conflict_columns)}) {action}', 'inserted/updated')
+
+
+def copy_update(table, rows: t.Iterable[t.Sequence], columns: t.Sequence[str], key_columns: t.Sequence[str] = None
+                ) -> int:
+    # rows are tuples in the order of columns; only existing rows whose values differ are updated
+    table_name = _table_name(table)
+    tmp_name = f'tmp_{table_name}'
+    key_columns = list(key_columns or _primary_key(table))
+    update_columns = [c for c in columns if c not in key_columns]
+    assignments = ', '.join(f'{c} = {tmp_name}.{c}' for c in update_columns)
+    join = ' AND '.join(f'{table_name}.{c} = {tmp_name}.{c}' for c in key_columns)
+    current = ', '.join(f'{table_name}.{c}' for c in update_columns)
+    new = ', '.join(f'{tmp_name}.{c}' for c in update_columns)
+    return _copy_and_run(table_name, columns, rows,
+                         f'UPDATE {table_name} SET {assignments} FROM {tmp_name} '
+                         f'WHERE {join} AND ({current}) IS DISTINCT FROM ({new})', 'updated')
+
+
+def _copy_and_run(table_name: str, columns: t.Sequence[str], rows: t.Iterable[t.Sequence], statement: str,
+                  action: str) -> int:
+    from db_interactor import model as m
+
+    start = time.time()
+    raw = m.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute(f'CREATE TEMP TABLE tmp_{table_name} (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP')
+        copied = copy_into(cursor, f'tmp_{table_name}', columns, rows)
+        cursor.execute(statement)
+        affected = cursor.rowcount
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    elapsed = time.time() - start
+    metrics.observe(f'db.copy.{table_name}', elapsed)
+    metrics.incr('db.rows_copied', copied)
+    metrics.incr('db.rows_written', max(affected, 0))
+    LOGGER.info(f'{table_name} - {copied} rows copied, {affected} {action} '
+                f'({int(copied / elapsed) if elapsed else copied} rows/s)')
+    return affected
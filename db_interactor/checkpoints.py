@@ -0,0 +1,37 @@
+import typing as t
+
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import insert
+
+from db_interactor import model as m
+
+
+def completed_units(stage: str) -> t.Set[str]:
+    with m.engine.connect() as conn:
+        query = sqlalchemy.select(m.JobCheckpoint.unit).where(m.JobCheckpoint.stage == stage)
+        return {row[0] for row in conn.execute(query)}
+
+
+def is_done(stage: str, unit: str) -> bool:
+    with m.engine.connect() as conn:
+        query = sqlalchemy.select(m.JobCheckpoint.unit).where(m.JobCheckpoint.stage == stage,
+                                                              m.JobCheckpoint.unit == unit)
+        return conn.execute(query).first() is not None
+
+
+def mark_done(stage: str, units: t.Iterable[t.Any]):
+    values = [{'stage': stage, 'unit': str(unit)} for unit in units]
+    if not values:
+        return
+    with m.engine.connect() as conn:
+        conn.execute(insert(m.JobCheckpoint).on_conflict_do_nothing(), values)
+        conn.commit()
+
+
+def clear(stage: str = None):
+    with m.engine.connect() as conn:
+        stmt = sqlalchemy.delete(m.JobCheckpoint)
+        if stage is not None:
+            stmt = stmt.where(m.JobCheckpoint.stage == stage)
+        conn.execute(stmt)
+        conn.commit()
@@ -0,0 +1,70 @@
+import os
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from logger import metrics
+from shared import db as db_utils
+
+# every engine of the project comes from here. Pool workers replace the engine they inherited with a small one of
+# their own (worker_engine), so 14 workers hold 14 connections and not 14 copies of the parent pool.
+#   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE: pool of the main process
+#   DB_WORKER_POOL_SIZE, DB_WORKER_MAX_OVERFLOW: pool of every worker process
+#   DB_POOL_PRE_PING: 0 to skip the liveness check when a connection is checked out
+#   DB_STATEMENT_TIMEOUT_MS: server side statement timeout, 0 for none
+#   DB_NULL_POOL: 1 to open and close a connection per checkout, for PgBouncer in transaction mode (set the
+#   statement timeout and graph.changelog on the database role there, PgBouncer rejects startup options)
+#   GRAPH_CHANGELOG: 0 for full loads followed by a full Neo4j rebuild, the graphchange triggers then skip every row
+
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 5))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+WORKER_POOL_SIZE = int(os.getenv('DB_WORKER_POOL_SIZE', 1))
+WORKER_MAX_OVERFLOW = int(os.getenv('DB_WORKER_MAX_OVERFLOW', 1))
+PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') not in ('0', 'false', 'False')
+STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 0))
+NULL_POOL = os.getenv('DB_NULL_POOL', '0') in ('1', 'true', 'True')
+GRAPH_CHANGELOG = os.getenv('GRAPH_CHANGELOG', '1') not in ('0', 'false', 'False')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def create(url: str = None, pool_size: int = POOL_SIZE, max_overflow: int = MAX_OVERFLOW, pre_ping: bool = PRE_PING,
+           statement_timeout_ms: int = STATEMENT_TIMEOUT_MS, null_pool: bool = NULL_POOL) -> Engine:
+    connect_args = {}
+    options = []
+    if statement_timeout_ms:
+        options.append(f'-c statement_timeout={statement_timeout_ms}')
+    if not GRAPH_CHANGELOG:
+        options.append('-c graph.changelog=off')
+    if options and not null_pool:
+        connect_args['options'] = ' '.join(options)
+    if null_pool:
+        engine = create_engine(url or db_utils.get_db_url(), poolclass=NullPool, connect_args=connect_args)
+    else:
+        engine = create_engine(url or db_utils.get_db_url(), pool_size=pool_size, max_overflow=max_overflow,
+                               pool_timeout=POOL_TIMEOUT, pool_recycle=POOL_RECYCLE, pool_pre_ping=pre_ping,
+                               connect_args=connect_args)
+    instrument(engine)
+    return engine
+
+
+def worker_engine(url: str = None) -> Engine:
+    return create(url, pool_size=WORKER_POOL_SIZE, max_overflow=WORKER_MAX_OVERFLOW)
+
+
+def instrument(engine: Engine):
+    event.listen(engine, 'before_cursor_execute', _statement_started)
+    event.listen(engine, 'after_cursor_execute', _statement_done)
+
+
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_starts', []).append(time.perf_counter())
+
+
+def _statement_done(conn, cursor, statement, parameters, context, executemany):
+    metrics.observe('db.statement', time.perf_counter() - conn.info['statement_starts'].pop())
+    if statement.lstrip()[:6].upper() in WRITE_STATEMENTS:
+        metrics.incr('db.rows_written', max(cursor.rowcount, 0))
@@ -0,0 +1,81 @@
+import time
+
+import sqlalchemy
+from sqlalchemy import text
+
+import logger
+import db_interactor
+from db_interactor import model as m
+
+LOGGER = logger.get_logger('db_interactor')
+
+ENTITY_TABLES = ('league', 'team', 'player')
+BATCH_SIZE = 5000
+
+# postgres hashes the bytes itself, so the images never travel to the client
+MOVE_BLOBS = '''
+INSERT INTO imageblob (sha256, size, data)
+SELECT DISTINCT ON (h) h, length(img), img
+FROM (SELECT encode(sha256(img), 'hex') AS h, img FROM {table}
+      WHERE img IS NOT NULL AND img_url IS NOT NULL AND id >= :lo AND id < :hi) s
+ON CONFLICT (sha256) DO NOTHING
+'''
+MOVE_SOURCES = '''
+INSERT INTO imagesource (url, sha256, status_code, fetched_at)
+SELECT DISTINCT ON (img_url) img_url, encode(sha256(img), 'hex'), 200, now() FROM {table}
+WHERE img IS NOT NULL AND img_url IS NOT NULL AND id >= :lo AND id < :hi
+ON CONFLICT (url) DO NOTHING
+'''
+CLEAR_INLINE = '''
+UPDATE {table} SET img = NULL
+WHERE img IS NOT NULL AND img_url IS NOT NULL AND id >= :lo AND id < :hi
+'''
+
+
+def move_inline_images(batch_size: int = BATCH_SIZE, clear_inline=True):
+    # copies the bytes of the legacy img columns to imageblob/imagesource (one blob per distinct image) and empties
+    # the inline columns, id range by id range so that no transaction has to hold a whole table
+    start = time.time()
+    for table in ENTITY_TABLES:
+        with m.engine.connect() as conn:
+            lo, hi = conn.execute(text(f'SELECT min(id), max(id) FROM {table} WHERE img IS NOT NULL')).one()
+            if lo is None:
+                LOGGER.info(f'{table} - no inline images')
+                continue
+            blobs = cleared = 0
+            for batch_lo in range(lo, hi + 1, batch_size):
+                params = {'lo': batch_lo, 'hi': batch_lo + batch_size}
+                blobs += conn.execute(text(MOVE_BLOBS.format(table=table)), params).rowcount
+                conn.execute(text(MOVE_SOURCES.format(table=table)), params)
+                if clear_inline:
+                    cleared += conn.execute(text(CLEAR_INLINE.format(table=table)), params).rowcount
+                conn.commit()
+            left = conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(text(table)).where(
+                text('img IS NOT NULL'))).scalar()
+        LOGGER.info(f'{table} - {blobs} new blobs, {cleared} inline images cleared'
+                    f'{f", {left} left (no img_url)" if left else ""}')
+
+    if clear_inline:
+        # the emptied rows only shrink on disk once vacuumed; VACUUM cannot run inside a transaction
+        with m.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            for table in ENTITY_TABLES:
+                conn.execute(text(f'VACUUM ANALYZE {table}'))
+    LOGGER.info(f'Inline images moved in {time.time() - start:.0f}s')
+
+
+def add_player_full_name():
+    # databases created before player.full_name existed; the gin indexes it replaces cannot serve <-> ordering.
+    # Run by init_db, a no-op once the column is there
+    with m.engine.connect() as conn:
+        conn.execute(text(f'ALTER TABLE player ADD COLUMN IF NOT EXISTS full_name varchar '
+                          f'GENERATED ALWAYS AS ({m.PLAYER_FULL_NAME}) STORED'))
+        conn.execute(text('DROP INDEX IF EXISTS ix_player_full_name_trgm'))
+        conn.execute(text('DROP INDEX IF EXISTS ix_team_name_trgm'))
+        conn.commit()
+    db_interactor.ensure_indexes()
+    LOGGER.info('player.full_name in place')
+
+
+if __name__ == '__main__':
+    add_player_full_name()
+    move_inline_images()
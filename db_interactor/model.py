@@ -1,19 +1,24 @@
-from sqlalchemy import ForeignKey, String, Column, Integer, LargeBinary, Date, Float, MetaData, create_engine, \
-    PrimaryKeyConstraint
+from sqlalchemy import ForeignKey, String, Column, Integer, LargeBinary, Date, Float, MetaData, \
+    PrimaryKeyConstraint, BigInteger, DateTime, Index, Computed, func
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 
-from shared import db as db_utils
+from db_interactor import engines
 
 metadata_obj = MetaData()
 base = declarative_base(metadata=metadata_obj)
-engine = create_engine(db_utils.get_db_url())
+# replaced by db_interactor.worker_initializer in pool workers, always read it as model.engine
+engine = engines.create()
+
+# the trigram indexes need the pg_trgm extension, created by db_interactor.init_db before the tables
+PLAYER_FULL_NAME = "coalesce(name, '') || ' ' || coalesce(surname, '')"
 
 
 class TeamMilitancy(base):
     __tablename__ = 'teammilitancy'
     __table_args__ = (
         PrimaryKeyConstraint('team_id', 'league_id', 'year'),
+        Index('ix_teammilitancy_league_id', 'league_id'),
     )
     team_id = Column(Integer, ForeignKey('team.id'))
     league_id = Column(Integer, ForeignKey('league.id'))
@@ -22,18 +27,28 @@ class TeamMilitancy(base):
 
 class Team(base):
     __tablename__ = 'team'
+    __table_args__ = (
+        Index('ix_team_name', 'name'),
+        # gist rather than gin: it also serves the <-> nearest-neighbour ordering
+        Index('ix_team_name_gist', 'name', postgresql_using='gist', postgresql_ops={'name': 'gist_trgm_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
-    img = Column(LargeBinary)
+    # legacy inline bytes, see db_interactor.migrations.move_inline_images; images now live in imageblob
+    img = deferred(Column(LargeBinary))
     img_url = Column(String)
     militancy = relationship(TeamMilitancy, backref='team')
+    image = relationship('ImageSource', primaryjoin='foreign(Team.img_url) == ImageSource.url', viewonly=True,
+                         uselist=False)
 
 
 class Militancy(base):
     __tablename__ = 'militancy'
     __table_args__ = (
         PrimaryKeyConstraint('player_id', 'team_id', 'year'),
+        # teammates lookups (team and period) and scans of a team; player lookups use the primary key
+        Index('ix_militancy_team_dates', 'team_id', 'start_date', 'end_date'),
     )
 
     player_id = Column(Integer, ForeignKey('player.id'))
@@ -47,25 +62,41 @@ class Militancy(base):
 
 class Player(base):
     __tablename__ = 'player'
+    __table_args__ = (
+        Index('ix_player_full_name_gist', 'full_name', postgresql_using='gist',
+              postgresql_ops={'full_name': 'gist_trgm_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     surname = Column(String)
-    img = Column(LargeBinary)
+    full_name = Column(String, Computed(PLAYER_FULL_NAME, persisted=True))
+    # legacy inline bytes, see db_interactor.migrations.move_inline_images; images now live in imageblob
+    img = deferred(Column(LargeBinary))
     img_url = Column(String)
     value = Column(Float, default=0)
     militancy = relationship(Militancy, backref='player')
+    image = relationship('ImageSource', primaryjoin='foreign(Player.img_url) == ImageSource.url', viewonly=True,
+                         uselist=False)
 
 
 class League(base):
     __tablename__ = 'league'
+    __table_args__ = (
+        Index('ix_league_display_name', 'display_name'),
+        Index('ix_league_display_name_trgm', 'display_name', postgresql_using='gin',
+              postgresql_ops={'display_name': 'gin_trgm_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     display_name = Column(String)
-    img = Column(LargeBinary)
+    # legacy inline bytes, see db_interactor.migrations.move_inline_images; images now live in imageblob
+    img = deferred(Column(LargeBinary))
     img_url = Column(String)
     country_code = Column(String)
     militancy = relationship(TeamMilitancy, backref='league')
+    image = relationship('ImageSource', primaryjoin='foreign(League.img_url) == ImageSource.url', viewonly=True,
+                         uselist=False)
 
 
 class LeagueSeasons(base):
@@ -78,3 +109,70 @@ class LeagueSeasons(base):
     year = Column(Integer)
     start_date = Column(Date, default=None)
     end_date = Column(Date, default=None)
+
+
+class GraphChange(base):
+    # filled by the triggers created in db_interactor.init_db, consumed by data_generator.graph_refresh
+    __tablename__ = 'graphchange'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    entity = Column(String)
+    player_id = Column(Integer)
+    team_id = Column(Integer, default=None)
+    changed_at = Column(DateTime, server_default=func.now())
+
+
+class PlayedWith(base):
+    # mirror of the PLAYED_WITH relationships last exported to Neo4j
+    __tablename__ = 'playedwith'
+    __table_args__ = (
+        PrimaryKeyConstraint('player_id', 'other_player_id', 'team_id'),
+    )
+
+    player_id = Column(Integer)
+    other_player_id = Column(Integer)
+    team_id = Column(Integer)
+
+
+class ExportWatermark(base):
+    __tablename__ = 'exportwatermark'
+
+    name = Column(String, primary_key=True)
+    change_id = Column(BigInteger, default=0)
+    exported_at = Column(DateTime, default=None)
+
+
+class JobCheckpoint(base):
+    # units of work already completed by a pipeline stage, see db_interactor.checkpoints
+    __tablename__ = 'jobcheckpoint'
+    __table_args__ = (
+        PrimaryKeyConstraint('stage', 'unit'),
+    )
+
+    stage = Column(String)
+    unit = Column(String)
+    completed_at = Column(DateTime, server_default=func.now())
+
+
+class ImageBlob(base):
+    # content addressed: every distinct image is stored once, either in data or as a file at path
+    __tablename__ = 'imageblob'
+
+    sha256 = Column(String, primary_key=True)
+    content_type = Column(String)
+    size = Column(Integer)
+    data = deferred(Column(LargeBinary, default=None))
+    path = Column(String, default=None)
+
+
+class ImageSource(base):
+    # one row per downloaded img_url, with the validators needed for conditional re-fetches
+    __tablename__ = 'imagesource'
+
+    url = Column(String, primary_key=True)
+    sha256 = Column(String, ForeignKey('imageblob.sha256'), default=None)
+    etag = Column(String, default=None)
+    last_modified = Column(String, default=None)
+    status_code = Column(Integer)
+    fetched_at = Column(DateTime, server_default=func.now())
+    blob = relationship(ImageBlob)
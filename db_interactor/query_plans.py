@@ -0,0 +1,114 @@
+import sys
+import datetime
+import typing as t
+
+import sqlalchemy
+from sqlalchemy import text
+
+import logger
+from db_interactor import model as m
+
+LOGGER = logger.get_logger('db_interactor')
+
+# the queries the pipeline runs in its hot loops, with the indexes each table has to be reached through
+HOT_QUERIES = {
+    'teammates': (sqlalchemy.select(m.Militancy.player_id, m.Militancy.team_id).where(
+        m.Militancy.team_id == 1, m.Militancy.start_date >= datetime.date(2020, 7, 1),
+        m.Militancy.end_date <= datetime.date(2021, 6, 30), m.Militancy.player_id != 1),
+        {'militancy': ('ix_militancy_team_dates',)}),
+    'player_militancies': (sqlalchemy.select(m.Militancy).where(m.Militancy.player_id == 1),
+                           {'militancy': ('militancy_pkey',)}),
+    'team_season_players': (sqlalchemy.select(m.Militancy.player_id).where(m.Militancy.team_id == 1,
+                                                                           m.Militancy.year == 2020),
+                            {'militancy': ('ix_militancy_team_dates',)}),
+    'team_by_name': (sqlalchemy.select(m.Team.id).where(m.Team.name == 'Juventus'), {'team': ('ix_team_name',)}),
+    'league_by_name': (sqlalchemy.select(m.League.id).where(m.League.display_name == 'Serie A'),
+                       {'league': ('ix_league_display_name',)}),
+    'league_teams': (sqlalchemy.select(m.TeamMilitancy).where(m.TeamMilitancy.league_id == 1),
+                     {'teammilitancy': ('ix_teammilitancy_league_id',)}),
+    'player_candidates': (sqlalchemy.select(m.Player.id).where(m.Player.full_name.op('%')('Lionel Messi')).order_by(
+        m.Player.full_name.op('<->')('Lionel Messi')).limit(10), {'player': ('ix_player_full_name_gist',)}),
+    'team_candidates': (sqlalchemy.select(m.Team.id).where(m.Team.name.op('%')('Juventus')).order_by(
+        m.Team.name.op('<->')('Juventus')).limit(5), {'team': ('ix_team_name_gist',)}),
+}
+
+
+# a minimal dataset, in a transaction rolled back once the plans are read: the planner gets statistics of the same
+# shape whatever the database holds. Ids start far above any real one, the changelog triggers are switched off
+SEED_ID_BASE = 2000000000
+SEED = (
+    "SET LOCAL graph.changelog = 'off'",
+    "INSERT INTO league (id, display_name) SELECT :base + g, 'league ' || g FROM generate_series(1, 50) g",
+    "INSERT INTO team (id, name) SELECT :base + g, 'team ' || g FROM generate_series(1, 2000) g",
+    "INSERT INTO player (id, name, surname, value) "
+    "SELECT :base + g, 'name ' || g, 'surname ' || (g % 5000), 0 FROM generate_series(1, 20000) g",
+    "INSERT INTO militancy (player_id, team_id, year, start_date, end_date, appearences) "
+    "SELECT :base + g, :base + 1 + g % 2000, y, make_date(y, 7, 1), make_date(y + 1, 6, 30), g % 38 "
+    "FROM generate_series(1, 20000) g, generate_series(2020, 2022) y",
+    "INSERT INTO teammilitancy (team_id, league_id, year) "
+    "SELECT :base + g, :base + 1 + g % 50, y FROM generate_series(1, 2000) g, generate_series(2020, 2022) y",
+    'ANALYZE league, team, player, militancy, teammilitancy',
+)
+
+
+def _bitmap_indexes(plan: t.Dict) -> t.Iterator[str]:
+    if plan.get('Node Type') == 'Bitmap Index Scan':
+        yield plan['Index Name']
+    for child in plan.get('Plans', []):
+        yield from _bitmap_indexes(child)
+
+
+def _scans(plan: t.Dict) -> t.Iterator[t.Tuple[str, t.Optional[str]]]:
+    # (table, index) for every table read by the plan, index None for sequential scans
+    node_type = plan.get('Node Type')
+    if node_type == 'Seq Scan':
+        yield plan['Relation Name'], None
+    elif node_type in ('Index Scan', 'Index Only Scan'):
+        yield plan['Relation Name'], plan['Index Name']
+    elif node_type == 'Bitmap Heap Scan':
+        for index in _bitmap_indexes(plan):
+            yield plan['Relation Name'], index
+        return
+    for child in plan.get('Plans', []):
+        yield from _scans(child)
+
+
+def explain(conn, query) -> t.Dict:
+    compiled = query.compile(m.engine)
+    return conn.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()[0]['Plan']
+
+
+def check_plans(queries: t.Dict = None) -> t.Dict[str, str]:
+    # on top of the seeded statistics seq scans are disabled, so the planner only falls back to one (or to a loosely
+    # matching index) when the expected index is missing or unusable
+    failures = {}
+    with m.engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            for statement in SEED:
+                conn.execute(text(statement), {'base': SEED_ID_BASE})
+            conn.execute(text('SET LOCAL enable_seqscan = off'))
+            for name, (query, tables) in (queries or HOT_QUERIES).items():
+                try:
+                    with conn.begin_nested():
+                        scans = list(_scans(explain(conn, query)))
+                except sqlalchemy.exc.DBAPIError as e:
+                    failures[name] = f'explain failed: {e.orig}'
+                    LOGGER.error(f'{name} - {failures[name]}')
+                    continue
+                wrong = [f'{table} via {index or "sequential scan"}' for table, index in scans
+                         if table in tables and index not in tables[table]]
+                if wrong:
+                    failures[name] = ', '.join(wrong)
+                    LOGGER.error(f'{name} - {failures[name]}')
+                else:
+                    LOGGER.info(f'{name} - ok')
+        finally:
+            transaction.rollback()
+    return failures
+
+
+if __name__ == '__main__':
+    plan_failures = check_plans()
+    LOGGER.info(f'{len(HOT_QUERIES) - len(plan_failures)} of {len(HOT_QUERIES)} hot queries use their indexes')
+    sys.exit(1 if plan_failures else 0)
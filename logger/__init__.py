@@ -1,6 +1,97 @@
+import os
+import sys
+import json
+import time
+import atexit
 import logging
+import datetime
+import threading
+import multiprocessing
+import logging.handlers
+
+# every logger shares one handler. In queue mode (the default) it only puts records on a pipe and a listener thread
+# of the process that imported this module first writes them, so forked pool workers never interleave their output;
+# processes started with spawn get their own listener.
+#   LOG_LEVEL: DEBUG, INFO, WARNING, ...
+#   LOG_FORMAT: text or json (one object per line)
+#   LOG_QUEUE: 0 to write from every process directly
+#   LOG_PROGRESS_INTERVAL: seconds between two messages of the same Progress
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE = os.getenv('LOG_QUEUE', '1') not in ('0', 'false', 'False')
+PROGRESS_INTERVAL = float(os.getenv('LOG_PROGRESS_INTERVAL', 10))
+TEXT_FORMAT = '%(name)s - %(levelname)s - %(message)s - LINE: %(lineno)d'
 
 _logs = {}
+_handler = None
+_listener = None
+_listener_pid = None
+_lock = threading.Lock()
+
+# attributes every LogRecord has, anything else was passed through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _PipeQueueHandler(logging.handlers.QueueHandler):
+    # a SimpleQueue writes to the pipe right away: no feeder thread whose records die with a terminated worker
+    def enqueue(self, record: logging.LogRecord):
+        self.queue.put(record)
+
+
+class _PipeQueueListener(logging.handlers.QueueListener):
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        return self.queue.get()
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def _stream_handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def _get_handler() -> logging.Handler:
+    global _handler, _listener, _listener_pid
+    with _lock:
+        if _handler is None:
+            if LOG_QUEUE:
+                queue = multiprocessing.SimpleQueue()
+                _listener = _PipeQueueListener(queue, _stream_handler(), respect_handler_level=False)
+                _listener.start()
+                _listener_pid = os.getpid()
+                atexit.register(stop_listener)
+                _handler = _PipeQueueHandler(queue)
+            else:
+                _handler = _stream_handler()
+        return _handler
+
+
+def stop_listener():
+    # writes what is still queued, runs at exit; forked workers share the queue but not the listener
+    global _listener
+    if _listener is None or _listener_pid != os.getpid():
+        return
+    listener, _listener = _listener, None
+    listener.stop()
 
 
 def get_logger(logger_name: str):
@@ -8,12 +99,34 @@ def get_logger(logger_name: str):
     if _logs.get(logger_name):
         return _logs.get(logger_name)
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.INFO)
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-
-    formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s - LINE: %(lineno)d')
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    logger.addHandler(_get_handler())
     _logs[logger_name] = logger
     return logger
+
+
+class Progress:
+    # "<message> i of total" at most once every interval seconds, and always for the last step; steps can be
+    # counted from several threads
+    def __init__(self, logger: logging.Logger, message: str, total: int = None, interval: float = None):
+        self._logger = logger
+        self._message = message
+        self._total = total
+        self._interval = PROGRESS_INTERVAL if interval is None else interval
+        self._done = 0
+        self._last = 0.
+        self._lock = threading.Lock()
+
+    def step(self, n: int = 1):
+        with self._lock:
+            self._done += n
+            now = time.monotonic()
+            if now - self._last < self._interval and self._done != self._total:
+                return
+            self._last = now
+            done = self._done
+        if self._total:
+            self._logger.info('%s %d of %d', self._message, done, self._total, stacklevel=2)
+        else:
+            self._logger.info('%s %d', self._message, done, stacklevel=2)
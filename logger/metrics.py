@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import atexit
+import datetime
+import tempfile
+import functools
+import threading
+import contextlib
+import typing as t
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:     # not on windows
+    resource = None
+
+import logger
+
+# counters and timers live in memory in every process; processes other than the one that started the run spool
+# theirs to files in the run folder (the folder is passed down through the environment), and write_report merges
+# everything into one json report
+
+LOGGER = logger.get_logger('metrics')
+
+METRICS_FOLDER = Path(os.getenv('METRICS_FOLDER', '.metrics'))
+RUN_DIR_ENV = 'METRICS_RUN_DIR'
+PROFILE_ENV = 'METRICS_PROFILE'
+SPOOL_FOLDER = 'spool'
+FLUSH_INTERVAL = 1.
+
+_lock = threading.RLock()
+_counters: t.Dict[str, float] = {}
+_timers: t.Dict[str, t.List[float]] = {}     # name: [count, total seconds, max seconds]
+_stages: t.List[t.Dict] = []
+_last_flush = 0.
+_run_started_at = None
+
+
+def incr(name: str, n: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+    _maybe_flush()
+
+
+def observe(name: str, seconds: float):
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+    _maybe_flush()
+
+
+@contextlib.contextmanager
+def timer(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collected(func):
+    # for functions run by pool workers: their metrics are spooled when the task ends, as pools terminate their
+    # workers without running any exit hook
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
+
+
+def _children_cpu() -> float:
+    if resource is None:
+        return 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextlib.contextmanager
+def _profiler(name: str, kind: t.Optional[str]):
+    run_dir = get_run_dir()
+    if not kind or run_dir is None:
+        yield
+        return
+    if kind == 'pyinstrument':
+        try:
+            import pyinstrument
+        except ImportError:
+            LOGGER.warning('pyinstrument is not installed, falling back to cProfile')
+            kind = 'cprofile'
+        else:
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+            try:
+                yield
+            finally:
+                profiler.stop()
+                Path(run_dir, f'{name}.html').write_text(profiler.output_html())
+            return
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(Path(run_dir, f'{name}.prof'))
+
+
+@contextlib.contextmanager
+def stage(name: str, profile: str = None):
+    # wall and cpu time of a pipeline stage; cpu time includes the pool workers that ended within the stage.
+    # profile: 'cprofile' or 'pyinstrument' (METRICS_PROFILE env var), written to the run folder
+    record = {'name': name, 'started_at': datetime.datetime.now().isoformat(), 'status': 'running'}
+    wall, cpu, children_cpu = time.perf_counter(), time.process_time(), _children_cpu()
+    try:
+        with _profiler(name, profile or os.getenv(PROFILE_ENV)):
+            yield record
+        record['status'] = 'completed'
+    except BaseException as e:
+        record['status'] = f'failed: {type(e).__name__}'
+        raise
+    finally:
+        record['wall_s'] = round(time.perf_counter() - wall, 3)
+        record['cpu_s'] = round(time.process_time() - cpu, 3)
+        record['children_cpu_s'] = round(_children_cpu() - children_cpu, 3)
+        with _lock:
+            _stages.append(record)
+        LOGGER.info(f'{name} {record["status"]} - wall {record["wall_s"]:.1f}s, cpu {record["cpu_s"]:.1f}s, '
+                    f'workers cpu {record["children_cpu_s"]:.1f}s')
+
+
+def get_run_dir() -> t.Optional[Path]:
+    run_dir = os.getenv(RUN_DIR_ENV)
+    return Path(run_dir) if run_dir else None
+
+
+def start_run(name: str = 'run') -> Path:
+    # must happen before any pool is created, workers find the run folder in their environment
+    global _run_started_at
+    _run_started_at = datetime.datetime.now()
+    run_dir = Path(METRICS_FOLDER, f'{name}_{_run_started_at.strftime("%m_%d_%Y__%H_%M_%S")}')
+    Path(run_dir, SPOOL_FOLDER).mkdir(parents=True, exist_ok=True)
+    os.environ[RUN_DIR_ENV] = str(run_dir.absolute())
+    os.environ[f'{RUN_DIR_ENV}_OWNER'] = str(os.getpid())
+    return run_dir
+
+
+def _is_owner() -> bool:
+    return os.getenv(f'{RUN_DIR_ENV}_OWNER') == str(os.getpid())
+
+
+def snapshot() -> t.Dict:
+    with _lock:
+        return {'counters': dict(_counters), 'timers': {k: list(v) for k, v in _timers.items()},
+                'stages': list(_stages)}
+
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    # a full snapshot of this process, so the spool file can simply be replaced
+    global _last_flush
+    _last_flush = time.monotonic()
+    run_dir = get_run_dir()
+    if run_dir is None or _is_owner():
+        return
+    spool = Path(run_dir, SPOOL_FOLDER)
+    with tempfile.NamedTemporaryFile('w', dir=spool, delete=False) as f:
+        json.dump(snapshot(), f)
+    os.replace(f.name, Path(spool, f'{os.getpid()}.json'))
+
+
+def _merge(into: t.Dict, other: t.Dict):
+    for name, value in other['counters'].items():
+        into['counters'][name] = into['counters'].get(name, 0) + value
+    for name, (count, total, longest) in other['timers'].items():
+        timer = into['timers'].setdefault(name, [0, 0., 0.])
+        timer[0] += count
+        timer[1] += total
+        timer[2] = max(timer[2], longest)
+    into['stages'].extend(other['stages'])
+
+
+def collect() -> t.Dict:
+    merged = snapshot()
+    processes = 1
+    run_dir = get_run_dir()
+    if run_dir is not None:
+        for path in Path(run_dir, SPOOL_FOLDER).glob('*.json'):
+            with open(path, 'r') as f:
+                _merge(merged, json.load(f))
+            processes += 1
+    merged['processes'] = processes
+    return merged
+
+
+def write_report(path: Path = None) -> t.Optional[Path]:
+    run_dir = get_run_dir()
+    if path is None and run_dir is None:
+        return None
+    merged = collect()
+    report = {
+        'started_at': _run_started_at.isoformat() if _run_started_at else None,
+        'finished_at': datetime.datetime.now().isoformat(),
+        'processes': merged['processes'],
+        'stages': merged['stages'],
+        'counters': dict(sorted(merged['counters'].items())),
+        'timers': {name: {'count': count, 'total_s': round(total, 3), 'mean_ms': round(total / count * 1000, 3),
+                          'max_ms': round(longest * 1000, 3)}
+                   for name, (count, total, longest) in sorted(merged['timers'].items())},
+    }
+    path = path or Path(run_dir, 'report.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=4)
+    LOGGER.info(f'Run report written to {path}')
+    return path
+
+
+def _reset():
+    # forked workers start from an empty registry, the parent's numbers are already counted
+    global _last_flush
+    _counters.clear()
+    _timers.clear()
+    _stages.clear()
+    _last_flush = time.monotonic()
+
+
+atexit.register(flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
@@ -0,0 +1,74 @@
+import os
+
+# the tests own their database, emptied before every test that uses it; read when the modules below are imported
+os.environ['DB_NAME'] = os.getenv('TEST_DB_NAME', 'football_test')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import psycopg2     # noqa: E402
+import pytest       # noqa: E402
+import sqlalchemy   # noqa: E402
+from sqlalchemy.schema import CreateIndex, CreateTable    # noqa: E402
+
+from shared import db as db_utils   # noqa: E402
+
+
+def _needs_trgm(index: sqlalchemy.Index) -> bool:
+    ops = index.dialect_options['postgresql'].get('ops') or {}
+    return any('trgm' in op for op in ops.values())
+
+
+def _ensure_database():
+    db_name = os.environ['DB_NAME']
+    con = psycopg2.connect(db_utils.get_db_url().rsplit('/', 1)[0] + '/postgres', connect_timeout=3)
+    try:
+        # CREATE DATABASE cannot run in a transaction
+        con.autocommit = True
+        cursor = con.cursor()
+        cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', (db_name,))
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE DATABASE {db_name}')
+    finally:
+        con.close()
+
+
+@pytest.fixture(scope='session')
+def database() -> bool:
+    # the schema of db_interactor.init_db; the trigram indexes are left out when the server has no pg_trgm.
+    # Returns whether pg_trgm is there
+    try:
+        _ensure_database()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f'no Postgres to test against: {e}')
+
+    import db_interactor
+    from db_interactor import model as m
+    with m.engine.begin() as conn:
+        has_trgm = conn.execute(sqlalchemy.text(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is not None
+        if has_trgm:
+            conn.execute(sqlalchemy.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    m.metadata_obj.drop_all(m.engine)
+    with m.engine.begin() as conn:
+        for table in m.metadata_obj.sorted_tables:
+            conn.execute(CreateTable(table))
+            for index in table.indexes:
+                if has_trgm or not _needs_trgm(index):
+                    conn.execute(CreateIndex(index))
+        conn.execute(sqlalchemy.text(db_interactor.GRAPH_CHANGES_TRIGGERS))
+    return has_trgm
+
+
+@pytest.fixture()
+def db(database) -> bool:
+    from db_interactor import model as m
+    tables = ', '.join(table.name for table in m.metadata_obj.sorted_tables)
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.text(f'TRUNCATE {tables} RESTART IDENTITY CASCADE'))
+    return database
+
+
+@pytest.fixture()
+def trgm_db(db) -> bool:
+    if not db:
+        pytest.skip('the Postgres server has no pg_trgm')
+    return db
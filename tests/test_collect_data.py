@@ -0,0 +1,72 @@
+import datetime
+import typing as t
+
+import sqlalchemy
+
+from api_client import fetch_engine
+from data_generator import collect_data
+from db_interactor import checkpoints, model as m
+
+SEASON = {'league_id': 39, 'year': 2022, 'start_date': datetime.date(2022, 8, 1),
+          'end_date': datetime.date(2023, 5, 31)}
+
+
+class PagedClient:
+    # 3 pages of one row per request; the pages in failing come back as failed requests
+    def __init__(self, failing: t.Set = frozenset()):
+        self.failing = failing
+
+    def send_request(self, partial_url, params=None):
+        key, page = params['key'], params['page']
+        if (key, page) in self.failing:
+            return None
+        return {'paging': {'current': page, 'total': 3}, 'response': [f'{key}{page}']}
+
+
+def player(p_id: int, team_id: int) -> t.Dict:
+    return {'player': {'id': p_id, 'firstname': 'Name', 'lastname': str(p_id), 'photo': None},
+            'statistics': [{'team': {'id': team_id, 'name': f'team {team_id}', 'logo': None},
+                            'league': {'id': SEASON['league_id']}, 'games': {'appearences': 10}}]}
+
+
+def test_a_request_with_a_failed_page_is_yielded_as_none():
+    engine = fetch_engine.FetchEngine(client=PagedClient(failing={('a', 2)}), max_workers=2,
+                                      rate_limiter=fetch_engine.TokenBucket(60000))
+    results = dict(engine.iter_paginated((key, 'players', {'key': key}) for key in ('a', 'b')))
+    assert results == {'a': None, 'b': ['b1', 'b2', 'b3']}
+
+
+def test_only_complete_league_seasons_are_checkpointed(db):
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.insert(m.League), [{'id': SEASON['league_id'], 'display_name': 'Premier League'}])
+    batches = [((39, 2022), collect_data.process_players_batch([player(1, 10), player(2, 10)], SEASON)),
+               ((39, 2023), None)]
+    stored = collect_data.store_batches(batches)
+
+    assert stored['batches'] == 1 and stored['incomplete'] == 1
+    assert checkpoints.completed_units(collect_data.LEAGUE_SEASONS_STAGE) == {'39:2022'}
+
+
+
+class LeaguesClient:
+    # the leagues endpoint has no paging: a page param is an error, as are the teams in failing
+    def __init__(self, failing: t.Set = frozenset()):
+        self.failing = failing
+        self.params = []
+
+    def get_clean_response(self, partial_url, params=None):
+        self.params.append(params)
+        if 'page' in params or params['team'] in self.failing:
+            return None
+        return [{'league': {'id': 39, 'type': 'League'}, 'seasons': [{'year': SEASON['year']}]}]
+
+
+def test_team_leagues_are_requested_once_without_a_page(monkeypatch):
+    client = LeaguesClient(failing={2})
+    engine = fetch_engine.FetchEngine(client=client, max_workers=2, rate_limiter=fetch_engine.TokenBucket(60000))
+    monkeypatch.setattr(fetch_engine, 'FetchEngine', lambda: engine)
+    results = dict(collect_data.fetch_team_leagues([1, 2, 3]))
+
+    assert sorted(client.params, key=lambda p: p['team']) == [{'team': 1}, {'team': 2}, {'team': 3}]
+    assert results[2] is None
+    assert [tm['team_id'] for tm in results[1]] == [1] and [tm['team_id'] for tm in results[3]] == [3]
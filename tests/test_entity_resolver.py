@@ -0,0 +1,93 @@
+import datetime
+
+import pytest
+import sqlalchemy
+from fuzzywuzzy import fuzz
+
+from db_interactor import model as m
+from data_generator import entity_resolver, entity_values_maker
+
+LEAGUES = ((1, 'Premier League'), (2, 'La Liga'), (3, 'Serie A'))
+TEAMS = ((10, 'Real Madrid'), (11, 'Barcelona'), (12, 'Manchester United'), (13, 'Juventus'))
+TEAM_LEAGUES = ((10, 2), (11, 2), (12, 1), (13, 3))
+PLAYERS = ((1, 'Vinicius', 'Junior'), (2, 'Neymar', 'Jr'), (3, 'Cristiano', 'Ronaldo'), (4, 'Paulo', 'Dybala'),
+           (5, 'Marcus', 'Rashford'), (6, 'José', 'Gayà'))
+# (player_id, team_id, year, appearences)
+MILITANCIES = ((1, 10, 2022, 30), (2, 11, 2022, 25), (3, 12, 2021, 20), (3, 13, 2022, 33), (4, 13, 2022, 28),
+               (5, 12, 2022, 35), (6, 11, 2022, 12))
+
+# as read from the transfermarkt results
+TEAM_VALUES = ({'team': 'Real Madrid', 'league': 'LaLiga', 'value': 1000},
+               {'team': 'Juventus FC', 'league': 'Serie A', 'value': 600},
+               {'team': 'Man Utd', 'league': 'Premier League', 'value': 800},
+               {'team': 'Olympique Lyon', 'league': 'Ligue 1', 'value': 300})
+# 'Vini Jr.' only shares the 'jr' word with Neymar, but trigrams with Vinicius Junior too
+PLAYER_VALUES = ({'player': 'Vini Jr.', 'team': 'Real Madrid', 'value': 150},
+                 {'player': 'Cristiano Ronaldo', 'team': 'Juventus', 'value': 40},
+                 {'player': 'Neymar', 'team': 'Barcelona', 'value': 90},
+                 {'player': 'Jose Gaya', 'team': 'FC Barcelona', 'value': 20},
+                 {'player': 'Rashford', 'team': 'Manchester United', 'value': 70},
+                 {'player': 'Nobody', 'team': 'Nowhere', 'value': 1})
+
+PAIRS = (('Manchester United', 'Man Utd'), ('Juventus', 'Juventus FC'), ('La Liga', 'LaLiga'),
+         ('Real Madrid', 'Madrid'), ('Neymar Jr', 'Vini Jr.'), ('Barcelona', 'FC Barcelona'),
+         ('Premier League', 'Premier Liga'), ('Vinicius Junior', 'Vinicius Jr'), ('Serie A', 'Serie B'))
+
+
+def seed():
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.insert(m.League), [{'id': i, 'display_name': n} for i, n in LEAGUES])
+        conn.execute(sqlalchemy.insert(m.Team), [{'id': i, 'name': n} for i, n in TEAMS])
+        conn.execute(sqlalchemy.insert(m.TeamMilitancy), [{'team_id': team_id, 'league_id': league_id, 'year': 2022}
+                                                          for team_id, league_id in TEAM_LEAGUES])
+        conn.execute(sqlalchemy.insert(m.Player), [{'id': i, 'name': n, 'surname': s, 'value': 0}
+                                                   for i, n, s in PLAYERS])
+        conn.execute(sqlalchemy.insert(m.Militancy), [
+            {'player_id': p_id, 'team_id': team_id, 'year': year, 'start_date': datetime.date(year, 7, 1),
+             'end_date': datetime.date(year + 1, 6, 30), 'appearences': appearences}
+            for p_id, team_id, year, appearences in MILITANCIES])
+
+
+def test_batch_resolution_matches_the_sql_lookups(trgm_db):
+    seed()
+    expected_teams = [entity_values_maker.process_team(team) for team in TEAM_VALUES]
+    expected_players = [entity_values_maker.process_player(player) for player in PLAYER_VALUES]
+
+    resolver = entity_resolver.EntityResolver(entity_values_maker.SIMILARITY_FLOOR,
+                                              entity_values_maker.PLAYER_CANDIDATES,
+                                              entity_values_maker.TEAM_CANDIDATES).load()
+    teams = entity_values_maker.resolve_teams(list(TEAM_VALUES), resolver)
+    players = entity_values_maker.resolve_players(list(PLAYER_VALUES), resolver)
+    assert teams == expected_teams
+    assert players == expected_players
+    assert players[0]['player']['id'] == 1
+
+
+@pytest.mark.parametrize('choice, query', PAIRS)
+def test_scores_are_the_fuzzywuzzy_ones_from_the_threshold(choice, query):
+    expected = fuzz.partial_ratio(choice, query)
+    score = entity_resolver.ScoreMatrix([query], [choice], workers=1).score(query, choice)
+    exact = entity_resolver.exact_scores(query, [choice],
+                                         entity_resolver.rapidfuzz_bounds([query], [choice], workers=1)[0])[0]
+    if expected >= entity_resolver.SIMILARITY_THRESHOLD:
+        assert score == exact == expected
+    else:
+        assert score < entity_resolver.SIMILARITY_THRESHOLD and exact < entity_resolver.SIMILARITY_THRESHOLD
+
+
+def test_find_ids_drops_duplicates_of_streamed_rows(db, monkeypatch, tmp_path):
+    seed()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(entity_values_maker, 'MATCH_CHUNK', 2)
+    read = []
+
+    def stream(rows):
+        for row in rows:
+            read.append(row)
+            yield row
+
+    teams, players = entity_values_maker.find_ids(stream(TEAM_VALUES + TEAM_VALUES[:1]),
+                                                  stream(PLAYER_VALUES[1:3] * 2))
+    assert len(read) == len(TEAM_VALUES) + 1 + 4
+    assert [team['team']['id'] for team in teams] == [10, 13]
+    assert [player['player']['id'] for player in players] == [3, 2]
@@ -0,0 +1,34 @@
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from db_interactor import model as m
+from data_generator import entity_values_maker
+
+CURRENT_FLOOR = sqlalchemy.text("SELECT current_setting('pg_trgm.similarity_threshold', true)")
+
+
+def test_similarity_floor_does_not_outlive_the_lookup(database):
+    with m.engine.connect() as conn:
+        # the pg_trgm default, also when the extension is not installed
+        conn.execute(sqlalchemy.text("SET pg_trgm.similarity_threshold = '0.3'"))
+        conn.commit()
+        with Session(bind=conn) as session:
+            entity_values_maker.set_similarity_floor(session, 0.42)
+            assert session.execute(CURRENT_FLOOR).scalar() == '0.42'
+            session.commit()
+        assert conn.execute(CURRENT_FLOOR).scalar() == '0.3'
+        conn.execute(sqlalchemy.text('RESET pg_trgm.similarity_threshold'))
+        conn.commit()
+
+
+def test_init_db_adds_full_name_to_older_databases(trgm_db):
+    import db_interactor
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.text('ALTER TABLE player DROP COLUMN full_name'))
+    db_interactor.init_db()
+    with m.engine.connect() as conn:
+        conn.execute(sqlalchemy.insert(m.Player), [{'id': 1, 'name': 'Lionel', 'surname': 'Messi', 'value': 0}])
+        assert conn.execute(sqlalchemy.select(m.Player.full_name)).scalar() == 'Lionel Messi'
+        assert conn.execute(sqlalchemy.text(
+            "SELECT 1 FROM pg_indexes WHERE indexname = 'ix_player_full_name_gist'")).first() is not None
+        conn.rollback()
@@ -0,0 +1,34 @@
+import time
+
+from db_interactor import engines
+from data_generator import executor
+
+
+class Tracked(list):
+    # how many items were taken from the list so far
+    read = 0
+
+    def __iter__(self):
+        for i, item in enumerate(super().__iter__()):
+            self.read = i + 1
+            yield item
+
+
+def slow_square(x: int) -> int:
+    time.sleep(0.01)
+    return x * x
+
+
+def test_threads_only_take_as_many_items_as_workers():
+    items = Tracked(range(100))
+    results = executor.Executor('test_stage', executor.THREAD, workers=2).imap(slow_square, items)
+    first = next(results)
+    assert items.read <= 3
+    assert sorted([first, *results]) == [(x, x * x) for x in range(100)]
+
+
+def test_database_stages_on_threads_are_capped_to_the_pool(monkeypatch):
+    monkeypatch.setenv('TEST_STAGE_BACKEND', executor.THREAD)
+    connections = engines.POOL_SIZE + engines.MAX_OVERFLOW
+    assert executor.Executor('test_stage', executor.PROCESS, workers=connections + 4).workers == connections
+    assert executor.Executor('test_stage', executor.THREAD, workers=connections + 4).workers == connections + 4
@@ -0,0 +1,46 @@
+import datetime
+
+import sqlalchemy
+
+from db_interactor import model as m
+from data_generator import graph_refresh, neo4j_interactor
+from tests import test_neo4j_interactor as fixture
+
+# player 8 joins team 10 for the 2020 season while the full export is running
+LATE_MILITANCY = {'player_id': 8, 'team_id': 10, 'year': 2020, 'start_date': datetime.date(2020, 7, 1),
+                  'end_date': datetime.date(2021, 6, 30), 'appearences': 1}
+
+
+def _graph_changes() -> int:
+    with m.engine.connect() as conn:
+        return conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(m.GraphChange)).scalar()
+
+
+def test_changes_committed_during_the_export_are_refreshed(db):
+    fixture.seed()
+    change_id = graph_refresh.snapshot_played_with()
+
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.insert(m.Player), [{'id': 8, 'name': 'player', 'surname': '8', 'value': 8}])
+        conn.execute(sqlalchemy.insert(m.Militancy), [LATE_MILITANCY])
+    exported = set(neo4j_interactor.iter_played_with_snapshot())
+    graph_refresh.mark_exported(change_id)
+
+    assert exported == fixture.expected_played_with()
+    stats = graph_refresh.refresh_graph(graph_refresh.RecordingExecutor())
+    current = set(neo4j_interactor.iter_played_with())
+    assert stats['added'] == len(current - exported) > 0
+    assert all(8 in edge[:2] for edge in current - exported)
+    assert stats['removed'] == 0
+    assert _graph_changes() == 0
+
+
+def test_changelog_can_be_switched_off(db):
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.text("SET LOCAL graph.changelog = 'off'"))
+        conn.execute(sqlalchemy.insert(m.Player), [{'id': 1, 'name': 'player', 'surname': '1', 'value': 1}])
+    assert _graph_changes() == 0
+
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.insert(m.Player), [{'id': 2, 'name': 'player', 'surname': '2', 'value': 2}])
+    assert _graph_changes() == 1
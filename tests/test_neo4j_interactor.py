@@ -0,0 +1,66 @@
+import datetime
+
+import pytest
+import sqlalchemy
+
+from db_interactor import model as m
+from data_generator import neo4j_interactor
+
+D = datetime.date
+
+# (player_id, team_id, year, start_date, end_date): nested, equal, partly overlapping and disjoint windows, a player
+# twice in the same team and a player without militancies
+MILITANCIES = [
+    (1, 10, 2020, D(2020, 7, 1), D(2021, 6, 30)),
+    (2, 10, 2020, D(2020, 7, 1), D(2021, 6, 30)),
+    (3, 10, 2020, D(2020, 9, 1), D(2021, 1, 31)),
+    (4, 10, 2020, D(2021, 1, 1), D(2021, 12, 31)),
+    (5, 10, 2021, D(2021, 7, 1), D(2022, 6, 30)),
+    (1, 10, 2021, D(2021, 7, 1), D(2022, 6, 30)),
+    (1, 11, 2019, D(2019, 7, 1), D(2020, 6, 30)),
+    (6, 11, 2019, D(2019, 7, 1), D(2020, 6, 30)),
+    (2, 11, 2018, D(2018, 7, 1), D(2019, 6, 30)),
+]
+PLAYERS = (1, 2, 3, 4, 5, 6, 7)
+TEAMS = (10, 11)
+
+
+def expected_played_with():
+    # the PLAYED_WITH condition: same team, the other militancy within the window of the first one
+    return {(p_id, p_id2, team_id)
+            for p_id, team_id, _, start, end in MILITANCIES
+            for p_id2, team_id2, _, start2, end2 in MILITANCIES
+            if team_id2 == team_id and p_id2 != p_id and start2 >= start and end2 <= end}
+
+
+def seed():
+    with m.engine.begin() as conn:
+        conn.execute(sqlalchemy.insert(m.Team), [{'id': team_id, 'name': f'team {team_id}'} for team_id in TEAMS])
+        conn.execute(sqlalchemy.insert(m.Player), [{'id': p_id, 'name': 'player', 'surname': str(p_id), 'value': p_id}
+                                                    for p_id in PLAYERS])
+        conn.execute(sqlalchemy.insert(m.Militancy), [
+            {'player_id': p_id, 'team_id': team_id, 'year': year, 'start_date': start, 'end_date': end,
+             'appearences': 1} for p_id, team_id, year, start, end in MILITANCIES])
+
+
+def test_set_based_and_per_player_relationships_match(db, monkeypatch):
+    monkeypatch.setenv('RELATIONSHIPS_WORKERS', '2')
+    seed()
+    expected = expected_played_with()
+
+    set_based = list(neo4j_interactor.iter_played_with())
+    per_player = list(neo4j_interactor.iter_player_relationships())
+
+    assert expected
+    assert len(set_based) == len(set(set_based))
+    assert set(set_based) == expected
+    assert set(per_player) == expected
+
+
+@pytest.mark.parametrize('part_size', [0, -1])
+def test_part_size_must_be_positive(part_size, tmp_path):
+    with pytest.raises(ValueError, match='part_size must be positive'):
+        neo4j_interactor.dump_csvs([(1, 1.)], [], csv_files_root=tmp_path, part_size=part_size)
+    with pytest.raises(ValueError, match='part_size must be positive'):
+        neo4j_interactor.generate_relationships(csv_files_root=tmp_path, part_size=part_size)
+    assert tmp_path.exists()
@@ -0,0 +1,8 @@
+from db_interactor import query_plans
+
+TRIGRAM_QUERIES = ('player_candidates', 'team_candidates')
+
+
+def test_hot_queries_use_their_indexes(db):
+    queries = {name: q for name, q in query_plans.HOT_QUERIES.items() if db or name not in TRIGRAM_QUERIES}
+    assert query_plans.check_plans(queries) == {}
@@ -0,0 +1,22 @@
+import pytest
+
+from api_client import html_parsers, transfermarkt_scraper
+from benchmarks import bench_transfermarkt_parsers as bench
+
+EXTRACTORS = {'players': transfermarkt_scraper._extract_players, 'teams': transfermarkt_scraper._extract_teams}
+
+
+@pytest.mark.parametrize('backend', html_parsers.available_backends())
+@pytest.mark.parametrize('kind', sorted(EXTRACTORS))
+def test_every_backend_extracts_the_rows_of_the_saved_pages(backend, kind):
+    pages = bench.load_fixtures(bench.FIXTURES / kind)
+    assert pages
+    extracted = [EXTRACTORS[kind](page, html_parsers.get_parser(backend)) for page in pages]
+    assert extracted == bench.expected_rows(kind)
+
+
+def test_synthetic_pages_parse_like_the_saved_ones():
+    rows = [{'name': 'Zé Roberto & Co', 'age': 20, 'team': 'Brighton & Hove Albion', 'team_id': 1, 'value': 12.5}]
+    page = bench.render_page('players', rows)
+    assert transfermarkt_scraper._extract_players(page, html_parsers.get_parser('bs4')) == [
+        {'player': 'Zé Roberto & Co', 'team': 'Brighton & Hove Albion', 'value': 12}]
@@ -0,0 +1,54 @@
+import datetime
+import typing as t
+
+from api_client import sessions, transfermarkt_scraper
+
+
+class Response:
+    def __init__(self, status_code: int, text: str = '', headers: t.Dict = None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class Session:
+    def __init__(self, responses: t.List[Response]):
+        self.responses = responses
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+
+def test_a_429_only_waits_through_the_limiter(monkeypatch):
+    session = Session([Response(429, headers={'Retry-After': '0'}), Response(200, 'page')])
+    monkeypatch.setattr(sessions, 'get_session', lambda *args, **kwargs: session)
+    # the limiter paces the requests with short sleeps, the backoff would be an hour
+    monkeypatch.setattr(transfermarkt_scraper, 'BACKOFF', 3600)
+    slept = []
+    monkeypatch.setattr(transfermarkt_scraper.time, 'sleep', slept.append)
+
+    assert transfermarkt_scraper.fetch_page('https://tm-429.test/page') == 'page'
+    assert len(session.urls) == 2 and all(seconds < 3600 for seconds in slept)
+
+
+def test_pages_are_not_fetched_once_the_consumer_stops(monkeypatch):
+    fetched = []
+    monkeypatch.setattr(transfermarkt_scraper, 'fetch_page', lambda url, cache=None: fetched.append(url) or url)
+    pages = transfermarkt_scraper.iter_pages('https://tm.test/{page}', 100, lambda text: [text], workers=2)
+    next(pages)
+    pages.close()
+    assert len(fetched) < 100
+
+
+def test_runs_started_at_the_same_time_get_their_own_folder(monkeypatch, tmp_path):
+    class Now(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls(2023, 6, 2, 22, 8, 9, 123456)
+
+    monkeypatch.setattr(transfermarkt_scraper.datetime, 'datetime', Now)
+    paths = [transfermarkt_scraper.RunWriter('teams', 1, folder=tmp_path).path for _ in range(3)]
+    assert [path.name for path in paths] == ['teams_20230602_220809_123456', 'teams_20230602_220809_123456_1',
+                                             'teams_20230602_220809_123456_2']